@@ -0,0 +1,78 @@
+"""Benchmark: eager vs --compile denoising step time.
+
+Times an editing DDIM step (UNet + DeltaBlock) of the tiny random-weight
+DDPM (configs/tiny_ddpm.yml) in eager mode and with utils/compile_utils.py
+applied; the compilation itself is reported separately. Run from
+src/lib/asyrp:
+
+    python -m benchmarks.bench_compile --device cpu --bs 4 --repeat 20
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.suite import tiny_config, tiny_ddpm
+from utils.compile_utils import compile_model, warmup, DEFAULT_CACHE_DIR
+from utils.diffusion_utils import get_beta_schedule, denoising_step, DiffusionSchedule
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--bs', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'])
+    parser.add_argument('--layer_type', type=str, default='conv', help='db_layer_type of the DeltaBlock')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    config = tiny_config()
+    torch.manual_seed(0)
+    eager = tiny_ddpm(config, device, layer_type=args.layer_type)
+    compiled = copy.deepcopy(eager)
+
+    betas = get_beta_schedule(beta_start=0.0001, beta_end=0.02, num_diffusion_timesteps=1000)
+    b = torch.from_numpy(betas).float().to(device)
+    logvars = np.log(np.append(betas[1], betas[1:]))
+    schedule = DiffusionSchedule(b, logvars, device=device)
+    size = config.data.image_size
+    xt = torch.randn(args.bs, 3, size, size, device=device)
+    t = torch.full((args.bs,), 500, device=device)
+    t_next = torch.full((args.bs,), 475, device=device)
+
+    start = time.perf_counter()
+    compile_model(compiled, mode=args.mode, cache_dir=args.cache_dir)
+    warmup(compiled, args.bs, size, device, index=0)
+    _sync(device)
+    print(f"compile + warm-up: {time.perf_counter() - start:.1f} s (cache: {args.cache_dir})")
+
+    outputs = {}
+    for name, model in (('eager', eager), ('compiled', compiled)):
+        def step():
+            with torch.no_grad():
+                return denoising_step(xt, t=t, t_next=t_next, models=model, logvars=logvars, b=b, schedule=schedule,
+                                      sampling_type='ddim', eta=0.0, index=0, t_edit=0, hs_coeff=(1.0, 1.0))[0]
+
+        outputs[name] = step()  # warm-up
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            step()
+        _sync(device)
+        print(f"{name:>9s}: {(time.perf_counter() - start) / args.repeat * 1e3:9.2f} ms/step")
+
+    diff = (outputs['eager'] - outputs['compiled']).abs().max().item()
+    print(f"max |x_eager - x_compiled|: {diff:.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Micro-benchmark: per-step coefficient setup in `denoising_step`.
+
+Compares the old per-step path, kept here as `per_call_step` (coefficients
+gathered from `b`/`logvars` and the cumprod of 1 - b rebuilt on every call),
+with `denoising_step` on a run-wide `DiffusionSchedule`. The UNet is replaced
+by a constant-eps module so only the sampler bookkeeping is timed. Run from
+src/lib/asyrp:
+
+    python -m benchmarks.bench_diffusion_schedule --device cuda --bs 8
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+
+from utils.diffusion_utils import get_beta_schedule, denoising_step, DiffusionSchedule
+
+
+class ConstantEps(nn.Module):
+    """Stands in for the UNet; returns (et, et_modified, delta_h, middle_h)."""
+
+    def forward(self, x, t, **kwargs):
+        et = torch.full_like(x, 0.1)
+        return et, et, None, None
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def per_call_extract(a, t, x_shape):
+    """`extract` as it was: `a` is copied to t.device on every call."""
+    bs, = t.shape
+    out = torch.gather(torch.tensor(a, dtype=torch.float, device=t.device), 0, t.long())
+    return out.reshape((bs,) + (1,) * (len(x_shape) - 1))
+
+
+def per_call_step(xt, t, t_next, *, models, logvars, b, sampling_type='ddim', eta=0.0):
+    """The coefficient setup of `denoising_step` before DiffusionSchedule."""
+    et, _, _, _ = models(xt, t)
+    logvar = per_call_extract(logvars, t, xt.shape)
+
+    bt = per_call_extract(b, t, xt.shape)
+    at = per_call_extract((1.0 - b).cumprod(dim=0), t, xt.shape)
+    if t_next.sum() == -t_next.shape[0]:
+        at_next = torch.ones_like(at)
+    else:
+        at_next = per_call_extract((1.0 - b).cumprod(dim=0), t_next, xt.shape)
+
+    if sampling_type == 'ddpm':
+        weight = bt / torch.sqrt(1 - at)
+        mean = 1 / torch.sqrt(1.0 - bt) * (xt - weight * et)
+        noise = torch.randn_like(xt)
+        mask = 1 - (t == 0).float()
+        mask = mask.reshape((xt.shape[0],) + (1,) * (len(xt.shape) - 1))
+        return (mean + mask * torch.exp(0.5 * logvar) * noise).float()
+
+    x0_t = (xt - et * (1 - at).sqrt()) / at.sqrt()
+    if eta == 0:
+        return at_next.sqrt() * x0_t + (1 - at_next).sqrt() * et
+    c1 = eta * ((1 - at / (at_next)) * (1 - at_next) / (1 - at)).sqrt()
+    c2 = ((1 - at_next) - c1 ** 2).sqrt()
+    return at_next.sqrt() * x0_t + c2 * et + c1 * torch.randn_like(xt)
+
+
+def run(xt, seq, seq_next, model, b, logvars, schedule, sampling_type):
+    """`schedule=None` runs the old per-call path."""
+    x = xt
+    for i, j in zip(reversed(seq), reversed(seq_next)):
+        t = torch.full((x.shape[0],), i, device=x.device)
+        t_next = torch.full((x.shape[0],), j, device=x.device)
+        if schedule is None:
+            x = per_call_step(x, t, t_next, models=model, logvars=logvars, b=b,
+                              sampling_type=sampling_type, eta=0.0)
+        else:
+            x, _, _, _ = denoising_step(x, t=t, t_next=t_next, models=model,
+                                        logvars=logvars, b=b, schedule=schedule,
+                                        sampling_type=sampling_type, eta=0.0)
+    return x
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--bs', type=int, default=1)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--n_step', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--sampling_type', type=str, default='ddim')
+    args = parser.parse_args()
+
+    # torch.tensor(b) in the old extract copy-constructs from a tensor, which warns
+    warnings.filterwarnings('ignore', message='To copy construct')
+    device = torch.device(args.device)
+    betas = get_beta_schedule(beta_start=0.0001, beta_end=0.02, num_diffusion_timesteps=1000)
+    alphas_cumprod = np.cumprod(1.0 - betas, axis=0)
+    alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+    posterior_variance = betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
+    logvars = np.log(np.append(posterior_variance[1], betas[1:]))
+    b = torch.from_numpy(betas).float().to(device)
+
+    seq = list(np.linspace(0, 999, args.n_step).astype(int))
+    seq_next = [-1] + seq[:-1]
+    xt = torch.randn(args.bs, 3, args.image_size, args.image_size, device=device)
+    model = ConstantEps()
+    schedule = DiffusionSchedule(b, logvars, device=device)
+
+    results = {}
+    for name, sched in (('per-call tables', None), ('DiffusionSchedule', schedule)):
+        out = run(xt, seq, seq_next, model, b, logvars, sched, args.sampling_type)  # warm-up
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            out = run(xt, seq, seq_next, model, b, logvars, sched, args.sampling_type)
+        _sync(device)
+        elapsed = (time.perf_counter() - start) / (args.repeat * args.n_step)
+        results[name] = out
+        print(f"{name:>20s}: {elapsed * 1e6:9.1f} us/step")
+
+    diff = (results['per-call tables'] - results['DiffusionSchedule']).abs().max().item()
+    print(f"max |x_old - x_new| after {args.n_step} steps: {diff:.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""End-to-end benchmark: precompute, train and test on synthetic data and weights.
+
+Runs the real entry points (--just_precompute, --run_train, --run_test) with
+configs/tiny_ddpm.yml, a random-init DDPM checkpoint, a generated LMDB and a
+small random CLIP, so no pretrained weights, downloads or datasets are
+needed. Everything is written to a scratch work directory. Each phase is
+profiled with --profile stages; wall time and the per-stage summary of every
+phase go to --out. Run from src/lib/asyrp:
+
+    python -m benchmarks.bench_e2e --n_img 8 --bs 2 --n_step 10 --out e2e.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ASYRP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ASYRP not in sys.path:
+    sys.path.insert(0, ASYRP)
+
+import torch
+import yaml
+
+from benchmarks.synthetic import write_synthetic_lmdb, write_random_ddpm_checkpoint, tiny_clip
+
+CONFIG = 'tiny_ddpm.yml'
+CLIP_NAME = 'synthetic-tiny'
+
+
+def phase_argv(args, workdir):
+    n_step = str(args.n_step)
+    return ['--config', CONFIG, '--exp', os.path.join('runs', 'synthetic'), '--edit_attr', 'smiling', '--ni', '1',
+            '--logger', 'local', '--profile', 'stages',
+            '--model_path', os.path.join(workdir, 'tiny_ddpm.ckpt'), '--clip_model_name', CLIP_NAME,
+            '--n_train_img', str(args.n_img), '--n_test_img', str(args.n_img), '--n_precomp_img', str(args.n_img),
+            '--bs_train', str(args.bs), '--bs_test', str(args.bs), '--bs_precompute', str(args.bs),
+            '--n_inv_step', n_step, '--n_train_step', n_step, '--n_test_step', n_step,
+            '--get_h_num', '1', '--train_delta_block', '--n_iter', '1', '--do_train', '1', '--do_test', '0',
+            '--user_defined_t_edit', '500', '--user_defined_t_addnoise', '200'] + args.extra
+
+
+PHASES = {
+    'precompute': ['--run_train', '--just_precompute', '--sh_file_name', 'script_precompute.sh'],
+    'train': ['--run_train', '--sh_file_name', 'script_train.sh'],
+    'test': ['--run_test', '--sh_file_name', 'script_inference.sh'],
+}
+
+
+def prepare(workdir, n_img):
+    """Work directory with the configs/scripts the runner reads, the LMDBs and the random weights."""
+    from main import dict2namespace
+
+    for name in ('configs', 'scripts'):
+        if not os.path.exists(os.path.join(workdir, name)):
+            os.symlink(os.path.join(ASYRP, name), os.path.join(workdir, name))
+    with open(os.path.join(ASYRP, 'configs', CONFIG)) as f:
+        config = dict2namespace(yaml.safe_load(f))
+    data_root = os.path.join(workdir, 'data')
+    for split in ('LMDB_train', 'LMDB_test'):
+        if not os.path.exists(os.path.join(data_root, split)):
+            os.makedirs(os.path.join(data_root, split))
+            write_synthetic_lmdb(os.path.join(data_root, split), n_img, config.data.image_size,
+                                 seed=int(split == 'LMDB_test'))
+    if not os.path.exists(os.path.join(workdir, 'tiny_ddpm.ckpt')):
+        write_random_ddpm_checkpoint(config, os.path.join(workdir, 'tiny_ddpm.ckpt'))
+    return data_root
+
+
+def run_phase(name, argv):
+    from main import parse_args_and_config
+    from diffusion_latent import Asyrp
+    from utils.profiling import stop_profiling
+
+    args, config = parse_args_and_config(argv)
+    start = time.perf_counter()
+    runner = Asyrp(args, config)
+    if name == 'test':
+        runner.run_test()
+    else:
+        runner.run_training()
+    runner.image_writer.flush()
+    runner.metrics.flush()
+    wall = time.perf_counter() - start
+    stages = stop_profiling() or {}
+    print(f"{name}: {wall:.2f} s")
+    return {'wall_s': wall, 'stages': stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n_img', type=int, default=8, help='# of synthetic train and test images')
+    parser.add_argument('--bs', type=int, default=2)
+    parser.add_argument('--n_step', type=int, default=10, help='# of inversion, train and test steps')
+    parser.add_argument('--phases', type=str, nargs='+', choices=list(PHASES), default=list(PHASES))
+    parser.add_argument('--workdir', type=str, default=None, help='reused if it exists (default: a new temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    parser.add_argument('--out', type=str, default='e2e.json')
+    parser.add_argument('--extra', type=str, nargs=argparse.REMAINDER, default=[],
+                        help='more main.py arguments for every phase, e.g. --extra --stack_decoders')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='asyrp_e2e_'))
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        data_root = prepare(workdir, args.n_img)
+        os.chdir(workdir)
+        # text features of the random CLIP stay in the work directory
+        os.environ['ASYRP_TEXT_CACHE'] = os.path.join(workdir, 'clip_text_features.pt')
+
+        from configs.paths_config import DATASET_PATHS
+        from losses.clip_loss import register_clip
+        DATASET_PATHS['CelebA_HQ'] = data_root
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')  # as in main.py
+        model, preprocess = tiny_clip(64)
+        register_clip(CLIP_NAME, device, model.to(device), preprocess)
+
+        results = {'meta': {'n_img': args.n_img, 'bs': args.bs, 'n_step': args.n_step, 'device': str(device),
+                            'torch': torch.__version__, 'extra': args.extra}}
+        for name in args.phases:
+            results[name] = run_phase(name, phase_argv(args, workdir) + PHASES[name])
+    finally:
+        os.chdir(cwd)
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
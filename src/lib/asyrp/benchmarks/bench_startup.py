@@ -0,0 +1,82 @@
+"""Startup benchmark: wall clock of fresh interpreters for the CLI entry points.
+
+Times, each in a new process:
+  help         python main.py --help
+  parse        argument parsing + config load (no side effects, no torch)
+  runner       import of diffusion_latent (what every real run pays before work starts)
+
+With --importtime, the slowest imports of each command are listed
+(from `python -X importtime`). Run from src/lib/asyrp:
+
+    python -m benchmarks.bench_startup --repeat 5 --importtime
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+PARSE = (
+    "import os, yaml, main; "
+    "args = main.get_parser().parse_args(['--config', {config!r}]); "
+    "f = open(os.path.join('configs', args.config)); "
+    "main.dict2namespace(yaml.safe_load(f))"
+)
+
+COMMANDS = {
+    'help': ['main.py', '--help'],
+    'parse': ['-c', PARSE],
+    'runner': ['-c', 'import diffusion_latent'],
+}
+
+
+def time_command(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def slowest_imports(cmd, top):
+    out = subprocess.run([sys.executable, '-X', 'importtime'] + cmd,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    rows = []
+    for line in out.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # top level imports only
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--config', type=str, default='celeba.yml')
+    parser.add_argument('--importtime', action='store_true', help='list the slowest top level imports')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--only', type=str, nargs='*', choices=sorted(COMMANDS), default=None)
+    args = parser.parse_args()
+
+    os.environ.setdefault('WANDB_MODE', 'disabled')
+    for name, cmd in COMMANDS.items():
+        if args.only and name not in args.only:
+            continue
+        cmd = [c.format(config=args.config) if c.startswith('import') else c for c in cmd]
+        try:
+            elapsed = time_command(cmd, args.repeat)
+        except subprocess.CalledProcessError as e:
+            print(f"{name:>8s}: failed ({e})")
+            continue
+        print(f"{name:>8s}: {elapsed * 1e3:8.1f} ms (median of {args.repeat})")
+        if args.importtime:
+            for cumulative, module in slowest_imports(cmd, args.top):
+                print(f"{'':>10s}{cumulative / 1e3:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
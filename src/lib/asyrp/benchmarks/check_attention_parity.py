@@ -0,0 +1,91 @@
+"""Parity and speed check: F.scaled_dot_product_attention vs the legacy attention.
+
+Runs every attention block of the three model families (DDPM AttnBlock,
+QKVAttentionLegacy and QKVAttention of improved_ddpm and guided_diffusion)
+on random inputs at the 16x16 attention resolution, once on each path. It
+reports the max abs difference and the time and peak memory of both paths,
+and exits non-zero when a difference exceeds --atol. Run from src/lib/asyrp:
+
+    python -m benchmarks.check_attention_parity --device cuda --dtype float16
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from models.attention import set_sdpa
+from models.ddpm.diffusion import AttnBlock
+from models.improved_ddpm import unet as improved_unet
+from models.guided_diffusion import unet as guided_unet
+
+
+def blocks(channels, n_heads):
+    yield 'ddpm.AttnBlock', AttnBlock(channels), 'bchw'
+    for family, module in (('improved_ddpm', improved_unet), ('guided_diffusion', guided_unet)):
+        yield f'{family}.QKVAttentionLegacy', module.QKVAttentionLegacy(n_heads), 'qkv'
+        yield f'{family}.QKVAttention', module.QKVAttention(n_heads), 'qkv'
+
+
+def measure(fn, device, repeat):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    out = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return out, (time.perf_counter() - start) / repeat * 1e3, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'])
+    parser.add_argument('--bs', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--n_heads', type=int, default=4)
+    parser.add_argument('--resolution', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--atol', type=float, default=None, help='default: 1e-4 for float32, 2e-2 otherwise')
+    args = parser.parse_args()
+
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    atol = args.atol if args.atol is not None else (1e-4 if dtype == torch.float32 else 2e-2)
+    torch.manual_seed(0)
+    length = args.resolution ** 2
+
+    failed = []
+    print(f"{'block':<36s}{'max |diff|':>12s}{'legacy ms':>11s}{'sdpa ms':>9s}{'legacy MB':>11s}{'sdpa MB':>9s}")
+    for name, block, layout in blocks(args.channels, args.n_heads):
+        block = block.to(device, dtype).eval()
+        if layout == 'bchw':
+            x = torch.randn(args.bs, args.channels, args.resolution, args.resolution, device=device, dtype=dtype)
+        else:
+            x = torch.randn(args.bs, 3 * args.channels, length, device=device, dtype=dtype)
+
+        results = {}
+        for path, enabled in (('legacy', False), ('sdpa', True)):
+            set_sdpa(enabled)
+            with torch.no_grad():
+                results[path] = measure(lambda: block(x), device, args.repeat)
+        set_sdpa(True)
+
+        diff = (results['legacy'][0].float() - results['sdpa'][0].float()).abs().max().item()
+        if diff > atol:
+            failed.append(name)
+        print(f"{name:<36s}{diff:12.2e}{results['legacy'][1]:11.3f}{results['sdpa'][1]:9.3f}"
+              f"{results['legacy'][2]:11.1f}{results['sdpa'][2]:9.1f}{'  MISMATCH' if diff > atol else ''}")
+
+    if failed:
+        print(f"outputs differ by more than {atol:g}: {', '.join(failed)}")
+        return 1
+    print(f"all blocks match within {atol:g}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
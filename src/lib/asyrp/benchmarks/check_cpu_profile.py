@@ -0,0 +1,100 @@
+"""Speed and quality check of --cpu_profile: channels_last and bfloat16 autocast on the CPU.
+
+Runs the same edited DDIM trajectory (UNet + DeltaBlock) three times: NCHW
+fp32 as the reference, channels_last fp32, and channels_last under bf16
+autocast. It reports the time of each and the LPIPS of the bf16 images
+against the fp32 ones, and exits non-zero when the LPIPS exceeds
+--max_lpips. The tiny random-weight DDPM is used unless a real --config and
+--model_path are given. Run from src/lib/asyrp:
+
+    python -m benchmarks.check_cpu_profile --bs 2 --n_step 20
+    python -m benchmarks.check_cpu_profile --config celeba.yml --model_path pretrained/celeba_hq.ckpt
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from benchmarks.suite import tiny_config, tiny_ddpm
+from main import dict2namespace
+from utils.cpu_profile import configure_threads, to_channels_last, cpu_autocast
+from utils.diffusion_utils import get_beta_schedule, denoising_step, DiffusionSchedule
+
+
+def load_model(args):
+    if args.config is None:
+        config = tiny_config()
+        torch.manual_seed(0)
+        return config, tiny_ddpm(config, 'cpu')
+    with open(os.path.join('configs', args.config)) as f:
+        config = dict2namespace(yaml.safe_load(f))
+    # a random DeltaBlock: the check is about the numerics of the edit path, not the edit
+    torch.manual_seed(0)
+    model = tiny_ddpm(config, 'cpu')
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'), strict=False)
+    return config, model
+
+
+@torch.no_grad()
+def trajectory(model, xT, seq, b, logvars, schedule, bf16):
+    x = xT.clone()
+    seq_next = [-1] + seq[:-1]
+    with cpu_autocast(bf16):
+        for i, j in zip(reversed(seq), reversed(seq_next)):
+            t = torch.full((x.shape[0],), i)
+            t_next = torch.full((x.shape[0],), j)
+            x = denoising_step(x, t=t, t_next=t_next, models=model, logvars=logvars, b=b, schedule=schedule,
+                               sampling_type='ddim', eta=0.0, index=0, t_edit=0, hs_coeff=(1.0, 1.0))[0]
+    return x.float()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', type=str, default=None, help='a DDPM config in configs/ (default: tiny_ddpm.yml, random weights)')
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--bs', type=int, default=2)
+    parser.add_argument('--n_step', type=int, default=20, help='# of DDIM steps from t=999')
+    parser.add_argument('--threads', type=int, default=None, help='default: all physical cores')
+    parser.add_argument('--max_lpips', type=float, default=0.05)
+    args = parser.parse_args()
+
+    cores = configure_threads(args.threads)
+    config, model = load_model(args)
+    models = {'fp32 NCHW': (model, False), 'fp32 channels_last': (to_channels_last(copy.deepcopy(model)), False)}
+    models['bf16 channels_last'] = (models['fp32 channels_last'][0], True)
+
+    betas = get_beta_schedule(beta_start=config.diffusion.beta_start, beta_end=config.diffusion.beta_end,
+                              num_diffusion_timesteps=config.diffusion.num_diffusion_timesteps)
+    b = torch.from_numpy(betas).float()
+    logvars = np.log(np.append(betas[1], betas[1:]))
+    schedule = DiffusionSchedule(b, logvars, device=torch.device('cpu'))
+    seq = [int(s + 1e-6) for s in np.linspace(0, 1, args.n_step) * 999]
+    size = config.data.image_size
+    xT = torch.randn(args.bs, 3, size, size, generator=torch.Generator().manual_seed(0))
+
+    print(f"{len(cores)} threads, bs {args.bs}, {args.n_step} steps, {size}px")
+    outputs = {}
+    for name, (m, bf16) in models.items():
+        trajectory(m, xT, seq[:2], b, logvars, schedule, bf16)  # warm-up
+        start = time.perf_counter()
+        outputs[name] = trajectory(m, xT, seq, b, logvars, schedule, bf16)
+        print(f"{name:>20s}: {time.perf_counter() - start:8.2f} s")
+
+    import lpips
+    loss_fn = lpips.LPIPS(net='alex', verbose=False)
+    reference = outputs['fp32 NCHW'].clamp(-1, 1)
+    layout_diff = (outputs['fp32 channels_last'] - outputs['fp32 NCHW']).abs().max().item()
+    with torch.no_grad():
+        bf16_lpips = loss_fn(outputs['bf16 channels_last'].clamp(-1, 1), reference).mean().item()
+    print(f"max |fp32 channels_last - fp32 NCHW|: {layout_diff:.3e}")
+    print(f"LPIPS(bf16, fp32): {bf16_lpips:.4f} (max {args.max_lpips:g})")
+    return int(bf16_lpips > args.max_lpips)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
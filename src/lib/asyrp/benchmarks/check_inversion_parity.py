@@ -0,0 +1,89 @@
+"""Parity check: batched DDIM inversion (--bs_precompute N) vs one image at a time.
+
+Inverts and reconstructs the same fixed-seed images with Asyrp.invert_batch,
+once per image (bs=1, the serial precompute) and once as a single batch of
+--n_img, on the tiny random-weight DDPM (configs/tiny_ddpm.yml). It reports
+whether x_lat and x_rec match bit for bit and their max abs difference, and
+exits non-zero when a difference exceeds --atol. Run from src/lib/asyrp:
+
+    python -m benchmarks.check_inversion_parity --n_img 4 --n_inv_step 40 --device cuda
+
+Batched convolution/GEMM kernels may accumulate in a different order than
+the bs=1 ones, so an exact match is not guaranteed on every backend; the
+float32 result is required to stay within --atol (default 1e-5, after
+--n_inv_step inversion and as many generative steps).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+ASYRP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ASYRP not in sys.path:
+    sys.path.insert(0, ASYRP)
+
+import torch
+
+from benchmarks.suite import tiny_ddpm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--n_img', type=int, default=4)
+    parser.add_argument('--n_inv_step', type=int, default=40)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    # the runner creates its folders in the working directory
+    workdir = tempfile.mkdtemp(prefix='asyrp_inversion_parity_')
+    cwd = os.getcwd()
+    try:
+        os.symlink(os.path.join(ASYRP, 'configs'), os.path.join(workdir, 'configs'))
+        os.chdir(workdir)
+        from main import parse_args_and_config
+        from diffusion_latent import Asyrp
+
+        run_args, config = parse_args_and_config(
+            ['--config', 'tiny_ddpm.yml', '--exp', os.path.join('runs', 'parity'), '--edit_attr', 'smiling', '--ni', '1',
+             '--logger', 'none', '--n_inv_step', str(args.n_inv_step)])
+        device = torch.device(args.device)
+        config.device = device
+        runner = Asyrp(run_args, config, device=device)
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+
+        torch.manual_seed(0)
+        model = runner.prepare_model(tiny_ddpm(config, device), args.n_img)
+        size = config.data.image_size
+        x0 = torch.rand(args.n_img, 3, size, size, generator=torch.Generator().manual_seed(0)) * 2 - 1
+
+        seq_inv = [int(s + 1e-6) for s in np.linspace(0, 1, args.n_inv_step) * run_args.t_0]
+        seq_inv_next = [-1] + list(seq_inv[:-1])
+
+        serial = [runner.invert_batch(model, x0[k:k + 1], [k], 'parity', seq_inv, seq_inv_next) for k in range(args.n_img)]
+        batched = runner.invert_batch(model, x0, list(range(args.n_img)), 'parity', seq_inv, seq_inv_next)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = False
+    for name, pos in (('x_lat', 2), ('x_rec', 1)):
+        one = torch.cat([out[pos].cpu() for out in serial], dim=0)
+        many = batched[pos].cpu()
+        diff = (one - many).abs().max().item()
+        exact = torch.equal(one, many)
+        failed |= diff > args.atol
+        print(f"{name}: {'bit-exact' if exact else 'not bit-exact'}, max |bs=1 - bs={args.n_img}| = {diff:.3e}"
+              f"{'  EXCEEDS ' + format(args.atol, 'g') if diff > args.atol else ''}")
+    if failed:
+        return 1
+    print(f"batched inversion matches bs=1 within {args.atol:g}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""Micro-benchmark suite for the Asyrp hot paths, on random weights.
+
+Cases use configs/tiny_ddpm.yml (ch 32, 64 px; the h-space is the real
+512x8x8), so the suite runs on a CPU. Every case is timed as the median of
+--repeat runs after --warmup runs; results go to a JSON file that `compare`
+checks against a baseline. Run from src/lib/asyrp:
+
+    python -m benchmarks.suite run --out bench.json
+    python -m benchmarks.suite run --out new.json --filter delta_block
+    python -m benchmarks.suite compare bench.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from main import dict2namespace
+from benchmarks.synthetic import write_synthetic_lmdb, tiny_clip
+
+
+CASES = []
+
+
+def case(fn):
+    CASES.append(fn)
+    return fn
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e3
+    return {'median_ms': float(np.median(times)), 'mean_ms': float(times.mean()), 'min_ms': float(times.min())}
+
+
+def tiny_config():
+    with open(os.path.join('configs', 'tiny_ddpm.yml')) as f:
+        return dict2namespace(yaml.safe_load(f))
+
+
+def tiny_ddpm(config, device, layer_type='conv', emb_type='add'):
+    from models.ddpm.diffusion import DDPM
+    model = DDPM(config)
+    model.db_layer_type = layer_type
+    model.db_emb_type = emb_type
+    model.db_nheads = 1
+    model.db_num_layers = 1
+    model.db_dim_feedforward = 2048
+    model.use_midblock = False
+    model.setattr_layers(1)
+    return model.to(device).eval()
+
+
+# Every case yields (name, fn) pairs; fn runs one timed iteration.
+
+@case
+def bench_slerp(ctx):
+    from models.ddpm.diffusion import slerp
+    v0 = torch.randn(ctx.bs, 512, 8, 8, device=ctx.device)
+    v1 = torch.randn(ctx.bs, 512, 8, 8, device=ctx.device)
+    yield 'slerp', lambda: slerp(0.3, v0, v1)
+
+
+@case
+def bench_ddpm_forward(ctx):
+    model = tiny_ddpm(ctx.config, ctx.device)
+    size = ctx.config.data.image_size
+    x = torch.randn(ctx.bs, 3, size, size, device=ctx.device)
+    t = torch.full((ctx.bs,), 500, device=ctx.device)
+
+    def forward(**kwargs):
+        with torch.no_grad():
+            model(x, t, **kwargs)
+
+    yield 'ddpm_forward/plain', lambda: forward()
+    yield 'ddpm_forward/index', lambda: forward(index=0, t_edit=0, hs_coeff=(1.0, 1.0))
+    model.stack_decoders = True
+    yield 'ddpm_forward/index_stacked', lambda: forward(index=0, t_edit=0, hs_coeff=(1.0, 1.0))
+
+
+@case
+def bench_denoising_step(ctx):
+    from utils.diffusion_utils import get_beta_schedule, denoising_step, DiffusionSchedule
+    model = tiny_ddpm(ctx.config, ctx.device)
+    betas = get_beta_schedule(beta_start=0.0001, beta_end=0.02, num_diffusion_timesteps=1000)
+    b = torch.from_numpy(betas).float().to(ctx.device)
+    logvars = np.log(np.append(betas[1], betas[1:]))
+    schedule = DiffusionSchedule(b, logvars, device=ctx.device)
+    size = ctx.config.data.image_size
+    xt = torch.randn(ctx.bs, 3, size, size, device=ctx.device)
+    t = torch.full((ctx.bs,), 500, device=ctx.device)
+    t_next = torch.full((ctx.bs,), 475, device=ctx.device)
+
+    def step(**kwargs):
+        with torch.no_grad():
+            denoising_step(xt, t=t, t_next=t_next, models=model, logvars=logvars, b=b, schedule=schedule,
+                           sampling_type='ddim', eta=0.0, **kwargs)
+
+    yield 'denoising_step/ddim', lambda: step()
+    yield 'denoising_step/ddim_edit', lambda: step(index=0, t_edit=0, hs_coeff=(1.0, 1.0))
+
+
+@case
+def bench_delta_block(ctx):
+    from models.ddpm.diffusion import DeltaBlock
+    h = torch.randn(ctx.bs, 512, 8, 8, device=ctx.device)
+    temb = torch.randn(ctx.bs, 512, device=ctx.device)
+    for layer_type in ('conv', 'c_transformer_simple', 'p_transformer_simple',
+                       'cp_transformer_simple', 'pc_transformer_simple'):
+        for emb_type in ('add', 'mult', 'adagn'):
+            try:
+                block = DeltaBlock(in_channels=512, out_channels=512, temb_channels=512, dropout=0.0,
+                                   layer_type=layer_type, emb_type=emb_type).to(ctx.device).eval()
+            except ImportError as e:  # adagn needs diffusers
+                print(f"skipping delta_block/{layer_type}/{emb_type}: {e}")
+                continue
+
+            def forward(block=block):
+                with torch.no_grad():
+                    block(h, temb)
+
+            yield f'delta_block/{layer_type}/{emb_type}', forward
+
+
+@case
+def bench_transformer(ctx):
+    from models.ddpm.diffusion import TransformerSimple, DualTransformerSimple
+    h = torch.randn(ctx.bs, 512, 8, 8, device=ctx.device)
+    layers = {
+        'transformer_simple/pixel': TransformerSimple(1, 1, 2048, 0.0, 'pixel'),
+        'transformer_simple/channel': TransformerSimple(1, 1, 2048, 0.0, 'channel'),
+        'dual_transformer_simple/cp': DualTransformerSimple(1, 1, 2048, 0.0, 'cp'),
+        'dual_transformer_simple/pc': DualTransformerSimple(1, 1, 2048, 0.0, 'pc'),
+    }
+    for name, layer in layers.items():
+        layer = layer.to(ctx.device).eval()
+
+        def forward(layer=layer):
+            with torch.no_grad():
+                layer(h)
+
+        yield name, forward
+
+
+@case
+def bench_clip_direction_loss(ctx):
+    try:
+        from losses.clip_loss import CLIPLoss, register_clip
+        model, preprocess = tiny_clip(64)
+    except ImportError as e:
+        print(f"skipping clip_direction_loss: {e}")
+        return
+    # the direction is set directly, so no text is encoded
+    register_clip('bench-tiny', ctx.device, model.to(ctx.device), preprocess)
+    loss = CLIPLoss(ctx.device, clip_model='bench-tiny')
+    direction = torch.randn(1, 64, device=ctx.device)
+    loss.target_direction = direction / direction.norm(dim=-1, keepdim=True)
+    size = ctx.config.data.image_size
+    src = torch.rand(ctx.bs, 3, size, size, device=ctx.device) * 2 - 1
+    trg = torch.rand(ctx.bs, 3, size, size, device=ctx.device) * 2 - 1
+    with torch.no_grad():
+        src_features = loss.get_image_features(src)
+
+    def direction_loss(**kwargs):
+        with torch.no_grad():
+            loss.clip_directional_loss(src, 'face', trg, 'smiling face', **kwargs)
+
+    yield 'clip_direction_loss', lambda: direction_loss()
+    yield 'clip_direction_loss/cached_src', lambda: direction_loss(src_features=src_features)
+
+
+@case
+def bench_lmdb_read(ctx):
+    try:
+        import torchvision.transforms as tfs
+        from datasets.CelebA_HQ_dataset import MultiResolutionDataset
+        size = ctx.config.data.image_size
+        n_images = 64
+        ctx.tmp_dirs.append(tempfile.TemporaryDirectory())
+        path = ctx.tmp_dirs[-1].name
+        write_synthetic_lmdb(path, n_images, size)
+    except ImportError as e:
+        print(f"skipping lmdb_read: {e}")
+        return
+    dataset = MultiResolutionDataset(path, tfs.Compose([tfs.ToTensor(), tfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]), size)
+
+    def read():
+        for i in range(n_images):
+            dataset[i]
+
+    yield f'lmdb_read/{n_images}_images', read
+
+
+def run(args):
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    ctx = argparse.Namespace(device=torch.device(args.device), bs=args.bs, config=tiny_config(), tmp_dirs=[])
+    results = {}
+    for fn in CASES:
+        for name, bench in fn(ctx):
+            if args.filter and not re.search(args.filter, name):
+                continue
+            results[name] = timeit(bench, ctx.device, args.repeat, args.warmup)
+            print(f"{name:<45s}{results[name]['median_ms']:10.3f} ms")
+    for tmp_dir in ctx.tmp_dirs:
+        tmp_dir.cleanup()
+
+    out = {
+        'meta': {'device': args.device, 'bs': args.bs, 'repeat': args.repeat, 'torch': torch.__version__,
+                 'python': platform.python_version(), 'machine': platform.machine(),
+                 'threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(out, f, indent=2)
+    print(f"results written to {args.out}")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base['meta']['device'] != new['meta']['device'] or base['meta']['bs'] != new['meta']['bs']:
+        print(f"warning: comparing {base['meta']} with {new['meta']}")
+
+    regressions = []
+    print(f"{'case':<45s}{'base ms':>10s}{'new ms':>10s}{'change':>9s}")
+    for name in sorted(set(base['results']) | set(new['results'])):
+        if name not in base['results'] or name not in new['results']:
+            print(f"{name:<45s}  only in {'new' if name in new['results'] else 'base'}")
+            continue
+        b, n = base['results'][name][args.metric], new['results'][name][args.metric]
+        change = n / b - 1
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -args.threshold:
+            flag = '  faster'
+        print(f"{name:<45s}{b:10.3f}{n:10.3f}{change:+9.1%}{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} case(s) slower by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and write their results')
+    run_parser.add_argument('--out', type=str, default='bench.json')
+    run_parser.add_argument('--device', type=str, default='cpu')
+    run_parser.add_argument('--bs', type=int, default=2)
+    run_parser.add_argument('--repeat', type=int, default=20)
+    run_parser.add_argument('--warmup', type=int, default=3)
+    run_parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0: torch default)')
+    run_parser.add_argument('--filter', type=str, default=None, help='regex on the case names')
+
+    compare_parser = subparsers.add_parser('compare', help='flag cases of `new` slower than in `base`')
+    compare_parser.add_argument('base', type=str)
+    compare_parser.add_argument('new', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown that counts as a regression')
+    compare_parser.add_argument('--metric', type=str, default='median_ms', choices=['median_ms', 'mean_ms', 'min_ms'])
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""Synthetic stand-ins for the data and weights the Asyrp entry points expect:
+an LMDB in the MultiResolutionDataset layout, a random-init DDPM checkpoint
+and a small random CLIP."""
+import io
+
+import numpy as np
+import torch
+
+
+def write_synthetic_lmdb(path, n_images, size, seed=0):
+    """n_images random PNGs in the layout of datasets/CelebA_HQ_dataset.py."""
+    import lmdb
+    from PIL import Image
+
+    rng = np.random.RandomState(seed)
+    env = lmdb.open(path, map_size=1 << 30)
+    with env.begin(write=True) as txn:
+        for i in range(n_images):
+            buf = io.BytesIO()
+            Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(buf, format='PNG')
+            txn.put(f"{size}-{str(i).zfill(5)}".encode('utf-8'), buf.getvalue())
+        txn.put('length'.encode('utf-8'), str(n_images).encode('utf-8'))
+    # LMDB must not be open twice in one process, so close it before a dataset opens it
+    env.close()
+
+
+def write_random_ddpm_checkpoint(config, path, seed=0):
+    from models.ddpm.diffusion import DDPM
+
+    torch.manual_seed(seed)
+    torch.save(DDPM(config).state_dict(), path)
+
+
+def tiny_clip(image_size=64):
+    """(model, preprocess) of a small random ViT CLIP; tokenization is the real one."""
+    from clip.clip import _transform
+    from clip.model import CLIP
+
+    model = CLIP(embed_dim=64, image_resolution=image_size, vision_layers=2, vision_width=64, vision_patch_size=16,
+                 context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=1, transformer_layers=1)
+    return model, _transform(image_size)
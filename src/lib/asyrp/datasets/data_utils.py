@@ -1,10 +1,4 @@
-from .AFHQ_dataset import get_afhq_dataset
-from .CelebA_HQ_dataset import get_celeba_dataset
-from .LSUN_dataset import get_lsun_dataset
 from torch.utils.data import DataLoader
-from .IMAGENET_dataset import get_imagenet_dataset
-from .CelebA_HQ_dataset_dialog import get_celeba_dialog_dataset
-from .CelebA_HQ_dataset_with_attr import get_celeba_dataset_attr
 
 from PIL import Image
 from torch.utils.data import Dataset
@@ -40,17 +34,24 @@ def get_dataset(dataset_type, dataset_paths, config, target_class_num=None, gend
         test_dataset = CustomImageDataset(dataset_paths['custom_test'], transforms.Compose([transforms.Resize((256, 256)), transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]))
         return train_dataset, test_dataset
 
+    # dataset modules pull in lmdb, pandas etc., so only the one in use is imported
     if dataset_type == 'AFHQ':
+        from .AFHQ_dataset import get_afhq_dataset
         train_dataset, test_dataset = get_afhq_dataset(dataset_paths['AFHQ'], config)
     elif dataset_type == "LSUN":
+        from .LSUN_dataset import get_lsun_dataset
         train_dataset, test_dataset = get_lsun_dataset(dataset_paths['LSUN'], config)
     elif dataset_type == "CelebA_HQ-attr":
+        from .CelebA_HQ_dataset_with_attr import get_celeba_dataset_attr
         train_dataset, test_dataset = get_celeba_dataset_attr(dataset_paths['CelebA_HQ'], config)
     elif dataset_type == "CelebA_HQ":
+        from .CelebA_HQ_dataset import get_celeba_dataset
         train_dataset, test_dataset = get_celeba_dataset(dataset_paths['CelebA_HQ'], config)
     elif dataset_type == "CelebA_HQ_Dialog":
+        from .CelebA_HQ_dataset_dialog import get_celeba_dialog_dataset
         train_dataset, test_dataset = get_celeba_dialog_dataset(dataset_paths['CelebA_HQ_Dialog'], config)
     elif dataset_type == "IMAGENET":
+        from .IMAGENET_dataset import get_imagenet_dataset
         train_dataset, test_dataset = get_imagenet_dataset(dataset_paths['IMAGENET'], config, class_num=target_class_num)
     elif dataset_type == "MetFACE":
         train_dataset = CustomImageDataset(os.path.join(dataset_paths['MetFACE'],'images'), transforms.Compose([transforms.Resize((256, 256)), transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]), test_nums=500)
@@ -64,11 +65,11 @@ def get_dataset(dataset_type, dataset_paths, config, target_class_num=None, gend
     return train_dataset, test_dataset
 
 
-def get_dataloader(train_dataset, test_dataset, bs_train=1, num_workers=0, shuffle=False):
+def get_dataloader(train_dataset, test_dataset, bs_train=1, num_workers=0, shuffle=False, bs_test=1, drop_last=True):
     train_loader = DataLoader(
         train_dataset,
         batch_size=bs_train,
-        drop_last=True,
+        drop_last=drop_last,
         shuffle=shuffle,
         sampler=None,
         num_workers=num_workers,
@@ -76,8 +77,8 @@ def get_dataloader(train_dataset, test_dataset, bs_train=1, num_workers=0, shuff
     )
     test_loader = DataLoader(
         test_dataset,
-        batch_size=1,
-        drop_last=True,
+        batch_size=bs_test,
+        drop_last=drop_last,
         sampler=None,
         shuffle=False,
         num_workers=num_workers,
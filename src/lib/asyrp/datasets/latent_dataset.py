@@ -0,0 +1,101 @@
+import queue
+import threading
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+class LatentPairsDataset(Dataset):
+    """Precomputed [x0, x_rec, x_lat] pairs (a list or a LatentPairs view) on the host.
+
+    Item k is (image index, x0, x_rec, x_lat) of image indices[k], each image [C, H, W].
+    """
+
+    def __init__(self, pairs, indices=None):
+        self.pairs = pairs
+        self.indices = list(range(len(pairs))) if indices is None else list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        idx = self.indices[k]
+        x0, x_rec, x_lat = self.pairs[idx]
+        return idx, x0[0].cpu(), x_rec[0].cpu(), x_lat[0].cpu()
+
+
+def get_latent_dataloader(pairs, batch_size, indices=None, num_workers=0, device='cpu'):
+    # the last partial batch is kept; pinned only when the batches go to a gpu
+    return DataLoader(
+        LatentPairsDataset(pairs, indices),
+        batch_size=batch_size,
+        drop_last=False,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == 'cuda',
+    )
+
+
+def _to_device(batch, device):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(b, device) for b in batch)
+    return batch
+
+
+class Prefetcher(object):
+    """Iterates `loader` on a background thread, up to `depth` batches ahead.
+
+    With `device`, the batches are also copied there on that thread (pinned
+    batches are copied asynchronously).
+    """
+
+    _END = object()
+
+    def __init__(self, loader, device=None, depth=1):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if self.device is not None:
+                        batch = _to_device(batch, self.device)
+                    if not put((batch, None)):
+                        return
+                put((self._END, None))
+            except Exception as e:
+                put((self._END, e))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if batch is self._END:
+                    if error is not None:
+                        raise error
+                    return
+                yield batch
+        finally:
+            # also reached when the consumer stops early
+            stop.set()
+            thread.join()
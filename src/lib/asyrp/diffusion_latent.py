@@ -1,35 +1,38 @@
-from audioop import reverse
-from genericpath import isfile
 import time
-from glob import glob
-from models.guided_diffusion.script_util import guided_Diffusion
-from models.improved_ddpm.nn import normalization
 from tqdm import tqdm
 import os
 import numpy as np
-import cv2
 from PIL import Image
 import torch
 from torch import nn
+from torch.utils.data import DataLoader, Subset
 import torchvision.utils as tvu
-from torchvision import models
 import torchvision.transforms as transforms
 import torch.nn.functional as F
-from losses.clip_loss import CLIPLoss
 import random
 import copy
-import wandb
-
-from models.ddpm.diffusion import DDPM
-from models.improved_ddpm.script_util import i_DDPM
-from utils.diffusion_utils import get_beta_schedule, denoising_step
+import re
+import shutil
+import socket
+import subprocess
+import sys
+
+# the model families, CLIP, the ID loss and transformers' Adafactor are heavy
+# to import; they are imported where they are used
+from models.attention import set_sdpa
+from models.delta_block_group import DeltaBlockGroup
+from utils.diffusion_utils import get_beta_schedule, denoising_step, denoising_step_twin, DiffusionSchedule
 from utils.text_dic import SRC_TRG_TXT_DIC
-from losses import id_loss
 from datasets.data_utils import get_dataset, get_dataloader
+from datasets.latent_dataset import get_latent_dataloader, Prefetcher
 from configs.paths_config import DATASET_PATHS, MODEL_PATHS
 from datasets.imagenet_dic import IMAGENET_DIC
-
-from transformers.optimization import Adafactor, AdafactorSchedule
+from utils.latent_store import LatentStore, OriginTrajectories
+from utils.image_writer import AsyncImageWriter, GridCanvas, get_sink
+from utils.metrics_logger import get_metrics_logger, DeviceStats
+from utils.profiling import region, profiled, start_profiling
+from utils.cpu_profile import SingleDevice, configure_threads, to_channels_last, cpu_autocast
+from utils.mixed_precision import DTYPES, convert_frozen_unet, LossScaler
 
 class Asyrp(object):
     def __init__(self, args, config, device=None):
@@ -37,12 +40,11 @@ class Asyrp(object):
         self.eval_clip_similarities = []
         self.eval_clip_losses = []
 
-        self.run = wandb.init(
-            # Set the project where this run will be logged
-            project="asyrp",
-            name= args.exp.split("/")[-1],
-            # Track hyperparameters and run metadata
-            config=args)
+        # wandb, local progress.json/csv files or nothing (--logger)
+        self.metrics = get_metrics_logger(args)
+        if args.profile != 'none':
+            # written when the run ends: exp/profile/stages.json (+ trace.json)
+            start_profiling(os.path.join(args.exp, 'profile'), trace=args.profile == 'trace')
 
 
         # ----------- predefined parameters -----------#
@@ -51,6 +53,14 @@ class Asyrp(object):
         if device is None:
             device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         self.device = device
+        if args.cpu_profile:
+            assert self.device.type == 'cpu', "--cpu_profile is for CPU-only runs"
+            cores = configure_threads(args.cpu_threads, args.cpu_interop_threads,
+                                      worker_id=args.precompute_worker_id or 0, n_workers=max(1, args.precompute_workers))
+            print(f"CPU profile: {len(cores)} threads pinned to cores {cores}, bf16 autocast {'on' if args.cpu_bf16 else 'off'}")
+        assert not (args.mixed_precision == 'fp16' and self.device.type == 'cpu'), "--mixed_precision fp16 needs a GPU (use bf16 on the CPU)"
+        # dtype of the frozen UNet and of autocast; set by load_pretrained_model (--mixed_precision)
+        self.mp_dtype = None
         self.accumulation_steps = args.accumulation_steps
 
         self.model_var_type = config.model.var_type
@@ -76,8 +86,23 @@ class Asyrp(object):
         elif self.model_var_type == 'fixedsmall':
             self.logvar = np.log(np.maximum(posterior_variance, 1e-20))
 
+        # device-resident alpha/beta/logvar tables shared by every denoising_step call
+        self.schedule = DiffusionSchedule(self.betas, getattr(self, 'logvar', None), device=self.device)
+
         self.learn_sigma = False # it will be changed in load_pretrained_model()
 
+        # save_image hands its PNGs (and their logging) to background threads
+        self.image_writer = AsyncImageWriter(
+            get_sink(self.args.image_sink, self.args.exp, compress_level=self.args.image_compress_level,
+                     shard_size=self.args.image_shard_size),
+            num_workers=self.args.image_writer_workers,
+            log_fn=self.metrics.log_image,
+        )
+
+        # mode -> per-image {t: (x_t, x0_t)} of the unedited DDIM path, read lazily from the latent
+        # store (OriginTrajectories); filled by precompute_pairs when --cache_origin_trajectory is set
+        self.origin_trajs = {}
+
         # ----------- Editing txt -----------#
         if self.args.edit_attr is None:
             self.src_txts = self.args.src_txts
@@ -115,7 +140,9 @@ class Asyrp(object):
         #     raise ValueError
 
         if self.config.data.dataset in ["CelebA_HQ", "LSUN", "CelebA_HQ_Dialog"]:
+            from models.ddpm.diffusion import DDPM
             model = DDPM(self.config)
+            family = 'DDPM'
 
             model.db_layer_type = self.args.db_layer_type
             model.db_emb_type = self.args.db_emb_type
@@ -131,7 +158,9 @@ class Asyrp(object):
             self.learn_sigma = False
             print("Original diffusion Model loaded.")
         elif self.config.data.dataset in ["FFHQ", "AFHQ", "IMAGENET"]:
+            from models.improved_ddpm.script_util import i_DDPM
             model = i_DDPM(self.config.data.dataset) #Get_h(self.config, model="i_DDPM", layer_num=self.args.get_h_num) #
+            family = 'i_DDPM'
             if self.args.model_path:
                 init_ckpt = torch.load(self.args.model_path)
             else:
@@ -139,14 +168,54 @@ class Asyrp(object):
             self.learn_sigma = True
             print("Improved diffusion Model loaded.")
         elif self.config.data.dataset in ["MetFACE", "CelebA_HQ_P2"]:
+            from models.guided_diffusion.script_util import guided_Diffusion
             model = guided_Diffusion(self.config.data.dataset)
+            family = 'guided'
             init_ckpt = torch.load(MODEL_PATHS[self.config.data.dataset])
             self.learn_sigma = True
         else:
             print('Not implemented dataset')
             raise ValueError
         model.load_state_dict(init_ckpt, strict=False)
+        model.stack_decoders = self.args.stack_decoders
+        set_sdpa(not self.args.legacy_attention)
+        if self.args.mixed_precision != 'none' and family in self.args.mixed_precision_models:
+            self.mp_dtype = DTYPES[self.args.mixed_precision]
+            model = convert_frozen_unet(model, self.mp_dtype)
+            print(f"Mixed precision: frozen {family} UNet in {self.args.mixed_precision}, trained parameters in fp32")
+
+        return model
 
+    def autocast(self):
+        """Context of the editing model calls: autocast to the --mixed_precision dtype,
+        bf16 on the CPU with --cpu_profile --cpu_bf16, or nothing."""
+        if self.mp_dtype is not None:
+            return torch.autocast(self.device.type, dtype=self.mp_dtype)
+        return cpu_autocast(self.args.cpu_profile and self.args.cpu_bf16)
+
+    def prepare_model(self, model, bs, index=None, grad=False):
+        """Move `model` to self.device and wrap it for the run: DataParallel, or with
+        --cpu_profile a channels_last model without the DataParallel wrapper."""
+        model = model.to(self.device)
+        if self.args.cpu_profile:
+            model = to_channels_last(model)
+        model = self.compile_model(model, bs, index=index, grad=grad)
+        if self.args.cpu_profile:
+            return SingleDevice(model)
+        return torch.nn.DataParallel(model)
+
+    def compile_model(self, model, bs, index=None, grad=False):
+        """--compile: compile the UNet parts and DeltaBlocks of `model` (already on
+        self.device) for static shapes and run the compilation once with batch size `bs`."""
+        if not self.args.compile:
+            return model
+        assert torch.cuda.device_count() <= 1, "--compile needs a single device (DataParallel replicas are rebuilt, and would recompile, every step)"
+        from utils.compile_utils import compile_model, warmup
+        compile_model(model, mode=self.args.compile_mode, cache_dir=self.args.compile_cache_dir)
+        time_s = time.time()
+        with self.autocast():
+            warmup(model, bs, self.config.data.image_size, self.device, index=index, grad=grad)
+        print(f"Compiled and warmed up the model in {time.time() - time_s:.1f}s")
         return model
 
     
@@ -158,6 +227,7 @@ class Asyrp(object):
         # But it is not used in the paper because it is not necessary.
         # We just leave the code here for future research.
         if self.args.use_id_loss:
+            from losses import id_loss
             id_loss_func = id_loss.IDLoss().to(self.device)
         
         # Set self.t_edit & self.t_addnoise & return cosine similarity of attribute
@@ -201,11 +271,10 @@ class Asyrp(object):
         if self.args.train_delta_block:
             model.setattr_layers(self.args.get_h_num)
             print("Setattr layers")
-            model = model.to(self.device)
-            model = torch.nn.DataParallel(model)
+            model = self.prepare_model(model, self.args.bs_train, index=0, grad=True)
 
             for i in range(self.args.get_h_num):
-                wandb.watch(getattr(model.module, f"layer_{i}"))
+                self.metrics.watch(getattr(model.module, f"layer_{i}"))
 
             for i in range(self.args.get_h_num):
                 get_h = getattr(model.module, f"layer_{i}")
@@ -220,14 +289,14 @@ class Asyrp(object):
                 for i in seq_train:
                     delta_h_dict[i] = torch.nn.Parameter(torch.randn((512, 8, 8))*0.2) # initialization of delta_h
 
-            model = model.to(self.device)
-            model = torch.nn.DataParallel(model)
+            model = self.prepare_model(model, self.args.bs_train, grad=True)
 
             for key in delta_h_dict.keys():
                 optim_param_list = optim_param_list + [delta_h_dict[key]]
             
         if self.args.optimizer == "adafactor":
             print("WARNING: LR PARAMETER IS IGNORED, INSTEAD AUTOMATICALLY INFERRED BY ADAFACTOR!!")
+            from transformers.optimization import Adafactor, AdafactorSchedule
             optim_ft = Adafactor(optim_param_list, scale_parameter=True, relative_step=True, warmup_init=True, lr=None)
             scheduler_ft = AdafactorSchedule(optim_ft)
         elif self.args.optimizer == "adamw":
@@ -241,6 +310,8 @@ class Asyrp(object):
             raise NotImplementedError(f"no optimizer implemented: {self.args.optimizer}")
 
         print(f"Setting optimizer with lr={self.args.lr_training}")
+        # fp16 gradients of the DeltaBlocks / delta_h pass through the half precision decoder
+        loss_scaler = LossScaler(optim_param_list, enabled=self.mp_dtype == torch.float16)
 
         # hs_coeff[0] is for original h, hs_coeff[1] is for delta_h
         # if you want to train multiple delta_h at once, you have to modify this part.
@@ -296,27 +367,16 @@ class Asyrp(object):
                             delta_h_dict[i] = torch.load(save_name)[f"{i}"]
                     continue
                 else:
-                    # Unfortunately, ima_lat_pairs_dic does not match with batch_size
-                    # I'm sorry but you have to get ima_lat_pairs_dic with batch_size == 1
-                    x_lat_tensor = None
-                    x0_tensor = None
-
-                    for step, (x0, _, x_lat) in enumerate(img_lat_pairs_dic['train']):
-                        if self.args.target_image_id:
-                            assert self.args.bs_train == 1, "target_image_id is only supported for batch_size == 1"
-                            if not step in self.args.target_image_id:
-                                continue
-                        if x_lat_tensor is None:
-                            x_lat_tensor = x_lat
-                            if self.args.use_x0_tensor:
-                                x0_tensor = x0
-                        else:
-                            x_lat_tensor = torch.cat((x_lat_tensor, x_lat), dim=0)
-                            if self.args.use_x0_tensor:
-                                x0_tensor = torch.cat((x0_tensor, x0), dim=0)
-                        if (step+1) % self.args.bs_train != 0:
-                            continue
-                        # LoL. now x_lat_tensor has batch_size == bs_train
+                    if self.args.target_image_id:
+                        assert self.args.bs_train == 1, "target_image_id is only supported for batch_size == 1"
+                    origin_trajs = self.origin_trajs.get('train')
+
+                    for step, indices, x0, x_rec, x_lat in self.latent_batches(img_lat_pairs_dic, 'train', self.args.bs_train,
+                                                                             target_ids=self.args.target_image_id):
+                        origin_traj_batch = [origin_trajs[idx] if origin_trajs is not None else None for idx in indices]
+                        x_lat_tensor = x_lat
+                        x0_tensor = x0 if self.args.use_x0_tensor else None
+                        bs = x_lat_tensor.shape[0]
 
                         # torch.cuda.empty.cache()
                         model.train()
@@ -331,94 +391,129 @@ class Asyrp(object):
 
                         time_in_start = time.time()
 
-                        # original DDIM
+                        # original DDIM (read from the precomputed trajectory when it covers seq_train)
                         x_origin = x_lat_tensor.to(self.device)
+                        use_cached_origin = self.has_origin_trajectory(origin_traj_batch, seq_train)
+                        # one stacked model call per step for both trajectories (deterministic DDIM only)
+                        use_twin_forward = (self.args.twin_forward and not use_cached_origin and self.args.sample_type == 'ddim'
+                                            and not (self.args.image_space_noise_optim or self.args.image_space_noise_optim_delta_block))
                         # editing by Asyrp
                         xt_next = x_lat_tensor.to(self.device)
+                        # x0 is the CLIP source of every timestep: encode it once per batch
+                        with torch.no_grad():
+                            x0_clip_features = clip_loss_func.get_image_features(x0.to(self.device))
                         
                         # put this here as the old trainign loop had this at the top, so 
                         # the first loop would always get a zero_grad first.
                         optim_ft.zero_grad() 
                         # Finally, go into training
-                        accumulated_loss = []
+                        # losses stay on the device; the progress bar shows their means every telemetry_interval steps
+                        telemetry = DeviceStats()
+                        accumulated_loss = 0
                         total_image_loss = 0
                         total_clip_loss = 0
                         total_l1_loss = 0
                         with tqdm(total=len(seq_train), desc=f"training iteration") as progress_bar:
                             for t_it, (i, j) in enumerate(zip(reversed(seq_train), reversed(seq_train_next))):
     
-                                t = (torch.ones(self.args.bs_train) * i).to(self.device)
-                                t_next = (torch.ones(self.args.bs_train) * j).to(self.device)
+                                t = (torch.ones(bs) * i).to(self.device)
+                                t_next = (torch.ones(bs) * j).to(self.device)
                                 
-                                # step 1: Asyrp
-                                xt_next, x0_t, _, _ = denoising_step(xt_next.detach(), t=t, t_next=t_next, models=model,
-                                                            logvars=self.logvar,                                        
-                                                            b=self.betas,
-                                                            sampling_type=self.args.sample_type,
-                                                            eta=0.0,
-                                                            learn_sigma=self.learn_sigma,
-                                                            index=0 if not (self.args.image_space_noise_optim or self.args.image_space_noise_optim_delta_block) else None,
-                                                            t_edit = self.t_edit,
-                                                            hs_coeff=hs_coeff,
-                                                            delta_h= delta_h_dict[0] if (self.args.ignore_timesteps and self.args.train_delta_h) else delta_h_dict[t[0].item()],
-                                                            ignore_timestep=self.args.ignore_timesteps,
-                                                            )
-                                                            # when train delta_block, delta_h is None (ignored)
-                                # step 2: DDIM
-                                with torch.no_grad():    
-                                    x_origin, x0_t_origin, _, _ = denoising_step(x_origin.detach(), t=t, t_next=t_next, models=model,
-                                                                    logvars=self.logvar,
+                                delta_h = delta_h_dict[0] if (self.args.ignore_timesteps and self.args.train_delta_h) else delta_h_dict[i]
+                                # forward and losses under autocast (--mixed_precision), backward outside it
+                                with self.autocast():
+                                    if use_twin_forward:
+                                        # step 1 + 2: Asyrp and DDIM in one stacked model call
+                                        xt_next, x0_t, x_origin, x0_t_origin = denoising_step_twin(xt_next.detach(), x_origin.detach(), t=t, t_next=t_next, models=model,
+                                                                                        logvars=self.logvar, schedule=self.schedule,
+                                                                                        b=self.betas,
+                                                                                        sampling_type=self.args.sample_type,
+                                                                                        eta=0.0,
+                                                                                        learn_sigma=self.learn_sigma,
+                                                                                        index=0,
+                                                                                        t_edit = self.t_edit,
+                                                                                        hs_coeff=hs_coeff,
+                                                                                        delta_h=delta_h,
+                                                                                        ignore_timestep=self.args.ignore_timesteps,
+                                                                                        )
+                                    else:
+                                        # step 1: Asyrp
+                                        xt_next, x0_t, _, _ = denoising_step(xt_next.detach(), t=t, t_next=t_next, models=model,
+                                                                    logvars=self.logvar, schedule=self.schedule,                                        
                                                                     b=self.betas,
-                                                                    sampling_type=self.args.sample_type,                                                                
+                                                                    sampling_type=self.args.sample_type,
                                                                     eta=0.0,
                                                                     learn_sigma=self.learn_sigma,
+                                                                    index=0 if not (self.args.image_space_noise_optim or self.args.image_space_noise_optim_delta_block) else None,
+                                                                    t_edit = self.t_edit,
+                                                                    hs_coeff=hs_coeff,
+                                                                    delta_h=delta_h,
+                                                                    ignore_timestep=self.args.ignore_timesteps,
                                                                     )
-
-                                progress_bar.update(1)
+                                                                    # when train delta_block, delta_h is None (ignored)
+                                        # step 2: DDIM
+                                        if use_cached_origin:
+                                            x0_t_origin = torch.cat([traj[i][1] for traj in origin_traj_batch], dim=0).to(self.device)
+                                        else:
+                                            with torch.no_grad():    
+                                                x_origin, x0_t_origin, _, _ = denoising_step(x_origin.detach(), t=t, t_next=t_next, models=model,
+                                                                                logvars=self.logvar, schedule=self.schedule,
+                                                                                b=self.betas,
+                                                                                sampling_type=self.args.sample_type,                                                                
+                                                                                eta=0.0,
+                                                                                learn_sigma=self.learn_sigma,
+                                                                                )
+
+                                    progress_bar.update(1)
                                 
-                                loss = 0
-                                loss_id = 0
-                                loss_l1 = 0
-                                loss_clr = 0
-                                loss_clip = 0
+                                    loss = 0
+                                    loss_id = 0
+                                    loss_l1 = 0
+                                    loss_clr = 0
+                                    loss_clip = 0
 
-                                # L1 loss
-                                loss_l1 += nn.L1Loss()(x0_t, x0_t_origin)
+                                    # L1 loss
+                                    loss_l1 += nn.L1Loss()(x0_t, x0_t_origin)
 
-                                # Following DiffusionCLIP, we use direction clip loss as below
-                                loss_clip = -torch.log((2 - clip_loss_func(x0, self.src_txts[0], x0_t, self.trg_txts[0])) / 2)
+                                    # Following DiffusionCLIP, we use direction clip loss as below
+                                    loss_clip = -torch.log((2 - clip_loss_func(x0, self.src_txts[0], x0_t, self.trg_txts[0], src_features=x0_clip_features)) / 2)
                                 
-                                if self.args.use_id_loss:
-                                    # We don't use this.
-                                    loss_id += torch.mean(id_loss_func(x0_t, x0_t_origin))
-
-                                loss += self.args.id_loss_w * loss_id
-                                loss += self.args.l1_loss_w * loss_l1 * cosine
-                                loss += self.args.clip_loss_w * loss_clip
-
-                                accumulated_loss.append(float(loss))
-                                total_image_loss += loss
-                                total_clip_loss += self.args.clip_loss_w * loss_clip
-                                total_l1_loss += self.args.l1_loss_w * loss_l1 * cosine
-
-                                loss.backward()
-                                progress_bar.set_description(f"{step}-{it_out}: loss_clr: {loss_clr:.3f} loss_l1: {loss_l1:.3f} loss_id: {loss_id:.3f} loss_clip:{loss_clip} loss: {loss:.3f} mean accumulated_loss: {np.mean(accumulated_loss):.3f}")
+                                    if self.args.use_id_loss:
+                                        # We don't use this.
+                                        loss_id += torch.mean(id_loss_func(x0_t, x0_t_origin))
+
+                                    loss += self.args.id_loss_w * loss_id
+                                    loss += self.args.l1_loss_w * loss_l1 * cosine
+                                    loss += self.args.clip_loss_w * loss_clip
+
+                                accumulated_loss += loss.detach()
+                                total_image_loss += loss.detach()
+                                total_clip_loss += self.args.clip_loss_w * loss_clip.detach()
+                                total_l1_loss += self.args.l1_loss_w * loss_l1.detach() * cosine
+                                telemetry.add(loss_l1=loss_l1, loss_id=loss_id, loss_clip=loss_clip, loss=loss)
+
+                                with region('backward', n=bs):
+                                    loss_scaler.backward(loss)
+                                if ((t_it + 1) % self.args.telemetry_interval == 0) or (t_it + 1 == len(seq_train)):
+                                    stats = telemetry.means()
+                                    progress_bar.set_description(f"{step}-{it_out}: loss_l1: {stats['loss_l1']:.3f} loss_id: {stats['loss_id']:.3f} loss_clip: {stats['loss_clip']:.3f} loss: {stats['loss']:.3f}")
                                 
                                 if ((t_it + 1) % self.accumulation_steps == 0) or (t_it + 1 == len(seq_train)):
-                                    optim_ft.step()
-                                    optim_ft.zero_grad()
-                                    wandb.log({
-                                        "accumulated_loss": np.sum(accumulated_loss)
+                                    with region('optimizer'):
+                                        loss_scaler.step(optim_ft)
+                                        optim_ft.zero_grad()
+                                    self.metrics.log({
+                                        "accumulated_loss": accumulated_loss
                                     })
                                     # reset accumulated loss after optimizer step
-                                    accumulated_loss = []
+                                    accumulated_loss = 0
 
-                                wandb.log({
+                                self.metrics.log({
                                     "loss_l1": self.args.l1_loss_w * loss_l1 * cosine,
                                     "loss_clip": self.args.clip_loss_w * loss_clip,
                                     "loss": loss
                                 })
-                        wandb.log({
+                        self.metrics.log({
                             "image_loss": total_image_loss,
                             "image_clip_loss": total_clip_loss,
                             "image_l1_loss": total_l1_loss
@@ -429,6 +524,7 @@ class Asyrp(object):
                             self.save_image(model, x_lat_tensor, seq_test, seq_test_next,
                                             save_x0 = self.args.save_x0, save_x_origin = self.args.save_x_origin,
                                             x0_tensor=x0_tensor, delta_h_dict=delta_h_dict,
+                                            x_rec_tensor=self.cached_x_rec(x_rec),
                                             folder_dir=self.args.training_image_folder,
                                             file_name=f'train_{step}_{it_out}', hs_coeff=hs_coeff,
                                             )
@@ -451,11 +547,7 @@ class Asyrp(object):
                                                                 
                         time_in_end = time.time()
                         print(f"Training for 1 step {time_in_end - time_in_start:.4f}s")
-                        if step == self.args.n_train_img - 1:
-                            break
                         save_image_iter += 1
-                        x_lat_tensor = None
-                        x0_tensor = None
 
 
                     # ------------------ Save ------------------#
@@ -473,7 +565,7 @@ class Asyrp(object):
                     torch.save(dicts, save_name)
                     
                     # save to weights and biases
-                    wandb.save(save_name)
+                    self.metrics.save(save_name)
                     print(f'Model {save_name} is saved.')
                     scheduler_ft.step()
 
@@ -483,56 +575,51 @@ class Asyrp(object):
 
         # ------------------ Test ------------------#
         if self.args.do_test:
-            x_lat_tensor = None
-            x0_tensor = None
             save_image_iter = 0
 
-            for step, (x0, _, x_lat) in enumerate(img_lat_pairs_dic['test']):
-                    
-                if x_lat_tensor is None:
-                    x_lat_tensor = x_lat
-                    if self.args.use_x0_tensor:
-                        x0_tensor = x0
-                else:
-                    x_lat_tensor = torch.cat((x_lat_tensor, x_lat), dim=0)
-                    if self.args.use_x0_tensor:
-                        x0_tensor = torch.cat((x0_tensor, x0), dim=0)
-                if (step+1) % self.args.bs_train != 0:
-                    continue
+            for step, indices, x0, x_rec, x_lat in self.latent_batches(img_lat_pairs_dic, 'test', self.args.bs_test):
+                x0_tensor = x0 if self.args.use_x0_tensor else None
 
-                self.save_image(model, x_lat_tensor, seq_test, seq_test_next,
+                self.save_image(model, x_lat, seq_test, seq_test_next,
                                             save_x0 = self.args.save_x0, save_x_origin = self.args.save_x_origin,
                                             x0_tensor=x0_tensor, delta_h_dict=delta_h_dict,
+                                            x_rec_tensor=self.cached_x_rec(x_rec),
                                             folder_dir=self.args.test_image_folder,
                                             file_name=f'test_{step}_{self.args.n_iter - 1}', hs_coeff=hs_coeff,
                                             )
                                         
-                if step == self.args.n_test_img - 1:
-                    break
                 save_image_iter += 1
-                x_lat_tensor = None
-                x0_tensor = None
+
+        self.image_writer.flush()
+        self.metrics.flush()
 
 
 
     @torch.no_grad()
+    @profiled('save_image')
     def save_image(self, model, x_lat_tensor, seq_inv, seq_inv_next,
                     save_x0 = False, save_x_origin = False,
                     save_process_delta_h = False, save_process_origin = False,
                     x0_tensor = None, delta_h_dict=None, get_delta_hs=False,
                     folder_dir="", file_name="", hs_coeff=(1.0,1.0),
-                    image_space_noise_dict=None):
+                    image_space_noise_dict=None, x_rec_tensor=None, fanout_names=None):
         
         if save_process_origin or save_process_delta_h:
             os.makedirs(os.path.join(folder_dir,file_name), exist_ok=True)
+        bs = x_lat_tensor.shape[0]
+        # with a DeltaBlockGroup, every edit runs the k checkpoints as one stacked batch
+        n_fanout = len(fanout_names) if fanout_names else 1
 
         process_num = int(save_x_origin) + (len(hs_coeff) if isinstance(hs_coeff, list) else 1)
         
 
-        with tqdm(total=len(seq_inv)*(process_num), desc=f"Generative process") as progress_bar:
+        # --mixed_precision / --cpu_bf16: the generative process runs under autocast
+        with tqdm(total=len(seq_inv)*(process_num), desc=f"Generative process") as progress_bar, self.autocast():
             time_s = time.time()
 
             x_list = []
+            # batched sweep: grid rows are written into `grid` as they finish (see below)
+            grid, x_tail = None, []
 
             if save_x0:
                 if x0_tensor is not None:
@@ -540,28 +627,32 @@ class Asyrp(object):
             
             if save_x_origin:
             # No delta h
-                x = x_lat_tensor.clone().to(self.device)
+                if (x_rec_tensor is not None and len(seq_inv) == self.args.n_inv_step
+                        and not save_process_origin and not self.args.origin_process_addnoise):
+                    # precompute_pairs already ran this exact deterministic path
+                    x = x_rec_tensor.to(self.device)
+                    progress_bar.update(len(seq_inv))
+                else:
+                    x = x_lat_tensor.clone().to(self.device)
 
-                for it, (i, j) in enumerate(zip(reversed((seq_inv)), reversed((seq_inv_next)))):
-                    t = (torch.ones(self.args.bs_train) * i).to(self.device)
-                    t_next = (torch.ones(self.args.bs_train) * j).to(self.device)
-
-                    x, x0_t, _, _  = denoising_step(x, t=t, t_next=t_next, models=model,
-                                    logvars=self.logvar,
-                                    sampling_type= self.args.sample_type,
-                                    b=self.betas,
-                                    learn_sigma=self.learn_sigma,
-                                    eta=1.0 if (self.args.origin_process_addnoise and t[0]<self.t_addnoise) else 0.0,
-                                    )
-                    progress_bar.update(1)
+                    for it, (i, j) in enumerate(zip(reversed((seq_inv)), reversed((seq_inv_next)))):
+                        t = (torch.ones(bs) * i).to(self.device)
+                        t_next = (torch.ones(bs) * j).to(self.device)
+
+                        x, x0_t, _, _  = denoising_step(x, t=t, t_next=t_next, models=model,
+                                        logvars=self.logvar, schedule=self.schedule,
+                                        sampling_type= self.args.sample_type,
+                                        b=self.betas,
+                                        learn_sigma=self.learn_sigma,
+                                        eta=1.0 if (self.args.origin_process_addnoise and t[0]<self.t_addnoise) else 0.0,
+                                        )
+                        progress_bar.update(1)
                     
-                    if save_process_origin:
-                        output = torch.cat([x, x0_t], dim=0)
-                        output = (output + 1) * 0.5
-                        grid = tvu.make_grid(output, nrow=self.args.bs_train, padding=1)
-                        tvu.save_image(grid, os.path.join(folder_dir, file_name, f'origin_{int(t[0].item())}.png'), normalization=True)
-                        image_path = os.path.join(folder_dir, file_name, f'origin_{int(t[0].item())}.png')
-                        wandb.log({"image_process_origin": wandb.Image(image_path)})
+                        if save_process_origin:
+                            output = torch.cat([x, x0_t], dim=0)
+                            output = (output + 1) * 0.5
+                            self.image_writer.save(output, os.path.join(folder_dir, file_name, f'origin_{int(t[0].item())}.png'),
+                                                   nrow=bs, padding=1, log_key="image_process_origin")
 
                 x_list.append(x)
 
@@ -570,17 +661,36 @@ class Asyrp(object):
             else:
                 if not isinstance(hs_coeff, list):
                     hs_coeff = [hs_coeff]
+
+                # a delta_interpolation sweep runs sweep_batch coefficient tuples as one
+                # batched trajectory, with a per-sample hs_coeff (DeltaBlock edits only)
+                batch_sweep = (len(hs_coeff) > 1 and self.args.sweep_batch > 1 and not get_delta_hs and not self.args.train_delta_h
+                               and not (self.args.image_space_noise_optim or self.args.image_space_noise_optim_delta_block))
+                chunk = self.args.sweep_batch if batch_sweep else 1
+                if batch_sweep:
+                    # every result is put into the uint8 grid as soon as its chunk finishes; only
+                    # the rows read after the loop are kept: the first three (CLIP loss, original/
+                    # reconstructed/edited) in x_list and the last n_fanout (fan-out edits) in x_tail
+                    n_head = len(x_list)
+                    n_rows = n_head + len(hs_coeff) * n_fanout
+                    grid = GridCanvas(n_rows, bs, x_lat_tensor.shape[2], x_lat_tensor.shape[3],
+                                      channels=x_lat_tensor.shape[1], padding=1)
+                    for r, x_ in enumerate(x_list):
+                        grid.put(r, ((x_ + 1) * 0.5).cpu())
                 
-                for hs_coeff_tuple in hs_coeff:
+                for k in range(0, len(hs_coeff), chunk):
+                    coeff_chunk = hs_coeff[k:k + chunk]
+                    n_rep = n_fanout * len(coeff_chunk)
+                    hs_coeff_tuple = coeff_chunk[0] if len(coeff_chunk) == 1 else self.stack_hs_coeff(coeff_chunk, bs, n_fanout)
 
-                    x = x_lat_tensor.clone().to(self.device)
+                    x = x_lat_tensor.clone().to(self.device).repeat(n_rep, 1, 1, 1)
 
                     for it, (i, j) in enumerate(zip(reversed((seq_inv)), reversed((seq_inv_next)))):
-                        t = (torch.ones(self.args.bs_train) * i).to(self.device)
-                        t_next = (torch.ones(self.args.bs_train) * j).to(self.device)
+                        t = (torch.ones(bs * n_rep) * i).to(self.device)
+                        t_next = (torch.ones(bs * n_rep) * j).to(self.device)
 
                         x, x0_t, delta_h, _ = denoising_step(x, t=t, t_next=t_next, models=model,
-                                        logvars=self.logvar,                                
+                                        logvars=self.logvar, schedule=self.schedule,                                
                                         sampling_type=self.args.sample_type,
                                         b=self.betas,
                                         learn_sigma=self.learn_sigma,
@@ -593,38 +703,50 @@ class Asyrp(object):
                                         dt_lambda=self.args.dt_lambda,
                                         warigari=self.args.warigari,
                                         )
-                        progress_bar.update(1)
+                        progress_bar.update(len(coeff_chunk))
 
                         if save_process_delta_h:
                             output = torch.cat([x, x0_t], dim=0)
                             output = (output + 1) * 0.5
-                            grid = tvu.make_grid(output, nrow=self.args.bs_train, padding=1)
-                            tvu.save_image(grid, os.path.join(folder_dir, file_name, f'delta_h_{int(t[0].item())}.png'), normalization=True)
-
-                            image_path = os.path.join(folder_dir, file_name, f'delta_h_{int(t[0].item())}.png')
-                            wandb.log({"image_process_delta_h": wandb.Image(image_path)})
+                            self.image_writer.save(output, os.path.join(folder_dir, file_name, f'delta_h_{int(t[0].item())}.png'),
+                                                   nrow=bs, padding=1, log_key="image_process_delta_h")
 
-                        if get_delta_hs and t[0]>= self.t_edit:
+                        # delta_h is None when hs_coeff made the step a no-op edit
+                        if get_delta_hs and t[0]>= self.t_edit and delta_h is not None:
                             if delta_h_dict[t[0].item()] is None:
                                 delta_h_dict[t[0].item()] = delta_h
                             else:
                                 delta_h_dict[int(t[0].item())] = delta_h_dict[int(t[0].item())] + delta_h
 
-                    x_list.append(x)
-
+                    # rows are (checkpoint, coefficient, image); the grid keeps the coefficient-major order
+                    x = x.unflatten(0, (n_fanout, len(coeff_chunk), bs))
+                    for c in range(len(coeff_chunk)):
+                        for g in range(n_fanout):
+                            if grid is None:
+                                x_list.append(x[g, c])
+                                continue
+                            row = n_head + (k + c) * n_fanout + g
+                            grid.put(row, ((x[g, c] + 1) * 0.5).cpu())
+                            if row < 3:
+                                x_list.append(x[g, c].cpu())
+                            if row >= n_rows - n_fanout:
+                                x_tail.append(x[g, c].cpu())
+
+        if grid is None:
+            n_rows = len(x_list)
         try:
-            print(len(x_list))
-            if len(x_list) == 2:
-                clip_loss = self.clip_loss_func.direction_loss(x_list[1], x_list[0])
-            elif len(x_list) == 3:
-                clip_loss = self.clip_loss_func.direction_loss(x_list[2], x_list[0])
+            print(n_rows)
+            if n_rows == 2:
+                clip_loss = self.clip_loss_func.direction_loss(x_list[1].to(self.device), x_list[0].to(self.device))
+            elif n_rows == 3:
+                clip_loss = self.clip_loss_func.direction_loss(x_list[2].to(self.device), x_list[0].to(self.device))
             else:
                 # in case formatting is doing something weird
                 
                 clip_loss = -1
             clip_loss = clip_loss.mean().cpu().detach().numpy()
 
-            wandb.log({
+            self.metrics.log({
                 "clip_loss": clip_loss,
                 "clip_similarity": 1 - clip_loss
             })
@@ -639,52 +761,62 @@ class Asyrp(object):
         except AttributeError:
             pass
 
-        x = torch.cat(x_list, dim=0)
+        x = torch.cat([x_.cpu() for x_ in x_list], dim=0)
         x = (x + 1) * 0.5
 
-        grid = tvu.make_grid(x, nrow=self.args.bs_train, padding=1)
+        # encoding, writing and logging happen on the image writer's threads
+        name = f'{file_name}_ngen{self.args.n_train_step}'
+        self.image_writer.save(x if grid is None else grid.array, os.path.join(folder_dir, f'{name}.png'),
+                               nrow=bs, padding=1, log_key="train_image")
 
-        image_save_path = os.path.join(folder_dir, f'{file_name}_ngen{self.args.n_train_step}.png')
-        tvu.save_image(grid, os.path.join(folder_dir, f'{file_name}_ngen{self.args.n_train_step}.png'), normalization=True)
-        wandb.log({"train_image": wandb.Image(image_save_path)})
-
-        if len(x) == 2:
-            os.makedirs(os.path.join(folder_dir, 'original'), exist_ok=True)
-            os.makedirs(os.path.join(folder_dir, 'edited'), exist_ok=True)
+        if n_rows * bs == 2:
             # original
-            tvu.save_image(x[0], os.path.join(folder_dir, 'original', f'{file_name}_ngen{self.args.n_train_step}_original.png'), normalization=True)
-            image_save_path = os.path.join(folder_dir, 'original', f'{file_name}_ngen{self.args.n_train_step}_original.png')
-            wandb.log({"train_image_original": wandb.Image(image_save_path)})
-            
+            self.image_writer.save(x[0], os.path.join(folder_dir, 'original', f'{name}_original.png'), log_key="train_image_original")
             # edited
-            idx_edited_0 = 0 + self.args.bs_train
-            tvu.save_image(x[idx_edited_0], os.path.join(folder_dir, 'edited', f'{file_name}_ngen{self.args.n_train_step}_edited.png'), normalization=True)
-            image_save_path = os.path.join(folder_dir, 'edited', f'{file_name}_ngen{self.args.n_train_step}_edited.png')
-            wandb.log({"train_image_edited": wandb.Image(image_save_path)})
+            idx_edited_0 = 0 + bs
+            self.image_writer.save(x[idx_edited_0], os.path.join(folder_dir, 'edited', f'{name}_edited.png'), log_key="train_image_edited")
 
         else:
-            os.makedirs(os.path.join(folder_dir, 'original'), exist_ok=True)
-            os.makedirs(os.path.join(folder_dir, 'reconstructed'), exist_ok=True)
-            os.makedirs(os.path.join(folder_dir, 'edited'), exist_ok=True)
             # original
-            tvu.save_image(x[0], os.path.join(folder_dir, 'original', f'{file_name}_ngen{self.args.n_train_step}_original.png'), normalization=True)
-            image_save_path = os.path.join(folder_dir, 'original', f'{file_name}_ngen{self.args.n_train_step}_original.png')
-            wandb.log({"train_image_original": wandb.Image(image_save_path)})
-
+            self.image_writer.save(x[0], os.path.join(folder_dir, 'original', f'{name}_original.png'), log_key="train_image_original")
             # reconstructed 
-            idx_recon_0 = 0 + self.args.bs_train
-            tvu.save_image(x[idx_recon_0], os.path.join(folder_dir, 'reconstructed', f'{file_name}_ngen{self.args.n_train_step}_reconstructed.png'), normalization=True)
-            image_save_path = os.path.join(folder_dir, 'reconstructed', f'{file_name}_ngen{self.args.n_train_step}_reconstructed.png')
-            wandb.log({"train_image_reconstructed": wandb.Image(image_save_path)})
-            
+            idx_recon_0 = 0 + bs
+            self.image_writer.save(x[idx_recon_0], os.path.join(folder_dir, 'reconstructed', f'{name}_reconstructed.png'), log_key="train_image_reconstructed")
             # edited
-            idx_edited_0 = 0 + (self.args.bs_train * 2)
-            tvu.save_image(x[idx_edited_0], os.path.join(folder_dir, 'edited', f'{file_name}_ngen{self.args.n_train_step}_edited.png'), normalization=True)
-            image_save_path = os.path.join(folder_dir, 'edited', f'{file_name}_ngen{self.args.n_train_step}_edited.png')
-            wandb.log({"train_image_edited": wandb.Image(image_save_path)})
+            idx_edited_0 = 0 + (bs * 2)
+            self.image_writer.save(x[idx_edited_0], os.path.join(folder_dir, 'edited', f'{name}_edited.png'), log_key="train_image_edited")
+
+        if fanout_names:
+            # one edited image per checkpoint; they are the last k * bs rows of x
+            edited = x[-n_fanout * bs:] if grid is None else (torch.cat(x_tail, dim=0) + 1) * 0.5
+            for fanout_name, x_edited in zip(fanout_names, edited.chunk(n_fanout, dim=0)):
+                self.image_writer.save(x_edited[0], os.path.join(folder_dir, 'edited', fanout_name, f'{name}_edited.png'))
 
         time_e = time.time()
-        print(f'{time_e - time_s} seconds, {file_name}_ngen{self.args.n_train_step}.png is saved')
+        print(f'{time_e - time_s} seconds, {file_name}_ngen{self.args.n_train_step}.png is queued')
+
+    def stack_hs_coeff(self, coeff_tuples, bs, n_fanout=1):
+        """Per-sample hs_coeff for a batch of (checkpoint, coefficient tuple, image) rows.
+
+        Entry p is a [n_fanout * len(coeff_tuples) * bs, 1, 1, 1] tensor, which the
+        UNets broadcast against h and delta_h.
+        """
+        coeffs = torch.tensor(coeff_tuples, dtype=torch.float, device=self.device)  # [n_coeff, len(tuple)]
+        coeffs = coeffs.repeat_interleave(bs, dim=0).repeat(n_fanout, 1)
+        return tuple(c.view(-1, 1, 1, 1) for c in coeffs.unbind(dim=1))
+
+    def load_delta_block_group(self, layer, checkpoints):
+        """A DeltaBlockGroup of copies of `layer`, one per DeltaBlock checkpoint."""
+        blocks = []
+        for name in checkpoints:
+            if not os.path.exists(name):
+                print(f"checkpoint({name}) does not exist!")
+                exit()
+            print(f"loading: {name}")
+            block = copy.deepcopy(layer)
+            block.load_state_dict(torch.load(name, map_location=self.device)[f"{0}"])
+            blocks.append(block)
+        return DeltaBlockGroup(blocks).to(self.device)
 
     # test
     @torch.no_grad()
@@ -739,8 +871,7 @@ class Asyrp(object):
             model.setattr_layers(self.args.get_h_num)
             print("Setattr layers")
 
-        model = model.to(self.device)
-        model = torch.nn.DataParallel(model)
+        model = self.prepare_model(model, self.args.bs_test, index=0 if self.args.train_delta_block else None)
 
 
         exp_id = os.path.split(self.args.exp)[-1]
@@ -809,10 +940,21 @@ class Asyrp(object):
         else:
             save_name_list = [save_name]
             hs_coeff = (1.0 * self.args.hs_coeff_origin_h, 1.0 * scaling_factor)
+
+        fanout_names = None
+        if self.args.fanout_checkpoints:
+            assert self.args.train_delta_block and self.args.get_h_num == 1, "fanout_checkpoints needs train_delta_block and get_h_num == 1"
+            assert not (self.args.multiple_attr or self.args.num_mean_of_delta_hs), "fanout_checkpoints can not be combined with multiple_attr or num_mean_of_delta_hs"
+            save_name_list = self.args.fanout_checkpoints.split(' ')
+            fanout_names = [os.path.splitext(os.path.basename(name))[0] for name in save_name_list]
+            model.module.layer_0 = self.load_delta_block_group(model.module.layer_0, save_name_list)
+            print(f"Fan-out over {len(save_name_list)} checkpoints: {fanout_names}")
             
     
         # Most come here
-        if os.path.exists(save_name_list[0]):
+        if fanout_names:
+            pass
+        elif os.path.exists(save_name_list[0]):
             # load checkpoint
             print(f'{save_name} exists. load checkpoint')
             if self.args.train_delta_block:
@@ -908,7 +1050,7 @@ class Asyrp(object):
                 hs_coeff = hs_coeff_list
         
         if self.args.num_mean_of_delta_hs:
-            assert self.args.bs_train == 1, "if you want to use mean, batch_size must be 1"
+            assert self.args.bs_train == 1 and self.args.bs_test == 1, "if you want to use mean, batch_size must be 1"
 
         # ----------- Pre-compute -----------#
         print("Prepare identity latent...")
@@ -922,44 +1064,27 @@ class Asyrp(object):
             self.args.target_image_id = self.args.target_image_id.split(" ")
             self.args.target_image_id = [int(i) for i in self.args.target_image_id]
 
-        # Unfortunately, ima_lat_pairs_dic does not match with batch_size
-        x_lat_tensor = None
-        x0_tensor = None
+        if self.args.target_image_id:
+            assert self.args.bs_train == 1 and self.args.bs_test == 1, "target_image_id is only supported for batch_size == 1"
         model.eval()
 
         # Train set
         if self.args.do_train:
-            for step, (x0, _, x_lat) in enumerate(img_lat_pairs_dic['train']):
+            for step, indices, x0, x_rec, x_lat in self.latent_batches(img_lat_pairs_dic, 'train', self.args.bs_train,
+                                                                     target_ids=self.args.target_image_id,
+                                                                     start_id=self.args.start_image_id):
+                x0_tensor = x0 if self.args.use_x0_tensor else None
 
-                if self.args.target_image_id:
-                    assert self.args.bs_train == 1, "target_image_id is only supported for batch_size == 1"
-                    if not step in self.args.target_image_id:
-                        continue
-                if self.args.start_image_id > step:
-                    continue
-
-
-                if x_lat_tensor is None:
-                    x_lat_tensor = x_lat
-                    if self.args.use_x0_tensor:
-                                x0_tensor = x0
-                else:
-                    x_lat_tensor = torch.cat((x_lat_tensor, x_lat), dim=0)
-                    if self.args.use_x0_tensor:
-                                x0_tensor = torch.cat((x0_tensor, x0), dim=0)
-                if (step+1) % self.args.bs_train != 0:
-                    continue
-
-                self.save_image(model, x_lat_tensor, seq_test, seq_test_next,
+                self.save_image(model, x_lat, seq_test, seq_test_next,
                                             save_x0 = self.args.save_x0, save_x_origin = self.args.save_x_origin,
                                             x0_tensor=x0_tensor, delta_h_dict=delta_h_dict,
+                                            x_rec_tensor=self.cached_x_rec(x_rec),
                                             folder_dir=self.args.test_image_folder, get_delta_hs=self.args.num_mean_of_delta_hs,
                                             save_process_origin=self.args.save_process_origin, save_process_delta_h=self.args.save_process_delta_h,
                                             file_name=f'train_{step}_{self.args.n_iter - 1}', hs_coeff=hs_coeff,
+                                            fanout_names=fanout_names,
                                             )
                                         
-                if step == self.args.n_train_img - 1:
-                    break
                 # if mean_of_delta_hs is not exist,
                 if step == self.args.num_mean_of_delta_hs -1:
                     for keys in delta_h_dict.keys():
@@ -986,45 +1111,26 @@ class Asyrp(object):
 
                     self.args.num_mean_of_delta_hs = 0
                     print("now we use mean of delta_hs")
- 
-                x_lat_tensor = None
         
         # Test set
         if self.args.do_test:
-            x_lat_tensor = None
-
-            for step, (x0, _, x_lat) in enumerate(img_lat_pairs_dic['test']):
+            for step, indices, x0, x_rec, x_lat in self.latent_batches(img_lat_pairs_dic, 'test', self.args.bs_test,
+                                                                     target_ids=self.args.target_image_id,
+                                                                     start_id=self.args.start_image_id):
+                x0_tensor = x0 if self.args.use_x0_tensor else None
 
-                if self.args.target_image_id:
-                    assert self.args.bs_train == 1, "target_image_id is only supported for batch_size == 1"
-                    if not step in self.args.target_image_id:
-                        continue
-
-                if self.args.start_image_id > step:
-                    continue
-
-                if x_lat_tensor is None:
-                    x_lat_tensor = x_lat
-                    if self.args.use_x0_tensor:
-                                x0_tensor = x0
-                else:
-                    x_lat_tensor = torch.cat((x_lat_tensor, x_lat), dim=0)
-                    if self.args.use_x0_tensor:
-                                x0_tensor = torch.cat((x0_tensor, x0), dim=0)
-                if (step+1) % self.args.bs_train != 0:
-                    continue
-
-                self.save_image(model, x_lat_tensor, seq_test, seq_test_next,
+                self.save_image(model, x_lat, seq_test, seq_test_next,
                                             save_x0 = self.args.save_x0, save_x_origin = self.args.save_x_origin,
                                             x0_tensor=x0_tensor, delta_h_dict=delta_h_dict,
+                                            x_rec_tensor=self.cached_x_rec(x_rec),
                                             folder_dir=self.args.test_image_folder, get_delta_hs=self.args.num_mean_of_delta_hs,
                                             save_process_origin=self.args.save_process_origin, save_process_delta_h=self.args.save_process_delta_h,
                                             file_name=f'test_{step}_{self.args.n_iter - 1}', hs_coeff=hs_coeff,
+                                            fanout_names=fanout_names,
                                             )
-                                        
-                if step == self.args.n_test_img - 1:
-                    break
-                x_lat_tensor = None
+
+        self.image_writer.flush()
+        self.metrics.flush()
 
 
     @torch.no_grad()
@@ -1077,7 +1183,7 @@ class Asyrp(object):
                         t_prev = (torch.ones(n) * j).to(self.device)
 
                         x, _, _, h = denoising_step(x, t=t, t_next=t_prev, models=model,
-                                            logvars=self.logvar,
+                                            logvars=self.logvar, schedule=self.schedule,
                                             sampling_type='ddim',
                                             b=self.betas,
                                             eta=0,
@@ -1109,8 +1215,8 @@ class Asyrp(object):
         seq_inv = [int(s+1e-6) for s in list(seq_inv)]
         seq_inv_next = [-1] + list(seq_inv[:-1])
 
-        n = 1
         img_lat_pairs_dic = {}
+        procs = None  # --precompute_workers subprocesses, started once there is work
 
         for mode in ['train', 'test']:
             img_lat_pairs = []
@@ -1130,7 +1236,20 @@ class Asyrp(object):
                     pairs_path = os.path.join('precomputed/',
                                               f'{self.config.data.category}_{mode}_t{self.args.t_0}_nim{self.args.n_test_img}_ninv{self.args.n_inv_step}_pairs.pth')
             print(pairs_path)
-            if os.path.exists(pairs_path) and not self.args.re_precompute:
+            n_img = self.args.n_train_img if mode == 'train' else self.args.n_test_img
+            store = self.open_latent_store(mode, pairs_path) if self.args.latent_store else None
+            if store is not None and all(idx in store for idx in range(n_img)):
+                print(f'{mode} latents exist in {store.root}')
+                img_lat_pairs_dic[mode] = store.pairs(range(n_img))
+                if self.args.cache_origin_trajectory:
+                    self.origin_trajs[mode] = self.store_origin_trajs(store, range(n_img), seq_inv)
+                if save_imgs:
+                    for step, (x0, x_id, x_lat) in enumerate(img_lat_pairs_dic[mode]):
+                        tvu.save_image((x0 + 1) * 0.5, os.path.join(self.args.image_folder, f'{mode}_{step}_0_orig.png'))
+                        tvu.save_image((x_id + 1) * 0.5, os.path.join(self.args.image_folder,
+                                                                    f'{mode}_{step}_1_rec_ninv{self.args.n_inv_step}.png'))
+                continue
+            if store is None and os.path.exists(pairs_path) and not self.args.re_precompute:
                 print(f'{mode} pairs exists')
                 img_lat_pairs_dic[mode] = torch.load(pairs_path, map_location=torch.device('cpu'))
                 if save_imgs:
@@ -1143,15 +1262,22 @@ class Asyrp(object):
                 continue
             else:
 
-                exist_num = 0
-                for exist_precompute_num in reversed(range(self.args.n_train_img if mode == 'train' else self.args.n_test_img)):
-                    tmp_path = os.path.join('precomputed/',
-                                          f'{self.config.data.category}_{mode}_t{self.args.t_0}_nim{exist_precompute_num}_ninv{self.args.n_inv_step}_pairs.pth')
-                    if os.path.exists(tmp_path):
-                        print(f'latest {mode} pairs are exist. Continue precomputing...')
-                        img_lat_pairs = img_lat_pairs + torch.load(tmp_path, map_location=torch.device('cpu'))
-                        exist_num = exist_precompute_num
-                        break
+                # images that are already precomputed (skipped below)
+                done = set()
+                if store is not None:
+                    done = set(store.indices())
+                    if done:
+                        print(f'{len(done)} {mode} latents exist in {store.root}. Continue precomputing...')
+                    store_traj = self.args.cache_origin_trajectory and (store.fields is None or 'origin_x0t' in store.fields)
+                else:
+                    for exist_precompute_num in reversed(range(self.args.n_train_img if mode == 'train' else self.args.n_test_img)):
+                        tmp_path = os.path.join('precomputed/',
+                                              f'{self.config.data.category}_{mode}_t{self.args.t_0}_nim{exist_precompute_num}_ninv{self.args.n_inv_step}_pairs.pth')
+                        if os.path.exists(tmp_path):
+                            print(f'latest {mode} pairs are exist. Continue precomputing...')
+                            img_lat_pairs = img_lat_pairs + torch.load(tmp_path, map_location=torch.device('cpu'))
+                            done = set(range(exist_precompute_num))
+                            break
 
                 if self.config.data.category == 'CUSTOM':
                     DATASET_PATHS["custom_train"] = self.args.custom_train_dataset_dir
@@ -1160,82 +1286,322 @@ class Asyrp(object):
                 train_dataset, test_dataset = get_dataset(self.config.data.dataset, DATASET_PATHS, self.config,
                                                               target_class_num=self.args.target_class_num)
 
-                loader_dic = get_dataloader(train_dataset, test_dataset, bs_train=1,#self.args.bs_train,
+                # batches are split back into per-image pairs below, so keep the last partial batch
+                loader_dic = get_dataloader(train_dataset, test_dataset, bs_train=self.args.bs_precompute,
+                                            bs_test=self.args.bs_precompute, drop_last=False,
                                             num_workers=self.config.data.num_workers, shuffle=self.args.shuffle_train_dataloader)
                 loader = loader_dic[mode]
 
+                save_process_folder = None
                 if self.args.save_process_origin:
                     save_process_folder = os.path.join(self.args.image_folder, f'inversion_process')
                     if not os.path.exists(save_process_folder):
                         os.makedirs(save_process_folder)
 
-            for step, img in enumerate(loader):
-                if (mode == "train" and step == self.args.n_train_img) or (mode == "test" and step == self.args.n_test_img):
+            if self.args.precompute_workers:
+                assert store is not None, "--precompute_workers needs --latent_store"
+                assert not self.args.shuffle_train_dataloader, "--precompute_workers needs an unshuffled dataset"
+                dataset = train_dataset if mode == 'train' else test_dataset
+                n_img = min(n_img, len(dataset))
+                if procs is None:
+                    procs = self.launch_precompute_workers()
+                self.precompute_claimed(model, store, dataset, n_img, mode, seq_inv, seq_inv_next,
+                                        store_traj, save_imgs=save_imgs, save_process_folder=save_process_folder)
+                if self.args.precompute_worker_id is not None:
+                    # a worker only contributes shards; worker 0 loads the result
+                    continue
+                self.wait_for_store(store, n_img, procs, model, dataset, mode, seq_inv, seq_inv_next, store_traj)
+                loader = []
+
+            for batch_idx, img in enumerate(loader):
+                # images [first, first + len(img)) of the loader; keep the ones below n_img not done yet
+                first = batch_idx * self.args.bs_precompute
+                if first >= n_img:
                     break
-                if exist_num != 0:
-                    exist_num = exist_num - 1
+                steps = [s_k for s_k in range(first, first + len(img)) if s_k < n_img and s_k not in done]
+                if not steps:
                     continue
-                x0 = img.to(self.config.device)
-                if save_imgs:
-                    tvu.save_image((x0 + 1) * 0.5, os.path.join(self.args.image_folder, f'{mode}_{step}_0_orig.png'))
+                if len(steps) < len(img):
+                    img = img[[s_k - first for s_k in steps]]
+                n = len(steps)
 
-                x = x0.clone()
-                model.eval()
-                time_s = time.time()
-                with torch.no_grad():
-                    with tqdm(total=len(seq_inv), desc=f"Inversion process {mode} {step}") as progress_bar:
-                        for it, (i, j) in enumerate(zip((seq_inv_next[1:]), (seq_inv[1:]))):
-                            t = (torch.ones(n) * i).to(self.device)
-                            t_prev = (torch.ones(n) * j).to(self.device)
-
-                            x, _, _, _ = denoising_step(x, t=t, t_next=t_prev, models=model,
-                                               logvars=self.logvar,
-                                               sampling_type='ddim',
-                                               b=self.betas,
-                                               eta=0,
-                                               learn_sigma=self.learn_sigma,
-                                               )
-                            progress_bar.update(1)
-                    
-                    time_e = time.time()
-                    print(f'{time_e - time_s} seconds')
-                    x_lat = x.clone()
-                    if save_imgs:
-                        tvu.save_image((x_lat + 1) * 0.5, os.path.join(self.args.image_folder,
-                                                                    f'{mode}_{step}_1_lat_ninv{self.args.n_inv_step}.png'))
-
-                    with tqdm(total=len(seq_inv), desc=f"Generative process {mode} {step}") as progress_bar:
-                        time_s = time.time()
-                        for it, (i, j) in enumerate(zip(reversed((seq_inv)), reversed((seq_inv_next)))):
-                            t = (torch.ones(n) * i).to(self.device)
-                            t_next = (torch.ones(n) * j).to(self.device)
-
-                            x, x0t, _, _ = denoising_step(x, t=t, t_next=t_next, models=model,
-                                               logvars=self.logvar,
-                                               sampling_type=self.args.sample_type,
-                                               b=self.betas,
-                                               learn_sigma=self.learn_sigma)
-                            progress_bar.update(1)
-                            if self.args.save_process_origin:
-                                tvu.save_image((x + 1) * 0.5, os.path.join(save_process_folder, f'xt_{step}_{it}_{t[0]}.png'))
-                                tvu.save_image((x0t + 1) * 0.5, os.path.join(save_process_folder, f'x0t_{step}_{it}_{t[0]}.png'))
-                        time_e = time.time()
-                        print(f'{time_e - time_s} seconds')
-
-                    img_lat_pairs.append([x0, x.detach().clone(), x_lat.detach().clone()])
-                
-                if save_imgs:
-                    tvu.save_image((x + 1) * 0.5, os.path.join(self.args.image_folder,
-                                                            f'{mode}_{step}_1_rec_ninv{self.args.n_inv_step}.png'))
-                
+                x0, x, x_lat, origin_traj = self.invert_batch(model, img, steps, mode, seq_inv, seq_inv_next,
+                                                              save_imgs=save_imgs, save_process_folder=save_process_folder)
+
+                if store is not None:
+                    self.append_to_store(store, steps, x0, x, x_lat, origin_traj, store_traj)
+                    continue
+                # split the batch back into per-image entries, kept on the host; copy so
+                # that torch.save does not serialize the whole batch storage per entry
+                for k in range(n):
+                    img_lat_pairs.append([x0[k:k+1].to('cpu', copy=True), x[k:k+1].to('cpu', copy=True), x_lat[k:k+1].to('cpu', copy=True)])
+
+
+            if store is not None:
+                store.flush()
+                indices = [idx for idx in store.indices() if idx < n_img]
+                img_lat_pairs_dic[mode] = store.pairs(indices)
+                if self.args.cache_origin_trajectory:
+                    self.origin_trajs[mode] = self.store_origin_trajs(store, indices, seq_inv)
+                continue
 
             img_lat_pairs_dic[mode] = img_lat_pairs
             # pairs_path = os.path.join('precomputed/',
             #                           f'{self.config.data.category}_{mode}_t{self.args.t_0}_nim{self.args.n_precomp_img}_ninv{self.args.n_inv_step}_pairs.pth')
             torch.save(img_lat_pairs, pairs_path)
 
+        for proc in procs or []:
+            proc.wait()
         return img_lat_pairs_dic
 
+    def run_precompute(self):
+        # entry point of a --precompute_workers subprocess (see launch_precompute_workers)
+        model = self.load_pretrained_model()
+        model = self.prepare_model(model, self.args.bs_precompute)
+        self.precompute_pairs(model, save_imgs=False)
+
+    def launch_precompute_workers(self):
+        """Start workers 1..N-1 as `main.py <same args> --precompute_worker_id k`; this process is worker 0."""
+        n_workers = self.args.precompute_workers
+        if n_workers <= 1 or self.args.precompute_worker_id is not None:
+            return []
+        devices = None
+        if torch.cuda.is_available():
+            visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+            devices = visible.split(',') if visible else [str(d) for d in range(torch.cuda.device_count())]
+        elif not self.args.cpu_profile:
+            # with --cpu_profile every worker pins itself to its own share of the cores
+            torch.set_num_threads(max(1, os.cpu_count() // n_workers))
+
+        procs = []
+        for k in range(1, n_workers):
+            env = dict(os.environ, WANDB_MODE='disabled')
+            if devices:
+                env['CUDA_VISIBLE_DEVICES'] = devices[k % len(devices)]
+            else:
+                env.setdefault('OMP_NUM_THREADS', str(max(1, os.cpu_count() // n_workers)))
+            # the later flags win; workers must not write over worker 0's exp/profile
+            cmd = [sys.executable] + sys.argv + ['--ni', '--logger', 'none', '--profile', 'none', '--precompute_worker_id', str(k)]
+            procs.append(subprocess.Popen(cmd, env=env))
+        print(f'Started {len(procs)} precompute workers')
+        return procs
+
+    def precompute_claimed(self, model, store, dataset, n_img, mode, seq_inv, seq_inv_next, store_traj,
+                           save_imgs=False, save_process_folder=None):
+        """Invert images [0, n_img) of `dataset` into `store`, one claimed range at a time.
+
+        Ranges are claimed through lock files in the store, so any number of
+        processes (--precompute_workers, jobs on other nodes) can share the work.
+        """
+        claim_size = self.args.precompute_claim_size
+        for start in range(0, n_img, claim_size):
+            stop = min(start + claim_size, n_img)
+            store.refresh()
+            if all(idx in store for idx in range(start, stop)):
+                continue
+            if not store.claim(start, stop, stale_after=self.args.precompute_claim_timeout):
+                continue
+            store.refresh()
+            todo = [idx for idx in range(start, stop) if idx not in store]
+            loader = DataLoader(Subset(dataset, todo), batch_size=self.args.bs_precompute,
+                                num_workers=self.config.data.num_workers, pin_memory=self.device.type == 'cuda')
+            first = 0
+            for img in loader:
+                steps = todo[first:first + len(img)]
+                first += len(img)
+                x0, x, x_lat, origin_traj = self.invert_batch(model, img, steps, mode, seq_inv, seq_inv_next,
+                                                              save_imgs=save_imgs, save_process_folder=save_process_folder)
+                self.append_to_store(store, steps, x0, x, x_lat, origin_traj, store_traj)
+                store.touch_claim(start, stop)
+
+    def wait_for_store(self, store, n_img, procs, model, dataset, mode, seq_inv, seq_inv_next, store_traj):
+        # wait for the other workers, taking over the ranges of workers that died
+        while True:
+            store.refresh()
+            if all(idx in store for idx in range(n_img)):
+                return
+            for proc in procs:
+                if proc.poll() not in (None, 0):
+                    raise RuntimeError(f'precompute worker {proc.args[-1]} exited with code {proc.returncode}')
+            self.precompute_claimed(model, store, dataset, n_img, mode, seq_inv, seq_inv_next, store_traj)
+            time.sleep(10)
+
+    @torch.no_grad()
+    def invert_batch(self, model, img, steps, mode, seq_inv, seq_inv_next, save_imgs=False, save_process_folder=None):
+        """DDIM inversion and reconstruction of a batch of images (image indices `steps`).
+
+        Returns x0, x_rec, x_lat and the unedited trajectory {t: (x_t, x0_t)}, which
+        is only filled with --cache_origin_trajectory.
+        """
+        step = steps[0]
+        n = len(steps)
+
+        x0 = img.to(self.config.device)
+        if save_imgs:
+            for k, s_k in enumerate(steps):
+                tvu.save_image((x0[k] + 1) * 0.5, os.path.join(self.args.image_folder, f'{mode}_{s_k}_0_orig.png'))
+
+        x = x0.clone()
+        model.eval()
+        time_s = time.time()
+        with torch.no_grad():
+            with tqdm(total=len(seq_inv), desc=f"Inversion process {mode} {step}") as progress_bar:
+                for it, (i, j) in enumerate(zip((seq_inv_next[1:]), (seq_inv[1:]))):
+                    t = (torch.ones(n) * i).to(self.device)
+                    t_prev = (torch.ones(n) * j).to(self.device)
+
+                    x, _, _, _ = denoising_step(x, t=t, t_next=t_prev, models=model,
+                                       logvars=self.logvar, schedule=self.schedule,
+                                       sampling_type='ddim',
+                                       b=self.betas,
+                                       eta=0,
+                                       learn_sigma=self.learn_sigma,
+                                       )
+                    progress_bar.update(1)
+            
+            time_e = time.time()
+            print(f'{time_e - time_s} seconds')
+            x_lat = x.clone()
+            if save_imgs:
+                for k, s_k in enumerate(steps):
+                    tvu.save_image((x_lat[k] + 1) * 0.5, os.path.join(self.args.image_folder,
+                                                                f'{mode}_{s_k}_1_lat_ninv{self.args.n_inv_step}.png'))
+
+            origin_traj = {}
+            with tqdm(total=len(seq_inv), desc=f"Generative process {mode} {step}") as progress_bar:
+                time_s = time.time()
+                for it, (i, j) in enumerate(zip(reversed((seq_inv)), reversed((seq_inv_next)))):
+                    t = (torch.ones(n) * i).to(self.device)
+                    t_next = (torch.ones(n) * j).to(self.device)
+                    xt = x
+
+                    x, x0t, _, _ = denoising_step(x, t=t, t_next=t_next, models=model,
+                                       logvars=self.logvar, schedule=self.schedule,
+                                       sampling_type=self.args.sample_type,
+                                       b=self.betas,
+                                       learn_sigma=self.learn_sigma)
+                    progress_bar.update(1)
+                    if self.args.cache_origin_trajectory:
+                        origin_traj[int(i)] = (xt.detach().cpu(), x0t.detach().cpu())
+                    if self.args.save_process_origin:
+                        for k, s_k in enumerate(steps):
+                            tvu.save_image((x[k] + 1) * 0.5, os.path.join(save_process_folder, f'xt_{s_k}_{it}_{t[0]}.png'))
+                            tvu.save_image((x0t[k] + 1) * 0.5, os.path.join(save_process_folder, f'x0t_{s_k}_{it}_{t[0]}.png'))
+                time_e = time.time()
+                print(f'{time_e - time_s} seconds')
+
+        if save_imgs:
+            for k, s_k in enumerate(steps):
+                tvu.save_image((x[k] + 1) * 0.5, os.path.join(self.args.image_folder,
+                                                        f'{mode}_{s_k}_1_rec_ninv{self.args.n_inv_step}.png'))
+
+        return x0, x, x_lat, origin_traj
+
+    def append_to_store(self, store, steps, x0, x_rec, x_lat, origin_traj, store_traj):
+        for k, idx in enumerate(steps):
+            fields = dict(x0=x0[k:k+1], x_rec=x_rec[k:k+1], x_lat=x_lat[k:k+1])
+            if store_traj:
+                fields.update(self.origin_traj_fields({i: (xt[k:k+1], x0t[k:k+1])
+                                                       for i, (xt, x0t) in origin_traj.items()}))
+            store.append(idx, **fields)
+        store.flush()
+
+    @staticmethod
+    def origin_traj_path(pairs_path):
+        # companion file of a precomputed pairs file, holding the unedited trajectories
+        return pairs_path.replace('_pairs.pth', '_origin_traj.pth')
+
+    def load_origin_trajs(self, pairs_path, num_pairs):
+        traj_path = self.origin_traj_path(pairs_path)
+        if os.path.exists(traj_path):
+            origin_trajs = torch.load(traj_path, map_location=torch.device('cpu'))
+        else:
+            print(f'{traj_path} does not exist. Use --re_precompute to cache the origin trajectory.')
+            origin_trajs = []
+        # pairs without a cached trajectory fall back to running the origin process
+        return origin_trajs[:num_pairs] + [None] * (num_pairs - len(origin_trajs))
+
+    def open_latent_store(self, mode, pairs_path):
+        """LatentStore next to pairs_path (one per mode/t_0/n_inv_step, any number of images).
+
+        An existing pickled pairs file is imported into an empty store.
+        """
+        store_root = re.sub(r'_nim\d+', '', pairs_path).replace('_pairs.pth', '_store')
+        if self.args.re_precompute and os.path.exists(store_root):
+            shutil.rmtree(store_root)
+        key = {'dataset': self.config.data.dataset, 'category': self.config.data.category,
+               'target_class_num': self.args.target_class_num, 'mode': mode,
+               't_0': self.args.t_0, 'n_inv_step': self.args.n_inv_step}
+        # one shard series per process, so that precompute workers never share a file
+        writer = f'{socket.gethostname()}-{os.getpid()}'
+        store = LatentStore(store_root, key, dtype=self.args.latent_store_dtype, writer=writer)
+
+        if len(store) == 0 and os.path.exists(pairs_path) and not self.args.re_precompute:
+            print(f'Importing {pairs_path} into {store_root}')
+            img_lat_pairs = torch.load(pairs_path, map_location=torch.device('cpu'))
+            origin_trajs = [None] * len(img_lat_pairs)
+            if self.args.cache_origin_trajectory:
+                origin_trajs = self.load_origin_trajs(pairs_path, len(img_lat_pairs))
+                if any(traj is None for traj in origin_trajs):
+                    origin_trajs = [None] * len(img_lat_pairs)
+            for idx, ((x0, x_rec, x_lat), traj) in enumerate(zip(img_lat_pairs, origin_trajs)):
+                fields = dict(x0=x0, x_rec=x_rec, x_lat=x_lat)
+                if traj is not None:
+                    fields.update(self.origin_traj_fields(traj))
+                store.append(idx, **fields)
+            store.flush()
+        return store
+
+    @staticmethod
+    def origin_traj_fields(traj):
+        # {t: (x_t, x0_t)} in generative order -> [T, C, H, W] store fields
+        return {'origin_xt': torch.cat([xt for xt, _ in traj.values()], dim=0),
+                'origin_x0t': torch.cat([x0t for _, x0t in traj.values()], dim=0)}
+
+    def store_origin_trajs(self, store, indices, seq_inv):
+        if 'origin_x0t' not in store.fields:
+            print(f'{store.root} has no origin trajectories. Use --re_precompute to cache them.')
+            return None
+        return OriginTrajectories(store, indices, reversed(seq_inv))
+
+    def has_origin_trajectory(self, origin_traj_batch, seq):
+        """Whether the cached trajectories are the DDIM path over `seq` itself.
+
+        That holds only if `seq`, in generative order, is the start of the stored
+        inversion timesteps (the same schedule, possibly cut at t_edit). A coarser
+        `seq` takes other steps than the stored path, so merely containing its
+        timesteps is not enough; the UNet has to run then.
+        """
+        if not origin_traj_batch:
+            return False
+        seq_gen = sorted((int(i) for i in seq), reverse=True)
+        return all(traj is not None and list(traj)[:len(seq_gen)] == seq_gen for traj in origin_traj_batch)
+
+    def cached_x_rec(self, x_rec):
+        """Precomputed reconstructions of the batch, if they can stand in for the origin process."""
+        if not self.args.cache_origin_trajectory:
+            return None
+        if self.args.load_random_noise and not self.args.saved_random_noise:
+            # random_noise_pairs only puts placeholder zeros there
+            return None
+        return x_rec
+
+    def latent_batches(self, img_lat_pairs_dic, mode, batch_size, target_ids=None, start_id=0):
+        """Batches of the precomputed pairs of `mode` as (last image index, image indices, x0, x_rec, x_lat).
+
+        Batches are assembled on the host by a DataLoader (the last one may be
+        smaller) and copied to self.device one batch ahead on a background thread.
+        """
+        pairs = img_lat_pairs_dic[mode]
+        n_img = self.args.n_train_img if mode == 'train' else self.args.n_test_img
+        indices = [idx for idx in range(min(len(pairs), n_img)) if idx >= start_id]
+        if target_ids:
+            indices = [idx for idx in indices if idx in target_ids]
+        loader = get_latent_dataloader(pairs, batch_size, indices, device=self.device)
+        for idx, x0, x_rec, x_lat in Prefetcher(loader, device=self.device):
+            idx = idx.tolist()
+            yield idx[-1], idx, x0, x_rec, x_lat
+
     # ----------- Get random latent -----------#
     @torch.no_grad()
     def random_noise_pairs(self, model, saved_noise=False, save_imgs=False):
@@ -1245,7 +1611,6 @@ class Asyrp(object):
         seq_inv = [int(s+1e-6) for s in list(seq_inv)]
         seq_inv_next = [-1] + list(seq_inv[:-1])
 
-        n = 1
         img_lat_pairs_dic = {}
 
         if saved_noise:
@@ -1279,15 +1644,21 @@ class Asyrp(object):
                                 break
                     continue
                 
-                step = 0
-                while True:
+                n_img = self.args.n_train_img if mode == 'train' else self.args.n_test_img
+                for first in range(0, n_img, self.args.bs_precompute):
+                    steps = list(range(first, min(first + self.args.bs_precompute, n_img)))
+                    step = steps[0]
+                    n = len(steps)
                     
                     with torch.no_grad():
-                        x_lat = torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size)).to(self.device)
+                        # one draw per image, in order, so the latents do not depend on bs_precompute
+                        x_lat = torch.cat([torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size))
+                                           for _ in steps], dim=0).to(self.device)
 
                         if save_imgs:
-                            tvu.save_image((x_lat + 1) * 0.5, os.path.join(self.args.image_folder,
-                                                                        f'{mode}_{step}_1_lat_ninv{self.args.n_inv_step}.png'))
+                            for k, s_k in enumerate(steps):
+                                tvu.save_image((x_lat[k] + 1) * 0.5, os.path.join(self.args.image_folder,
+                                                                            f'{mode}_{s_k}_1_lat_ninv{self.args.n_inv_step}.png'))
 
                         with tqdm(total=len(seq_inv), desc=f"Generative process {mode} {step}") as progress_bar:
                             time_s = time.time()
@@ -1297,7 +1668,7 @@ class Asyrp(object):
                                 t_next = (torch.ones(n) * j).to(self.device)
 
                                 x, _, _, _ = denoising_step(x, t=t, t_next=t_next, models=model,
-                                                logvars=self.logvar,
+                                                logvars=self.logvar, schedule=self.schedule,
                                                 sampling_type=self.args.sample_type,
                                                 b=self.betas,
                                                 learn_sigma=self.learn_sigma)
@@ -1305,24 +1676,22 @@ class Asyrp(object):
                             time_e = time.time()
                             print(f'{time_e - time_s} seconds')
                         # img_lat_pairs.append([None, x.detach().clone(), x_lat.detach().clone()])
-                        img_lat_pairs.append([x.detach().clone(), x.detach().clone(), x_lat.detach().clone()])
-
-                    
+                        for k in range(n):
+                            img_lat_pairs.append([x[k:k+1].to('cpu', copy=True), x[k:k+1].to('cpu', copy=True), x_lat[k:k+1].to('cpu', copy=True)])
 
                     if save_imgs:
-                        tvu.save_image((x + 1) * 0.5, os.path.join(self.args.image_folder,
-                                                                f'{mode}_{step}_1_rec_ninv{self.args.n_inv_step}.png'))
-                    if (mode == "train" and step == self.args.n_train_img - 1) or (mode == "test" and step == self.args.n_test_img - 1):
-                        break
-                    step += 1
+                        for k, s_k in enumerate(steps):
+                            tvu.save_image((x[k] + 1) * 0.5, os.path.join(self.args.image_folder,
+                                                                    f'{mode}_{s_k}_1_rec_ninv{self.args.n_inv_step}.png'))
 
                 img_lat_pairs_dic[mode] = img_lat_pairs
                 torch.save(img_lat_pairs, pairs_path)
 
         else:
+            # the latents stay on the host like the saved ones; latent_batches moves each batch to the device
             train_lat = []
             for i in range(self.args.n_train_img):
-                lat = torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size)).to(self.device)
+                lat = torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size))
                 # train_lat.append([None, None, lat])
                 train_lat.append([torch.zeros_like(lat), torch.zeros_like(lat), lat])
 
@@ -1330,7 +1699,7 @@ class Asyrp(object):
 
             test_lat = []
             for i in range(self.args.n_test_img):
-                lat = torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size)).to(self.device)
+                lat = torch.randn((1, self.config.data.channels, self.config.data.image_size, self.config.data.image_size))
                 # test_lat.append([None, None, lat])
                 test_lat.append([torch.zeros_like(lat), torch.zeros_like(lat), lat])
 
@@ -1350,8 +1719,7 @@ class Asyrp(object):
 
         model = self.load_pretrained_model()
 
-        model = model.to(self.device)
-        model = torch.nn.DataParallel(model)
+        model = self.prepare_model(model, self.args.bs_train)
 
         import lpips
 
@@ -1370,10 +1738,12 @@ class Asyrp(object):
         train_dataset, test_dataset = get_dataset(self.config.data.dataset, DATASET_PATHS, self.config,
                                                         target_class_num=self.args.target_class_num)
 
-        loader_dic = get_dataloader(train_dataset, test_dataset, bs_train=1,#self.args.bs_train,
+        loader_dic = get_dataloader(train_dataset, test_dataset, bs_train=self.args.bs_precompute, drop_last=False,
                                     num_workers=self.config.data.num_workers)
         loader = loader_dic["train"]
         print("Load dataset done")
+        # steps 0..n_train_img are measured (n_train_img + 1 images)
+        n_img = self.args.n_train_img + 1
 
         lpips_distance_list = {}
         lpips_distance_list_x0_t = {}
@@ -1389,10 +1759,15 @@ class Asyrp(object):
 
         save_imgs = True
 
-        for step, img in enumerate(loader):
-            x0 = img.to(self.device)
+        for batch_idx, img in enumerate(loader):
+            first = batch_idx * self.args.bs_precompute
+            if first >= n_img:
+                break
+            step = first
+            x0 = img[:n_img - first].to(self.device)
+            n = x0.shape[0]
             if save_imgs:
-                tvu.save_image((x0 + 1) * 0.5, os.path.join(self.args.image_folder, f'LPIPS_{step}_0_orig.png'))
+                tvu.save_image((x0[0] + 1) * 0.5, os.path.join(self.args.image_folder, f'LPIPS_{step}_0_orig.png'))
 
             x = x0.clone()
             model.eval()
@@ -1400,24 +1775,25 @@ class Asyrp(object):
             with torch.no_grad():
                 with tqdm(total=len(seq_inv), desc=f"Inversion process {step}") as progress_bar:
                     for it, (i, j) in enumerate(zip((seq_inv_next[1:]), (seq_inv[1:]))):
-                        t = (torch.ones(self.args.bs_train) * i).to(self.device)
-                        t_prev = (torch.ones(self.args.bs_train) * j).to(self.device)
+                        t = (torch.ones(n) * i).to(self.device)
+                        t_prev = (torch.ones(n) * j).to(self.device)
 
                         x, x0_t, _, _ = denoising_step(x, t=t, t_next=t_prev, models=model,
-                                            logvars=self.logvar,
+                                            logvars=self.logvar, schedule=self.schedule,
                                             sampling_type='ddim',
                                             b=self.betas,
                                             eta=0,
                                             learn_sigma=self.learn_sigma,
                                             )
+                        # per-image distances, in image order
                         lpips_x = loss_fn_alex(x, x0)
                         lpips_x0 = loss_fn_alex(x0_t, x0)
-                        lpips_distance_list[j].append(lpips_x.item())
-                        lpips_distance_list_x0_t[j].append(lpips_x0.item())
+                        lpips_distance_list[j].extend(lpips_x.flatten().tolist())
+                        lpips_distance_list_x0_t[j].extend(lpips_x0.flatten().tolist())
                         if save_imgs:
-                            tvu.save_image((x + 1) * 0.5, os.path.join(self.args.image_folder,
+                            tvu.save_image((x[0] + 1) * 0.5, os.path.join(self.args.image_folder,
                                                                 f'LPIPS_{step}_{j}.png'))
-                            tvu.save_image((x0_t + 1) * 0.5, os.path.join(self.args.image_folder,
+                            tvu.save_image((x0_t[0] + 1) * 0.5, os.path.join(self.args.image_folder,
                                                                 f'X0_t_LPIPS_{step}_{j}.png'))
                         progress_bar.update(1)
                 
@@ -1425,8 +1801,6 @@ class Asyrp(object):
                 print(f'{time_e - time_s} seconds')
             
             save_imgs = False
-            if self.args.n_train_img == step:
-                break
         
         result_x_tsv = ""
         result_x_std_tsv = ""
@@ -1459,6 +1833,7 @@ class Asyrp(object):
 
     @torch.no_grad()
     def set_t_edit_t_addnoise(self, LPIPS_th=0.33, LPIPS_addnoise_th=0.1, return_clip_loss=False):
+        from losses.clip_loss import CLIPLoss
 
         clip_loss_func = CLIPLoss(
             self.device,
@@ -1471,10 +1846,8 @@ class Asyrp(object):
 
         # ----------- Get clip cosine similarity -----------#
         print("Texts:", self.src_txts, self.trg_txts)
-        scr_token = clip_loss_func.tokenize(self.src_txts)
-        trg_token = clip_loss_func.tokenize(self.trg_txts)
-        text_feature_scr = clip_loss_func.encode_text(scr_token)
-        text_feature_trg = clip_loss_func.encode_text(trg_token)
+        text_feature_scr = clip_loss_func.get_cached_text_features(self.src_txts)
+        text_feature_trg = clip_loss_func.get_cached_text_features(self.trg_txts)
 
         ## get cosine distance between features
         text_cos_distance = torch.nn.CosineSimilarity(dim=1, eps=1e-6)(text_feature_scr, text_feature_trg)
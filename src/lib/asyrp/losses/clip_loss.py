@@ -6,6 +6,8 @@ import clip
 from PIL import Image
 
 from utils.text_templates import imagenet_templates, part_templates, imagenet_templates_small
+from utils.text_feature_cache import get_text_feature_cache
+from utils.profiling import profiled
 
 
 class DirectionLoss(torch.nn.Module):
@@ -27,12 +29,36 @@ class DirectionLoss(torch.nn.Module):
         
         return self.loss_func(x, y)
 
+
+_clip_models = {}
+
+
+def load_clip(clip_model, device):
+    """(model, preprocess) of a CLIP variant, loaded once per process and device.
+
+    The model is shared by every caller, so it is handed out frozen and in eval mode.
+    """
+    key = (clip_model, str(device))
+    if key not in _clip_models:
+        model, preprocess = clip.load(clip_model, device=device)
+        model.eval().requires_grad_(False)
+        _clip_models[key] = (model, preprocess)
+    return _clip_models[key]
+
+
+def register_clip(clip_model, device, model, preprocess):
+    """Make load_clip(clip_model, device) return `model` (e.g. a small random CLIP for benchmarks)."""
+    model.eval().requires_grad_(False)
+    _clip_models[(clip_model, str(device))] = (model, preprocess)
+
+
 class CLIPLoss(torch.nn.Module):
     def __init__(self, device, lambda_direction=1., lambda_patch=0., lambda_global=0., lambda_manifold=0., lambda_texture=0., patch_loss_type='mae', direction_loss_type='cosine', clip_model='ViT-B/32'):
         super(CLIPLoss, self).__init__()
 
         self.device = device
-        self.model, clip_preprocess = clip.load(clip_model, device=self.device)
+        self.clip_model_name = clip_model
+        self.model, clip_preprocess = load_clip(clip_model, self.device)
 
         self.clip_preprocess = clip_preprocess
         
@@ -57,24 +83,42 @@ class CLIPLoss(torch.nn.Module):
         self.target_text_features = None
         self.angle_loss = torch.nn.L1Loss()
 
-        self.model_cnn, preprocess_cnn = clip.load("RN50", device=self.device)
+        # the RN50 texture encoder is only needed by the texture loss
+        self.model_cnn = None
+        self.preprocess_cnn = None
+        if self.lambda_texture:
+            self.load_cnn()
+
+        self.texture_loss = torch.nn.MSELoss()
+
+    def load_cnn(self):
+        self.model_cnn, preprocess_cnn = load_clip("RN50", self.device)
         self.preprocess_cnn = transforms.Compose([transforms.Normalize(mean=[-1.0, -1.0, -1.0], std=[2.0, 2.0, 2.0])] + # Un-normalize from [-1.0, 1.0] (GAN output) to [0, 1].
                                         preprocess_cnn.transforms[:2] +                                                 # to match CLIP input scale assumptions
                                         preprocess_cnn.transforms[4:])                                                  # + skip convert PIL to tensor
 
-        self.texture_loss = torch.nn.MSELoss()
-
     def tokenize(self, strings: list):
         return clip.tokenize(strings).to(self.device)
 
     def encode_text(self, tokens: list) -> torch.Tensor:
         return self.model.encode_text(tokens)
 
+    def encode_strings(self, strings: list) -> torch.Tensor:
+        return self.encode_text(self.tokenize(strings))
+
+    def get_cached_text_features(self, texts, templates=None) -> torch.Tensor:
+        """Normalized features of `texts` (each formatted with every template, if given),
+        from the on-disk text feature cache, in the dtype of the text encoder."""
+        return get_text_feature_cache().features(self.clip_model_name, texts, self.encode_strings, templates,
+                                                 device=self.device, dtype=self.model.dtype)
+
     def encode_images(self, images: torch.Tensor) -> torch.Tensor:
         images = self.preprocess(images).to(self.device)
         return self.model.encode_image(images)
 
     def encode_images_with_cnn(self, images: torch.Tensor) -> torch.Tensor:
+        if self.model_cnn is None:
+            self.load_cnn()
         images = self.preprocess_cnn(images).to(self.device)
         return self.model_cnn.encode_image(images)
     
@@ -88,16 +132,14 @@ class CLIPLoss(torch.nn.Module):
         return 1. - similarity
     
     def get_text_features(self, class_str: str, templates=imagenet_templates, norm: bool = True) -> torch.Tensor:
+        if norm:
+            return self.get_cached_text_features(class_str, templates)
+
         template_text = self.compose_text_with_templates(class_str, templates)
 
         tokens = clip.tokenize(template_text).to(self.device)
 
-        text_features = self.encode_text(tokens).detach()
-
-        if norm:
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-
-        return text_features
+        return self.encode_text(tokens).detach()
 
     def get_image_features(self, img: torch.Tensor, norm: bool = True) -> torch.Tensor:
         image_features = self.encode_images(img)
@@ -146,14 +188,16 @@ class CLIPLoss(torch.nn.Module):
         target_features = self.get_text_features(target_class).mean(axis=0, keepdim=True)
         self.target_text_features = target_features / target_features.norm(dim=-1, keepdim=True)
 
-    def clip_angle_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str) -> torch.Tensor:
+    def clip_angle_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str, src_features: torch.Tensor = None) -> torch.Tensor:
         if self.src_text_features is None:
             self.set_text_features(source_class, target_class)
 
         cos_text_angle = self.target_text_features @ self.src_text_features.T
         text_angle = torch.acos(cos_text_angle)
 
-        src_img_features = self.get_image_features(src_img).unsqueeze(2)
+        if src_features is None:
+            src_features = self.get_image_features(src_img)
+        src_img_features = src_features.unsqueeze(2)
         target_img_features = self.get_image_features(target_img).unsqueeze(1)
 
         cos_img_angle = torch.clamp(target_img_features @ src_img_features, min=-1.0, max=1.0)
@@ -167,12 +211,12 @@ class CLIPLoss(torch.nn.Module):
     def compose_text_with_templates(self, text: str, templates=imagenet_templates) -> list:
         return [template.format(text) for template in templates]
             
-    def clip_directional_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str) -> torch.Tensor:
+    def clip_directional_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str, src_features: torch.Tensor = None) -> torch.Tensor:
 
         if self.target_direction is None:
             self.target_direction = self.compute_text_direction(source_class, target_class)
 
-        src_encoding    = self.get_image_features(src_img)
+        src_encoding    = self.get_image_features(src_img) if src_features is None else src_features
         target_encoding = self.get_image_features(target_img)
 
         edit_direction = (target_encoding - src_encoding)
@@ -278,7 +322,9 @@ class CLIPLoss(torch.nn.Module):
 
         return self.texture_loss(src_features, target_features)
 
-    def forward(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str, texture_image: torch.Tensor = None):
+    @profiled('clip_loss')
+    def forward(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str, texture_image: torch.Tensor = None, src_features: torch.Tensor = None):
+        # src_features: get_image_features(src_img), when src_img is reused across calls
         clip_loss = 0.0
 
         if self.lambda_global:
@@ -288,10 +334,10 @@ class CLIPLoss(torch.nn.Module):
             clip_loss += self.lambda_patch * self.patch_directional_loss(src_img, source_class, target_img, target_class)
 
         if self.lambda_direction:
-            clip_loss += self.lambda_direction * self.clip_directional_loss(src_img, source_class, target_img, target_class)
+            clip_loss += self.lambda_direction * self.clip_directional_loss(src_img, source_class, target_img, target_class, src_features)
 
         if self.lambda_manifold:
-            clip_loss += self.lambda_manifold * self.clip_angle_loss(src_img, source_class, target_img, target_class)
+            clip_loss += self.lambda_manifold * self.clip_angle_loss(src_img, source_class, target_img, target_class, src_features)
 
         if self.lambda_texture and (texture_image is not None):
             clip_loss += self.lambda_texture * self.cnn_feature_loss(texture_image, target_img)
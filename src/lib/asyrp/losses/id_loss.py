@@ -20,16 +20,16 @@ class IDLoss(nn.Module):
         x_feats = self.facenet(x)
         return x_feats
 
-    def forward(self, x, x_hat):
-        n_samples = x.shape[0]
-        x_feats = self.extract_feats(x)
+    def forward(self, x, x_hat, x_feats=None):
+        """1 - <f(x_hat), f(x)> per sample. Pass `x_feats` (extract_feats(x)) when the
+        reference is reused across calls; otherwise x and x_hat go through the
+        facenet as one batch."""
+        if x_feats is None:
+            n_samples = x.shape[0]
+            feats = self.extract_feats(torch.cat([x, x_hat], dim=0))
+            x_feats, x_hat_feats = feats[:n_samples], feats[n_samples:]
+        else:
+            x_hat_feats = self.extract_feats(x_hat)
         x_feats = x_feats.detach()
 
-        x_hat_feats = self.extract_feats(x_hat)
-        losses = []
-        for i in range(n_samples):
-            loss_sample = 1 - x_hat_feats[i].dot(x_feats[i])
-            losses.append(loss_sample.unsqueeze(0))
-
-        losses = torch.cat(losses, dim=0)
-        return losses
+        return 1 - (x_hat_feats * x_feats).sum(dim=1)
@@ -4,14 +4,12 @@ import logging
 import yaml
 import sys
 import os
-import torch
-import numpy as np
-import wandb
-wandb.login()
 
-from diffusion_latent import Asyrp
+# torch and the runner are imported once the arguments are parsed, so that
+# `--help` and argument errors return without paying for them
 
-def parse_args_and_config():
+
+def get_parser():
     parser = argparse.ArgumentParser(description=globals()['__doc__'])
 
     # CUSTOM
@@ -49,6 +47,45 @@ def parse_args_and_config():
     parser.add_argument('--use_id_loss', action='store_true', default=False, help='train with id loss')
     parser.add_argument('--shuffle_train_dataloader', action='store_true', default=False, help='shuffle train dataloader')
     parser.add_argument('--re_precompute', action='store_true', default=False, help='re-precompute')
+    parser.add_argument('--latent_store', action='store_true', default=False,
+                        help='keep precomputed latents in a sharded, memory-mapped store (precomputed/*_store) instead of pickled pairs files')
+    parser.add_argument('--latent_store_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='dtype of a new latent store')
+    parser.add_argument('--precompute_workers', type=int, default=0,
+                        help='precompute the latent store with N processes (one GPU each, round robin) that claim image ranges; '
+                             'jobs on other nodes with the same store cooperate')
+    parser.add_argument('--precompute_worker_id', type=int, default=None, help='set for the worker subprocesses')
+    parser.add_argument('--precompute_claim_size', type=int, default=32, help='# of images per claimed range')
+    parser.add_argument('--precompute_claim_timeout', type=float, default=1800,
+                        help='seconds without progress after which a claimed range is taken over')
+    parser.add_argument('--cache_origin_trajectory', action='store_true', default=False,
+                        help='store x_t and x0_t of the unedited DDIM path while precomputing and reuse them instead of '
+                             're-running the origin process (needs --latent_store and n_train_step/n_test_step == n_inv_step; '
+                             '~2*n_inv_step images per pair on disk)')
+    parser.add_argument('--twin_forward', action='store_true', default=False,
+                        help='run the edited and the original DDIM trajectory as one stacked model call per training step '
+                             '(deterministic DDIM only; the stacked batch runs on a single device)')
+    parser.add_argument('--stack_decoders', action='store_true', default=False,
+                        help='run the edited (h2) and the original (h) decoder as one stacked batch instead of two passes')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the UNet encoder/middle/decoder and the DeltaBlocks (static shapes, single device)')
+    parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'])
+    parser.add_argument('--compile_cache_dir', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'asyrp', 'inductor'),
+                        help='inductor artifacts kept between runs')
+    parser.add_argument('--legacy_attention', action='store_true', default=False,
+                        help='use the explicit bmm/einsum + softmax attention instead of F.scaled_dot_product_attention')
+    parser.add_argument('--cpu_profile', action='store_true', default=False,
+                        help='CPU-only runs: channels_last UNet and DeltaBlocks, no DataParallel wrapper, '
+                             'thread counts and core affinity from the available physical cores')
+    parser.add_argument('--cpu_threads', type=int, default=None, help='--cpu_profile intra-op threads (default: all physical cores)')
+    parser.add_argument('--cpu_interop_threads', type=int, default=1, help='--cpu_profile inter-op threads')
+    parser.add_argument('--cpu_bf16', action='store_true', default=False,
+                        help='--cpu_profile: run the generative process of save_image (training previews and run_test) under bfloat16 autocast')
+    parser.add_argument('--mixed_precision', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help='frozen UNet (and the editing forward) in half precision; DeltaBlocks / delta_h stay fp32, '
+                             'with dynamic loss scaling for fp16')
+    parser.add_argument('--mixed_precision_models', type=str, nargs='+', default=['DDPM', 'i_DDPM', 'guided'],
+                        choices=['DDPM', 'i_DDPM', 'guided'], help='model families --mixed_precision applies to')
     parser.add_argument('--save_checkpoint_only_last_iter', action='store_true', default=False, help='carefully')
     parser.add_argument('--save_checkpoint_during_iter', action='store_true', default=False, help='carefully')
     parser.add_argument('--save_checkpoint_step', type=int, default=200, help='save checkpoint every save_checkpoint_step')
@@ -73,6 +110,9 @@ def parse_args_and_config():
     parser.add_argument('--max_delta', type=float, default=1.0, help='max delta for evaluating the generative process')
     parser.add_argument('--min_delta', type=float, default=0.0, help='min delta for evaluating the generative process')
     parser.add_argument('--num_delta', type=int, default=5, help='num of delta for evaluating the generative process')
+    parser.add_argument('--sweep_batch', type=int, default=8,
+                        help='# of delta_interpolation strengths generated as one batch (1: one generative process per strength; '
+                             'stochastic steps below t_addnoise draw different noise when batched)')
     
     parser.add_argument('--hs_coeff_delta_h', type=float, default=1.0, help='max delta for evaluating the generative process')
     parser.add_argument('--hs_coeff_origin_h', type=float, default=1.0, help='max delta for evaluating the generative process')
@@ -80,6 +120,20 @@ def parse_args_and_config():
     parser.add_argument('--target_image_id', type=str, help='Sampling only one image which is target_image_id')
     parser.add_argument('--start_image_id', type=int, default=0, help='Sampling after start_image_id')
     
+    parser.add_argument('--logger', type=str, default='wandb', choices=['wandb', 'local', 'none'],
+                        help='wandb; local: exp/logs/progress.json and progress.csv (no network); none')
+    parser.add_argument('--log_interval', type=int, default=50, help='# of logged rows buffered before they are written to the logger')
+    parser.add_argument('--profile', type=str, default='none', choices=['none', 'stages', 'trace'],
+                        help='stages: per-region latency/memory/throughput summary in exp/profile/stages.json; '
+                             'trace: also record a torch.profiler Chrome trace (exp/profile/trace.json)')
+    parser.add_argument('--telemetry_interval', type=int, default=10,
+                        help='# of training steps between progress bar updates (each one copies the loss statistics to the host)')
+    parser.add_argument('--image_writer_workers', type=int, default=2,
+                        help='# of background threads encoding and writing the images of save_image (0: write inline)')
+    parser.add_argument('--image_sink', type=str, default='files', choices=['files', 'tar', 'npz'],
+                        help='files: one PNG per image; tar: PNGs in sharded exp/images-*.tar; npz: raw uint8 arrays in sharded exp/images-*.npz')
+    parser.add_argument('--image_compress_level', type=int, default=6, help='PNG zlib level, 0 (uncompressed) to 9')
+    parser.add_argument('--image_shard_size', type=int, default=1000, help='# of images per tar/npz shard')
     parser.add_argument('--save_process_origin', action='store_true', help='save_origin_process')
     parser.add_argument('--save_process_delta_h', action='store_true', help='save_delta_h_process')
     
@@ -90,6 +144,8 @@ def parse_args_and_config():
     parser.add_argument('--masked_h', type=str, default='', help='')
 
     parser.add_argument('--manual_checkpoint_name', type=str, default="", help='manually choose the name of chekcpoint')
+    parser.add_argument('--fanout_checkpoints', type=str, default='',
+                        help='space separated DeltaBlock checkpoints; run_test edits every image with each of them in one stacked generative process')
     parser.add_argument('--choose_checkpoint_num', type=str, default='', help='if model is saved during an iteration, you can choose the number of chekcpoint of the model. This is for training from random noise')
     parser.add_argument('--load_from_checkpoint', type=str)
 
@@ -190,6 +246,7 @@ def parse_args_and_config():
     parser.add_argument('--save_train_image_iter', type=int, default=1, help='Wheter to save training results during CLIP fineuning')
     parser.add_argument('--bs_train', type=int, default=1, help='Training batch size during CLIP fineuning')
     parser.add_argument('--bs_test', type=int, default=1, help='Test batch size during CLIP fineuning')
+    parser.add_argument('--bs_precompute', type=int, default=1, help='Batch size of the inversion/reconstruction when precomputing latents (and LPIPS distances)')
     parser.add_argument('--n_precomp_img', type=int, default=100, help='# of images to precompute latents')
     parser.add_argument('--n_train_img', type=int, default=50, help='# of training images')
     parser.add_argument('--n_test_img', type=int, default=10, help='# of test images')
@@ -238,7 +295,18 @@ def parse_args_and_config():
 
     parser.add_argument('--get_SNR', action="store_true", default=False, help='Whether to get SNR')
 
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args_and_config(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.cache_origin_trajectory and not args.latent_store:
+        # the trajectories take ~2*n_inv_step images per pair; only the store reads them lazily
+        parser.error('--cache_origin_trajectory needs --latent_store')
+
+    import torch
+    import numpy as np
 
     # parse config file
     with open(os.path.join('configs', args.config), 'r') as f:
@@ -334,6 +402,9 @@ def dict2namespace(config):
 def main():
     args, config = parse_args_and_config()
 
+    import torch
+    from diffusion_latent import Asyrp
+
     # This code is for me. If you don't need it, just remove it out.
     if torch.cuda.is_available():
         assert args.bs_train % torch.cuda.device_count() == 0, f"Number of GPUs ({torch.cuda.device_count()}) must be a multiple of batch size ({args.bs_train})"
@@ -341,7 +412,9 @@ def main():
     runner = Asyrp(args, config) # if you want to specify the device, add device="something" in the argument
     try:
         # check the example script files for essential parameters
-        if args.run_train:
+        if args.precompute_worker_id is not None:
+            runner.run_precompute()
+        elif args.run_train:
             runner.run_training()
         elif args.run_test:
             runner.run_test()
@@ -350,6 +423,12 @@ def main():
 
     except Exception:
         logging.error(traceback.format_exc())
+        # worker 0 only notices a crashed precompute worker through its exit code
+        if args.precompute_worker_id is not None:
+            return 1
+    finally:
+        from utils.profiling import stop_profiling
+        stop_profiling()
 
     return 0
 
@@ -0,0 +1,24 @@
+import torch.nn.functional as F
+
+
+# The attention blocks of all three model families call
+# F.scaled_dot_product_attention (fused kernels, no materialized hw x hw
+# softmax on the memory efficient paths) unless the legacy bmm/einsum +
+# softmax path is selected with set_sdpa(False) (--legacy_attention).
+_use_sdpa = hasattr(F, 'scaled_dot_product_attention')
+
+
+def set_sdpa(enabled):
+    global _use_sdpa
+    _use_sdpa = bool(enabled) and hasattr(F, 'scaled_dot_product_attention')
+
+
+def use_sdpa():
+    return _use_sdpa
+
+
+def sdpa_bct(q, k, v):
+    """Attention over [B x C x T] q, k, v with F.scaled_dot_product_attention; its
+    default 1 / sqrt(C) scale equals the two 1 / sqrt(sqrt(C)) factors of the einsum path."""
+    a = F.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2))
+    return a.transpose(1, 2)
@@ -1,8 +1,10 @@
 import math
 import torch
 import torch.nn as nn
-from diffusers.models.attention import AdaGroupNorm
-from diffusers.models.unet_2d_blocks import UNetMidBlock2DCrossAttn
+
+from utils.profiling import region
+from models.attention import use_sdpa
+from models.edit_utils import is_noop_edit, cat_skip, edit_half
 
 def slerp(t, v0, v1):
     _shape = v0.shape
@@ -193,8 +195,15 @@ class AttnBlock(nn.Module):
         k = self.k(h_)
         v = self.v(h_)
 
-        # compute attention
         b, c, h, w = q.shape
+        if use_sdpa():
+            # one head over the hw positions; the default scale is c ** -0.5 as below
+            q, k, v = (y.reshape(b, 1, c, h * w).transpose(2, 3) for y in (q, k, v))
+            h_ = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+            h_ = h_.transpose(2, 3).reshape(b, c, h, w)
+            return x + self.proj_out(h_)
+
+        # compute attention
         q = q.reshape(b, c, h * w)
         q = q.permute(0, 2, 1)  # b,hw,c
         k = k.reshape(b, c, h * w)  # b,c,hw
@@ -296,6 +305,8 @@ class DDPM(nn.Module):
         self.num_res_blocks = num_res_blocks
         self.resolution = resolution
         self.in_channels = in_channels
+        # decode h2 and h as one stacked batch (set by the runner)
+        self.stack_decoders = False
 
         # timestep embedding
         self.temb = nn.Module()
@@ -444,27 +455,14 @@ class DDPM(nn.Module):
         temb = self.temb.dense[1](temb)
         return temb
 
-    def forward(
-        self,
-        x,
-        t,
-        index=None,
-        t_edit=400,
-        hs_coeff=(1.0, 1.0),
-        delta_h=None,
-        ignore_timestep=False,
-        use_mask=False,
-    ):
-        assert x.shape[2] == x.shape[3] == self.resolution
-
+    def encode(self, x, t):
+        """Timestep embedding and downsampling path: (temb, hs)."""
         # timestep embedding
         temb = get_timestep_embedding(t, self.ch)
         temb = self.temb.dense[0](temb)
         temb = nonlinearity(temb)
         temb = self.temb.dense[1](temb)
 
-        cnt = 0
-
         # downsampling
         hs = [self.conv_in(x)]
         for i_level in range(self.num_resolutions):
@@ -476,88 +474,24 @@ class DDPM(nn.Module):
 
             if i_level != self.num_resolutions - 1:
                 hs.append(self.down[i_level].downsample(hs[-1]))
+        return temb, hs
 
-        # middle
-
-        h = hs[-1]
+    def middle(self, h, temb):
         h = self.mid.block_1(h, temb)
         h = self.mid.attn_1(h)
         h = self.mid.block_2(h, temb)
-        middle_h = h
-        h2 = None
-
-        if index is not None:
-            # assert len(hs_coeff) == index + 1 + 1
-            # check t_edit
-            if t[0] >= t_edit:
-                # use DeltaBlock
-                if delta_h is None:  # Asyrp
-                    h2 = h * hs_coeff[0]
-                    for i in range(index + 1):
-                        delta_h = getattr(self, f"layer_{i}")(
-                            h, None if ignore_timestep else temb
-                        )
-                        h2 += delta_h * hs_coeff[i + 1]
-                # use input delta_h  : even tough you does not use DeltaBlock, you need to use index is 0.
-                else:  # DiffStyle; Just ignore this code. We will update about it in README.md later.
-                    if use_mask:
-                        mask = torch.zeros_like(h)
-                        mask[:, :, 4:-1, 3:5] = 1.0
-                        inverted_mask = 1 - mask
-
-                        masked_delta_h = delta_h * mask
-                        masked_h = h * mask
-
-                        partial_h2 = slerp(1 - hs_coeff[0], masked_h, masked_delta_h)
-                        h2 = partial_h2 + inverted_mask * h
-
-                    else:
-                        h_shape = h.shape
-                        h_copy = h.clone().view(h_shape[0], -1)
-                        delta_h_copy = delta_h.clone().view(h_shape[0], -1)
-
-                        h_norm = (
-                            torch.norm(h_copy, dim=1)
-                            .unsqueeze(-1)
-                            .unsqueeze(-1)
-                            .unsqueeze(-1)
-                        )
-                        delta_h_norm = (
-                            torch.norm(delta_h_copy, dim=1)
-                            .unsqueeze(-1)
-                            .unsqueeze(-1)
-                            .unsqueeze(-1)
-                        )
-                        normalized_delta_h = h_norm * delta_h / delta_h_norm
-
-                        h2 = slerp(1.0 - hs_coeff[0], h, normalized_delta_h)
-            # when t[0] < t_edit : pass the delta_h
-            else:
-                h2 = h
-
-            hs_index = -1
-
-            for i_level in reversed(range(self.num_resolutions)):
-                for i_block in range(self.num_res_blocks + 1):
-                    h2 = self.up[i_level].block[i_block](
-                        torch.cat([h2, hs[hs_index]], dim=1), temb
-                    )
-                    hs_index -= 1
-                    if len(self.up[i_level].attn) > 0:
-                        h2 = self.up[i_level].attn[i_block](h2)
-                if i_level != 0:
-                    h2 = self.up[i_level].upsample(h2)
-
-            # end
-            h2 = self.norm_out(h2)
-            h2 = nonlinearity(h2)
-            h2 = self.conv_out(h2)
+        return h
 
-        # upsampling
+    def decode(self, h, hs, temb, stacked=False, n_edit=None):
+        """Upsampling path; takes the skips from the end of `hs` (which is left as is).
+        With `stacked`, h is a [h2; h] batch that shares the skips (see cat_skip)."""
+        hs_index = len(hs) - 1
         for i_level in reversed(range(self.num_resolutions)):
             for i_block in range(self.num_res_blocks + 1):
+                skip = hs[hs_index]
+                hs_index -= 1
                 h = self.up[i_level].block[i_block](
-                    torch.cat([h, hs.pop()], dim=1), temb
+                    cat_skip(h, skip, n_edit) if stacked else torch.cat([h, skip], dim=1), temb
                 )
                 if len(self.up[i_level].attn) > 0:
                     h = self.up[i_level].attn[i_block](h)
@@ -569,6 +503,103 @@ class DDPM(nn.Module):
         h = self.norm_out(h)
         h = nonlinearity(h)
         h = self.conv_out(h)
+        return h
+
+    def forward(
+        self,
+        x,
+        t,
+        index=None,
+        t_edit=400,
+        hs_coeff=(1.0, 1.0),
+        delta_h=None,
+        ignore_timestep=False,
+        use_mask=False,
+        n_edit=None,
+    ):
+        assert x.shape[2] == x.shape[3] == self.resolution
+
+        # encode, middle and decode are separate methods so that they can be
+        # compiled on their own (utils/compile_utils.py)
+        with region('unet/encoder', n=x.shape[0]):
+            temb, hs = self.encode(x, t)
+
+        # middle
+        with region('unet/mid'):
+            h = self.middle(hs[-1], temb)
+
+        middle_h = h
+        h2 = None
+
+        if index is not None:
+            h_edit, temb_edit, hs_edit = edit_half(h, n_edit), edit_half(temb, n_edit), edit_half(hs, n_edit)
+
+            # assert len(hs_coeff) == index + 1 + 1
+            # check t_edit
+            # the edited branch is skipped when it would decode h_edit unchanged:
+            # t < t_edit, or hs_coeff keeps h and drops every delta (Asyrp only)
+            edit = bool(t[0] >= t_edit) and not (delta_h is None and is_noop_edit(hs_coeff, index))
+            if edit:
+                with region('unet/delta'):
+                    # use DeltaBlock
+                    if delta_h is None:  # Asyrp
+                        h2 = h_edit * hs_coeff[0]
+                        for i in range(index + 1):
+                            delta_h = getattr(self, f"layer_{i}")(
+                                h_edit, None if ignore_timestep else temb_edit
+                            )
+                            h2 += delta_h * hs_coeff[i + 1]
+                    # use input delta_h  : even tough you does not use DeltaBlock, you need to use index is 0.
+                    else:  # DiffStyle; Just ignore this code. We will update about it in README.md later.
+                        if use_mask:
+                            mask = torch.zeros_like(h_edit)
+                            mask[:, :, 4:-1, 3:5] = 1.0
+                            inverted_mask = 1 - mask
+
+                            masked_delta_h = delta_h * mask
+                            masked_h = h_edit * mask
+
+                            partial_h2 = slerp(1 - hs_coeff[0], masked_h, masked_delta_h)
+                            h2 = partial_h2 + inverted_mask * h_edit
+
+                        else:
+                            h_shape = h_edit.shape
+                            h_copy = h_edit.clone().view(h_shape[0], -1)
+                            delta_h_copy = delta_h.clone().view(h_shape[0], -1)
+
+                            h_norm = (
+                                torch.norm(h_copy, dim=1)
+                                .unsqueeze(-1)
+                                .unsqueeze(-1)
+                                .unsqueeze(-1)
+                            )
+                            delta_h_norm = (
+                                torch.norm(delta_h_copy, dim=1)
+                                .unsqueeze(-1)
+                                .unsqueeze(-1)
+                                .unsqueeze(-1)
+                            )
+                            normalized_delta_h = h_norm * delta_h / delta_h_norm
+
+                            h2 = slerp(1.0 - hs_coeff[0], h_edit, normalized_delta_h)
+
+            if edit and not self.stack_decoders:
+                with region('unet/decoder_edit'):
+                    h2 = self.decode(h2, hs_edit, temb_edit)
+
+        # with stack_decoders, h2 and h go through the decoder as one batch
+        stacked = index is not None and edit and self.stack_decoders
+        if stacked:
+            n2 = h2.shape[0]
+            h, temb = torch.cat([h2, h], dim=0), torch.cat([temb_edit, temb], dim=0)
+
+        with region('unet/decoder'):
+            h = self.decode(h, hs, temb, stacked=stacked, n_edit=n_edit)
+
+        if stacked:
+            h2, h = h[:n2], h[n2:]
+        if index is not None and not edit:
+            h2 = edit_half(h, n_edit)
 
         return h, h2, delta_h, middle_h
 
@@ -1139,6 +1170,8 @@ class DeltaBlock(nn.Module):
         self.emb_type = emb_type
         self.layer_type = layer_type
         if use_midblock:
+            # diffusers is only needed for these DeltaBlock variants
+            from diffusers.models.unet_2d_blocks import UNetMidBlock2DCrossAttn
             self.model = UNetMidBlock2DCrossAttn(512, 512, cross_attention_dim=512)
         else:
             self.in_channels = in_channels
@@ -1157,6 +1190,7 @@ class DeltaBlock(nn.Module):
             )
             if emb_type == "adagn":
                 # num groups is kept the same as in Normalize
+                from diffusers.models.attention import AdaGroupNorm
                 self.adagn = AdaGroupNorm(embedding_dim=512,out_dim=512,num_groups=32)
 
             if layer_type == 'conv':
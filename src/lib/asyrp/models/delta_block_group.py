@@ -0,0 +1,52 @@
+import torch
+import torch.nn as nn
+
+
+class DeltaBlockGroup(nn.Module):
+    """k DeltaBlocks of one architecture, applied to a group-major stacked batch.
+
+    Drop-in for a model's `layer_{i}`: rows [g*B, (g+1)*B) of `h` (and of the
+    time embedding) go through block g. The weights of the k blocks are
+    stacked once per device and run as a single vmapped call; blocks with
+    layers vmap can not batch fall back to a loop over the groups.
+
+    The stacked weights are not refreshed, so load the blocks' checkpoints
+    before the first forward. Inference only.
+    """
+
+    def __init__(self, blocks):
+        super().__init__()
+        self.blocks = nn.ModuleList(blocks)
+        self._stacked = {}  # device -> (params, buffers); shared by DataParallel replicas
+        self._use_vmap = True
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def stacked_state(self, device):
+        if device not in self._stacked:
+            params, buffers = torch.func.stack_module_state(list(self.blocks))
+            self._stacked[device] = ({k: v.detach() for k, v in params.items()}, buffers)
+        return self._stacked[device]
+
+    def forward(self, h, temb=None):
+        k = len(self.blocks)
+        assert h.shape[0] % k == 0, f"batch of {h.shape[0]} does not split into {k} groups"
+        hs = h.unflatten(0, (k, -1))
+        tembs = None if temb is None else temb.unflatten(0, (k, -1))
+
+        if self._use_vmap:
+            params, buffers = self.stacked_state(h.device)
+            base = self.blocks[0]
+
+            def call(p, b, x, e):
+                return torch.func.functional_call(base, (p, b), (x, e))
+
+            try:
+                out = torch.func.vmap(call, in_dims=(0, 0, 0, None if tembs is None else 0))(params, buffers, hs, tembs)
+                return out.flatten(0, 1)
+            except (RuntimeError, NotImplementedError) as e:
+                print(f"DeltaBlockGroup: vmap failed ({e}), running the blocks one by one")
+                self._use_vmap = False
+
+        return torch.cat([block(hs[g], None if tembs is None else tembs[g]) for g, block in enumerate(self.blocks)], dim=0)
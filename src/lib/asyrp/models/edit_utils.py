@@ -0,0 +1,38 @@
+"""h-space editing helpers shared by the DDPM, i_DDPM and guided_diffusion UNets."""
+import torch
+
+
+def is_noop_edit(hs_coeff, index):
+    """True when `hs_coeff` keeps h as is and scales every delta_h by 0."""
+    if not isinstance(hs_coeff, (tuple, list)):
+        return False
+    coeffs = hs_coeff[:index + 2]
+    if not all(isinstance(c, (int, float)) for c in coeffs):
+        return False
+    return coeffs[0] == 1 and not any(coeffs[1:])
+
+
+def cat_skip(h, skip, n_edit=None):
+    """`torch.cat([h, skip], dim=1)` for a stacked [h2; h] decoder batch.
+
+    The edited half takes the same skips as the original one (all of them, or
+    the first n_edit samples); without n_edit the skips are expanded, not copied.
+    """
+    if n_edit is None:
+        n = skip.shape[0]
+        return torch.cat([h.unflatten(0, (2, n)), skip.expand(2, *skip.shape)], dim=2).flatten(0, 1)
+    return torch.cat([h, torch.cat([skip[:n_edit], skip], dim=0)], dim=1)
+
+
+def edit_half(x, n_edit=None):
+    """The samples of `x` (a tensor or a list of skips) that take the edited h2 path.
+
+    With n_edit, only the first n_edit samples (the edited half of a twin
+    batch, see denoising_step_twin) go through the delta path and the h2
+    decoder; without it, all of them.
+    """
+    if n_edit is None:
+        return x
+    if isinstance(x, (list, tuple)):
+        return [s[:n_edit] for s in x]
+    return x[:n_edit]
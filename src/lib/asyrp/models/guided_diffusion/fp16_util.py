@@ -12,14 +12,14 @@ from . import logger
 INITIAL_LOG_LOSS_SCALE = 20.0
 
 
-def convert_module_to_f16(l):
+def convert_module_to_f16(l, dtype=th.float16):
     """
-    Convert primitive modules to float16.
+    Convert primitive modules to float16 (or another 16-bit `dtype`, e.g. bfloat16).
     """
     if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
-        l.weight.data = l.weight.data.half()
+        l.weight.data = l.weight.data.to(dtype)
         if l.bias is not None:
-            l.bias.data = l.bias.data.half()
+            l.bias.data = l.bias.data.to(dtype)
 
 
 def convert_module_to_f32(l):
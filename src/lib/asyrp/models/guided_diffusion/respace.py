@@ -104,8 +104,15 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
+        if not hasattr(self, "_map_tensors"):
+            # shared by every wrapper so the map is uploaded once per device
+            self._map_tensors = {}
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model,
+            self.timestep_map,
+            self.rescale_timesteps,
+            self.original_num_steps,
+            map_tensors=self._map_tensors,
         )
 
     def _scale_timesteps(self, t):
@@ -114,14 +121,20 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps,
+                 map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        key = (ts.device, ts.dtype)
+        map_tensor = self.map_tensors.get(key)
+        if map_tensor is None:
+            map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+            self.map_tensors[key] = map_tensor
         new_ts = map_tensor[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
@@ -12,6 +12,8 @@ import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..attention import use_sdpa, sdpa_bct
+from ..edit_utils import is_noop_edit, cat_skip, edit_half
 from .fp16_util import convert_module_to_f16, convert_module_to_f32
 from .nn import (
     checkpoint,
@@ -60,7 +62,6 @@ def slerp(t,v0,v1):
     return v2
 
 
-
 class AttentionPool2d(nn.Module):
     """
     Adapted from CLIP: https://github.com/openai/CLIP/blob/main/clip/model.py
@@ -387,6 +388,8 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
+        if use_sdpa():
+            return sdpa_bct(q, k, v).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -420,6 +423,8 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if use_sdpa():
+            return sdpa_bct(*(y.reshape(bs * self.n_heads, ch, length) for y in (q, k, v))).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -508,6 +513,8 @@ class UNetModel(nn.Module):
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
+        # decode h2 and h as one stacked batch (set by the runner)
+        self.stack_decoders = False
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -657,13 +664,14 @@ class UNetModel(nn.Module):
             zero_module(conv_nd(dims, input_ch, out_channels, 3, padding=1)),
         )
 
-    def convert_to_fp16(self):
+    def convert_to_fp16(self, dtype=th.float16):
         """
-        Convert the torso of the model to float16.
+        Convert the torso of the model to float16 (or bfloat16).
         """
-        self.input_blocks.apply(convert_module_to_f16)
-        self.middle_block.apply(convert_module_to_f16)
-        self.output_blocks.apply(convert_module_to_f16)
+        self.input_blocks.apply(lambda l: convert_module_to_f16(l, dtype))
+        self.middle_block.apply(lambda l: convert_module_to_f16(l, dtype))
+        self.output_blocks.apply(lambda l: convert_module_to_f16(l, dtype))
+        self.dtype = dtype
 
     def convert_to_fp32(self):
         """
@@ -672,8 +680,9 @@ class UNetModel(nn.Module):
         self.input_blocks.apply(convert_module_to_f32)
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
+        self.dtype = th.float32
 
-    def forward(self, x, timesteps, y=None, index=None, t_edit=400, hs_coeff=(1.0, 1.0), delta_h=None, ignore_timestep=False, use_mask=False):
+    def forward(self, x, timesteps, y=None, index=None, t_edit=400, hs_coeff=(1.0, 1.0), delta_h=None, ignore_timestep=False, use_mask=False, n_edit=None):
         """
         Apply the model to an input batch.
 
@@ -695,60 +704,75 @@ class UNetModel(nn.Module):
         h2 = None
         
         if index is not None:
+            h_edit, emb_edit, hs_edit = edit_half(h, n_edit), edit_half(emb, n_edit), edit_half(hs, n_edit)
+
             # assert len(hs_coeff) == index + 1 + 1
             # check t_edit 
-            if timesteps[0] >= t_edit:
+            # the edited branch is skipped when it would decode h_edit unchanged:
+            # t < t_edit, or hs_coeff keeps h and drops every delta (Asyrp only)
+            edit = bool(timesteps[0] >= t_edit) and not (delta_h is None and is_noop_edit(hs_coeff, index))
+            if edit:
                 # use DeltaBlock
                 if delta_h is None: #Asyrp
-                    h2 = h * hs_coeff[0]
+                    h2 = h_edit * hs_coeff[0]
                     for i in range(index+1):
-                        delta_h = getattr(self, f"layer_{i}")(h, None if ignore_timestep else emb)
+                        delta_h = getattr(self, f"layer_{i}")(h_edit, None if ignore_timestep else emb_edit)
                         h2 += delta_h * hs_coeff[i+1]
                 # use input delta_h  : even tough you does not use DeltaBlock, you need to use index is 0.
                 else:  #DiffStyle # DiffStyle; Just ignore this code. We will update about it in README.md later.
                     if use_mask:
-                        mask = th.zeros_like(h)
+                        mask = th.zeros_like(h_edit)
                         mask[:,:,4:-1,3:5] = 1.0
                         inverted_mask = 1 - mask
 
                         masked_delta_h = delta_h * mask
-                        masked_h = h * mask
+                        masked_h = h_edit * mask
 
                         partial_h2 = slerp(1-hs_coeff[0], masked_h, masked_delta_h)
-                        h2 = partial_h2 + inverted_mask * h
+                        h2 = partial_h2 + inverted_mask * h_edit
 
 
                     else:
-                        h_shape = h.shape
-                        h_copy = h.clone().view(h_shape[0],-1)
+                        h_shape = h_edit.shape
+                        h_copy = h_edit.clone().view(h_shape[0],-1)
                         delta_h_copy = delta_h.clone().view(h_shape[0],-1)
 
                         h_norm = th.norm(h_copy, dim=1).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
                         delta_h_norm = th.norm(delta_h_copy, dim=1).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
                         normalized_delta_h = h_norm * delta_h / delta_h_norm
                         
-                        h2 = slerp(1.0-hs_coeff[0], h, normalized_delta_h)
+                        h2 = slerp(1.0-hs_coeff[0], h_edit, normalized_delta_h)
 
-            # when t[0] < t_edit : pass the delta_h
-            else:
-                h2 = h
+            if edit and not self.stack_decoders:
+                hs_index = -1
+                for module in self.output_blocks:
+                    h2 = th.cat([h2, hs_edit[hs_index]], dim=1)
+                    hs_index -= 1
+                    h2 = module(h2, emb_edit)
+                h2 = h2.type(x.dtype)
 
-            hs_index = -1
-            for module in self.output_blocks:
-                h2 = th.cat([h2, hs[hs_index]], dim=1)
-                hs_index -= 1
-                h2 = module(h2, emb)
-            h2 = h2.type(x.dtype)
+                h2 = self.out(h2)
 
-            h2 = self.out(h2)
+        # with stack_decoders, h2 and h go through the decoder as one batch
+        stacked = index is not None and edit and self.stack_decoders
+        if stacked:
+            n2 = h2.shape[0]
+            h, emb = th.cat([h2, h], dim=0), th.cat([emb_edit, emb], dim=0)
 
         for module in self.output_blocks:
-            h = th.cat([h, hs.pop()], dim=1)
+            skip = hs.pop()
+            h = cat_skip(h, skip, n_edit) if stacked else th.cat([h, skip], dim=1)
             h = module(h, emb)
         h = h.type(x.dtype)
 
         h = self.out(h)
+
+        if stacked:
+            h2, h = h[:n2], h[n2:]
         
+        if index is not None and not edit:
+            h2 = edit_half(h, n_edit)
+
         return h, h2, delta_h, middle_h
         
 
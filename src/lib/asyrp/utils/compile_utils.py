@@ -0,0 +1,53 @@
+import os
+
+import torch
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'asyrp', 'inductor')
+
+
+def set_compile_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """Keep the inductor artifacts in `cache_dir`, so later runs with the same
+    shapes reuse the generated kernels (and, on torch versions with an FX graph
+    cache, the compiled graphs) instead of compiling again."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def compile_method(module, name, mode='default'):
+    # the compiled bound method replaces the instance attribute; the module and
+    # its state_dict keys stay the same, so checkpoints are not affected
+    setattr(module, name, torch.compile(getattr(module, name), mode=mode, dynamic=False))
+
+
+def compile_model(model, mode='default', cache_dir=DEFAULT_CACHE_DIR):
+    """Compile the UNet encoder, middle block and decoder of a DDPM and each of
+    its DeltaBlocks (`layer_{i}`) as separate static-shape graphs.
+
+    Other model families have no separate encode/middle/decode and are
+    compiled as a whole.
+    """
+    set_compile_cache(cache_dir)
+    if all(hasattr(model, name) for name in ('encode', 'middle', 'decode')):
+        for name in ('encode', 'middle', 'decode'):
+            compile_method(model, name, mode)
+        i = 0
+        while hasattr(model, f'layer_{i}'):
+            compile_method(getattr(model, f'layer_{i}'), 'forward', mode)
+            i += 1
+    else:
+        compile_method(model, 'forward', mode)
+    return model
+
+
+def warmup(model, batch_size, image_size, device, index=None, grad=False):
+    """Run the compilation for the shapes of a run once, before anything is timed."""
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    t = torch.full((batch_size,), 500, device=device)
+    with torch.set_grad_enabled(grad):
+        model(x, t)
+        if index is not None:
+            model(x, t, index=index, t_edit=0, hs_coeff=(1.0,) + (1.0,) * (index + 1))
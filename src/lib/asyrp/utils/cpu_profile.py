@@ -0,0 +1,77 @@
+import contextlib
+import os
+
+import torch
+
+
+class SingleDevice(torch.nn.Module):
+    """DataParallel's interface (`.module`, the 'module.' state_dict prefix)
+    without its per-call replicate/scatter/gather, for a model that runs on a
+    single device anyway."""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+
+def physical_cores(cpus):
+    """One logical CPU per physical core among `cpus`; hyper-threads share the
+    core's execution units, so an extra intra-op thread on them only adds
+    contention."""
+    chosen, seen = [], set()
+    for cpu in sorted(cpus):
+        siblings = f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list'
+        if os.path.exists(siblings):
+            with open(siblings) as f:
+                key = f.read().strip()
+        else:
+            key = str(cpu)
+        if key not in seen:
+            seen.add(key)
+            chosen.append(cpu)
+    return chosen
+
+
+def configure_threads(num_threads=None, interop_threads=1, worker_id=0, n_workers=1):
+    """Pin this process to its share of the available physical cores and size
+    torch's intra-op pool to match.
+
+    With `n_workers` precompute workers, worker `worker_id` takes a contiguous
+    slice of the cores so the workers do not compete for them. Returns the
+    cores the process is pinned to.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = physical_cores(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if n_workers > 1:
+        share = max(1, len(cores) // n_workers)
+        cores = cores[worker_id * share:(worker_id + 1) * share] or cores[-share:]
+    if num_threads:
+        cores = cores[:num_threads]
+    if hasattr(os, 'sched_setaffinity'):
+        # set before the OpenMP pool starts, so its threads inherit it
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # can only be set once, before any inter-op work has started
+        pass
+    return cores
+
+
+def to_channels_last(model):
+    """Convert the conv weights of the UNet and its DeltaBlocks to NHWC. The
+    inputs do not need converting: a conv with channels_last weights returns
+    channels_last activations, which the following layers keep."""
+    return model.to(memory_format=torch.channels_last)
+
+
+def cpu_autocast(enabled):
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast('cpu', dtype=torch.bfloat16)
@@ -1,6 +1,8 @@
 import numpy as np
 import torch
 
+from utils.profiling import region
+
 
 def get_beta_schedule(*, beta_start, beta_end, num_diffusion_timesteps):
     betas = np.linspace(beta_start, beta_end,
@@ -9,12 +11,95 @@ def get_beta_schedule(*, beta_start, beta_end, num_diffusion_timesteps):
     return betas
 
 
+class DiffusionSchedule(object):
+    """Beta schedule and its derived coefficients, kept as device tensors.
+
+    Build it once per run and pass it to `denoising_step` as `schedule=`;
+    coefficients are then looked up by timestep index instead of being
+    rebuilt from numpy (and re-cumprod'ed) on every call.
+
+    Every table has one trailing entry for t = -1 (the end of a generative
+    process), so `lookup` can be indexed with `t_next` directly: alpha_bar
+    is 1 there, exactly like the `at_next = torch.ones_like(at)` special case.
+    """
+
+    def __init__(self, betas, logvars=None, device=None):
+        # same float32 arithmetic as the old per-step `(1.0 - b).cumprod(dim=0)`
+        betas = torch.as_tensor(betas).float()
+        if device is not None:
+            betas = betas.to(device)
+        self.device = betas.device
+        self.num_timesteps = betas.shape[0]
+
+        one = torch.ones(1, dtype=betas.dtype, device=betas.device)
+        zero = torch.zeros(1, dtype=betas.dtype, device=betas.device)
+
+        alphas_cumprod = (1.0 - betas).cumprod(dim=0)
+        self.betas = torch.cat([betas, zero])
+        self.alphas_cumprod = torch.cat([alphas_cumprod, one])
+        self.sqrt_alphas_cumprod = self.alphas_cumprod.sqrt()
+        self.sqrt_one_minus_alphas_cumprod = (1 - self.alphas_cumprod).sqrt()
+        if logvars is not None:
+            logvars = torch.as_tensor(logvars, dtype=torch.float, device=betas.device)
+            self.logvars = torch.cat([logvars, zero])
+        else:
+            self.logvars = None
+
+        self._per_device = {self.device: self}
+
+    def to(self, device):
+        """Return the schedule on `device`; copies are made once and cached."""
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        if device not in self._per_device:
+            other = DiffusionSchedule.__new__(DiffusionSchedule)
+            other.device = device
+            other.num_timesteps = self.num_timesteps
+            for name in ('betas', 'alphas_cumprod', 'sqrt_alphas_cumprod',
+                         'sqrt_one_minus_alphas_cumprod', 'logvars'):
+                value = getattr(self, name)
+                setattr(other, name, None if value is None else value.to(device))
+            other._per_device = self._per_device
+            self._per_device[device] = other
+        return self._per_device[device]
+
+    def lookup(self, name, t, x_shape):
+        """Gather `name` at timesteps `t` and reshape to broadcast with x_shape."""
+        table = getattr(self, name)
+        if table is None:
+            raise ValueError(f"schedule was built without {name}")
+        if table.device != t.device:
+            table = getattr(self.to(t.device), name)
+        bs, = t.shape
+        out = table[t.long()]
+        return out.reshape((bs,) + (1,) * (len(x_shape) - 1))
+
+
+_schedules = {}  # (id(b), id(logvars), device) -> (b, logvars, DiffusionSchedule)
+
+
+def cached_schedule(b, logvars, device):
+    """The DiffusionSchedule of `b`/`logvars` on `device`, built once per
+    (b, logvars) object, for callers that do not pass `schedule=`."""
+    key = (id(b), id(logvars), str(device))
+    entry = _schedules.get(key)
+    # the stored references keep the ids valid; a match must be the same objects
+    if entry is None or entry[0] is not b or entry[1] is not logvars:
+        if len(_schedules) >= 8:
+            _schedules.clear()
+        entry = (b, logvars, DiffusionSchedule(b, logvars, device=device))
+        _schedules[key] = entry
+    return entry[2]
+
+
 def extract(a, t, x_shape):
     """Extract coefficients from a based on t and reshape to make it
     broadcastable with x_shape."""
     bs, = t.shape
     assert x_shape[0] == bs, f"{x_shape[0]}, {t.shape}"
-    out = torch.gather(torch.tensor(a, dtype=torch.float, device=t.device), 0, t.long())
+    # as_tensor does not copy when `a` already is a float tensor on t.device
+    out = torch.gather(torch.as_tensor(a, dtype=torch.float, device=t.device), 0, t.long())
     assert out.shape == (bs,)
     out = out.reshape((bs,) + (1,) * (len(x_shape) - 1))
     return out
@@ -38,19 +123,26 @@ def denoising_step(xt, t, t_next, *,
                    image_space_noise=0,
                    dt_end = 999,
                    warigari=False,
+                   schedule=None,
                    ):
 
+    # `schedule` is the run-wide DiffusionSchedule; without it the one built
+    # for `b`/`logvars` on the first such call is reused.
+    if schedule is None:
+        schedule = cached_schedule(b, logvars, xt.device)
+
     # Compute noise and variance
     model = models
 
-    et, et_modified, delta_h, middle_h = model(xt, t, index=index, t_edit=t_edit, hs_coeff=hs_coeff, delta_h=delta_h, ignore_timestep=ignore_timestep, use_mask=use_mask)
+    with region('denoising_step/model', n=xt.shape[0]):
+        et, et_modified, delta_h, middle_h = model(xt, t, index=index, t_edit=t_edit, hs_coeff=hs_coeff, delta_h=delta_h, ignore_timestep=ignore_timestep, use_mask=use_mask)
     if learn_sigma:
         et, logvar_learned = torch.split(et, et.shape[1] // 2, dim=1)
         if index is not None:
             et_modified, _ = torch.split(et_modified, et_modified.shape[1] // 2, dim=1)
         logvar = logvar_learned
     else:
-        logvar = extract(logvars, t, xt.shape)
+        logvar = None
 
     if type(image_space_noise) != int:
         if t[0] >= t_edit:
@@ -63,16 +155,20 @@ def denoising_step(xt, t, t_next, *,
                 et_modified = et + image_space_noise(et, temb) * 0.01
 
     # Compute the next x
-    bt = extract(b, t, xt.shape)
-    at = extract((1.0 - b).cumprod(dim=0), t, xt.shape)
-    if t_next.sum() == -t_next.shape[0]:
-        at_next = torch.ones_like(at)
-    else:
-        at_next = extract((1.0 - b).cumprod(dim=0), t_next, xt.shape)
+    # t_next == -1 looks up the trailing alpha_bar = 1 entry of the schedule
+    at = schedule.lookup('alphas_cumprod', t, xt.shape)
+    at_next = schedule.lookup('alphas_cumprod', t_next, xt.shape)
+    sqrt_at = schedule.lookup('sqrt_alphas_cumprod', t, xt.shape)
+    sqrt_1m_at = schedule.lookup('sqrt_one_minus_alphas_cumprod', t, xt.shape)
+    sqrt_at_next = schedule.lookup('sqrt_alphas_cumprod', t_next, xt.shape)
+    sqrt_1m_at_next = schedule.lookup('sqrt_one_minus_alphas_cumprod', t_next, xt.shape)
 
     xt_next = torch.zeros_like(xt)
     if sampling_type == 'ddpm':
-        weight = bt / torch.sqrt(1 - at)
+        bt = schedule.lookup('betas', t, xt.shape)
+        if logvar is None:
+            logvar = schedule.lookup('logvars', t, xt.shape)
+        weight = bt / sqrt_1m_at
 
         mean = 1 / torch.sqrt(1.0 - bt) * (xt - weight * et)
         noise = torch.randn_like(xt)
@@ -83,21 +179,21 @@ def denoising_step(xt, t, t_next, *,
 
     elif sampling_type == 'ddim':
         if index is not None:
-            x0_t = (xt - et_modified * (1 - at).sqrt()) / at.sqrt()
+            x0_t = (xt - et_modified * sqrt_1m_at) / sqrt_at
         else:
-            x0_t = (xt - et * (1 - at).sqrt()) / at.sqrt()
+            x0_t = (xt - et * sqrt_1m_at) / sqrt_at
 
         # Deterministic.
         if eta == 0:
-            xt_next = at_next.sqrt() * x0_t + (1 - at_next).sqrt() * et
+            xt_next = sqrt_at_next * x0_t + sqrt_1m_at_next * et
         # Add noise. When eta is 1 and time step is 1000, it is equal to ddpm.
         else:
             c1 = eta * ((1 - at / (at_next)) * (1 - at_next) / (1 - at)).sqrt()
             c2 = ((1 - at_next) - c1 ** 2).sqrt()
-            xt_next = at_next.sqrt() * x0_t + c2 * et + c1 * torch.randn_like(xt)
+            xt_next = sqrt_at_next * x0_t + c2 * et + c1 * torch.randn_like(xt)
 
     if dt_lambda != 1 and t[0] >= dt_end:
-        xt_next = at_next.sqrt() * x0_t + (1 - at_next).sqrt() * et * dt_lambda
+        xt_next = sqrt_at_next * x0_t + sqrt_1m_at_next * et * dt_lambda
 
     # Asyrp & DiffStyle
     if not warigari or index is None:
@@ -106,4 +202,60 @@ def denoising_step(xt, t, t_next, *,
     # Warigari by young-hyun, Not in the paper
     else:
         # will be updated
-        return xt_next, x0_t, delta_h, middle_h
\ No newline at end of file
+        return xt_next, x0_t, delta_h, middle_h
+
+def denoising_step_twin(xt, x_origin, t, t_next, *,
+                        models,
+                        logvars,
+                        b,
+                        sampling_type='ddim',
+                        eta=0.0,
+                        learn_sigma=False,
+                        index=0,
+                        t_edit=0,
+                        hs_coeff=(1.0),
+                        delta_h=None,
+                        use_mask=False,
+                        ignore_timestep=False,
+                        schedule=None,
+                        ):
+    """One DDIM step of the edited (`xt`) and the unedited (`x_origin`) trajectory
+    in a single model call.
+
+    Both halves are stacked on the batch axis; the model's `n_edit` keeps the
+    delta path to the first half, and the origin half is detached, so gradients
+    only reach the DeltaBlocks through the edited half. Returns
+    (xt_next, x0_t, x_origin_next, x0_t_origin).
+
+    The stacked batch must not be scattered, so a DataParallel model is run on
+    its own device only.
+    """
+    if sampling_type != 'ddim' or eta != 0:
+        raise ValueError("denoising_step_twin only supports deterministic DDIM (sampling_type='ddim', eta=0)")
+    if schedule is None:
+        schedule = cached_schedule(b, logvars, xt.device)
+
+    model = models.module if isinstance(models, torch.nn.DataParallel) else models
+    n = xt.shape[0]
+
+    with region('denoising_step_twin/model', n=2 * n):
+        et, et_modified, delta_h, middle_h = model(torch.cat([xt, x_origin], dim=0), torch.cat([t, t], dim=0),
+                                                   index=index, t_edit=t_edit, hs_coeff=hs_coeff, delta_h=delta_h,
+                                                   ignore_timestep=ignore_timestep, use_mask=use_mask, n_edit=n)
+    if learn_sigma:
+        et, _ = torch.split(et, et.shape[1] // 2, dim=1)
+        et_modified, _ = torch.split(et_modified, et_modified.shape[1] // 2, dim=1)
+    et, et_origin = et[:n], et[n:].detach()
+
+    sqrt_at = schedule.lookup('sqrt_alphas_cumprod', t, xt.shape)
+    sqrt_1m_at = schedule.lookup('sqrt_one_minus_alphas_cumprod', t, xt.shape)
+    sqrt_at_next = schedule.lookup('sqrt_alphas_cumprod', t_next, xt.shape)
+    sqrt_1m_at_next = schedule.lookup('sqrt_one_minus_alphas_cumprod', t_next, xt.shape)
+
+    x0_t = (xt - et_modified * sqrt_1m_at) / sqrt_at
+    xt_next = sqrt_at_next * x0_t + sqrt_1m_at_next * et
+
+    x0_t_origin = (x_origin - et_origin * sqrt_1m_at) / sqrt_at
+    x_origin_next = sqrt_at_next * x0_t_origin + sqrt_1m_at_next * et_origin
+
+    return xt_next, x0_t, x_origin_next, x0_t_origin
@@ -0,0 +1,230 @@
+import atexit
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+
+import numpy as np
+import torch
+import torchvision.utils as tvu
+from PIL import Image
+
+
+def to_uint8(tensor, nrow=8, padding=2):
+    """[N, C, H, W] (as a grid) or [C, H, W] tensor in [0, 1] -> [H, W, C] uint8 array,
+    rounded like torchvision.utils.save_image."""
+    if tensor.dim() == 4:
+        tensor = tvu.make_grid(tensor, nrow=nrow, padding=padding)
+    return tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
+
+
+class GridCanvas(object):
+    """The uint8 image of tvu.make_grid(x, nrow=ncol, padding=padding) for an x of
+    n_rows * ncol images, filled one row of ncol images at a time.
+
+    A long grid (e.g. a delta_interpolation sweep) is then built while its rows
+    are produced, instead of keeping every image until the grid is written.
+    """
+
+    def __init__(self, n_rows, ncol, height, width, channels=3, padding=2):
+        self.height, self.width, self.padding = height, width, padding
+        self.array = np.zeros((n_rows * (height + padding) + padding, ncol * (width + padding) + padding, channels),
+                              dtype=np.uint8)
+
+    def put(self, row, images):
+        """Place `images` ([ncol, C, H, W] in [0, 1]) in grid row `row`."""
+        p, h, w = self.padding, self.height, self.width
+        y = row * (h + p) + p
+        for k, image in enumerate(images):
+            x = k * (w + p) + p
+            self.array[y:y + h, x:x + w] = to_uint8(image)
+
+
+def encode_png(array, compress_level=6):
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, format='PNG', compress_level=compress_level)
+    return buf.getvalue()
+
+
+class FileSink(object):
+    """Every image is its own PNG at the given path (the old layout)."""
+
+    def __init__(self, compress_level=6):
+        self.compress_level = compress_level
+
+    def write(self, path, array):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        data = encode_png(array, self.compress_level)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def close(self):
+        pass
+
+
+class TarSink(object):
+    """PNGs appended to {root}/images-{n}.tar shards of `shard_size` members,
+    named by their path relative to `root`."""
+
+    def __init__(self, root, compress_level=6, shard_size=1000):
+        self.root = root
+        self.compress_level = compress_level
+        self.shard_size = shard_size
+        self._lock = threading.Lock()
+        self._tar = None
+        self._n_members = 0
+        self._n_shards = 0
+
+    def _open_shard(self):
+        os.makedirs(self.root, exist_ok=True)
+        while os.path.exists(os.path.join(self.root, f'images-{self._n_shards:05d}.tar')):
+            self._n_shards += 1
+        self._tar = tarfile.open(os.path.join(self.root, f'images-{self._n_shards:05d}.tar'), 'w')
+        self._n_members = 0
+
+    def write(self, path, array):
+        data = encode_png(array, self.compress_level)  # encoded outside the lock
+        info = tarfile.TarInfo(os.path.relpath(path, self.root))
+        info.size = len(data)
+        info.mtime = time.time()
+        with self._lock:
+            if self._tar is None or self._n_members == self.shard_size:
+                self.close()
+                self._open_shard()
+            self._tar.addfile(info, io.BytesIO(data))
+            self._n_members += 1
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
+
+
+class NpzSink(object):
+    """Raw uint8 arrays, flushed to uncompressed {root}/images-{n}.npz shards of
+    `shard_size` images, keyed by their path relative to `root`."""
+
+    def __init__(self, root, shard_size=1000):
+        self.root = root
+        self.shard_size = shard_size
+        self._lock = threading.Lock()
+        self._arrays = {}
+        self._n_shards = 0
+
+    def write(self, path, array):
+        with self._lock:
+            self._arrays[os.path.relpath(path, self.root)] = array
+            if len(self._arrays) == self.shard_size:
+                self._flush()
+        return None
+
+    def _flush(self):
+        if not self._arrays:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        while os.path.exists(os.path.join(self.root, f'images-{self._n_shards:05d}.npz')):
+            self._n_shards += 1
+        np.savez(os.path.join(self.root, f'images-{self._n_shards:05d}.npz'), **self._arrays)
+        self._arrays = {}
+
+    def close(self):
+        with self._lock:
+            self._flush()
+
+
+def get_sink(sink, root, compress_level=6, shard_size=1000):
+    if sink == 'files':
+        return FileSink(compress_level)
+    elif sink == 'tar':
+        return TarSink(root, compress_level, shard_size)
+    elif sink == 'npz':
+        return NpzSink(root, shard_size)
+    raise ValueError(f"unknown image sink {sink}")
+
+
+class AsyncImageWriter(object):
+    """Encodes and writes images on `num_workers` background threads.
+
+    `save` copies the tensor to the host and returns; at most `max_pending`
+    images wait in the queue, after that `save` blocks. With `log_fn`, every
+    image saved with a `log_key` is handed to log_fn(key, image) once written,
+    where image is the file path, or the uint8 array for tar/npz sinks.
+    num_workers=0 writes in the calling thread.
+
+    Errors of the workers are raised by the next `save` or `flush`.
+    """
+
+    _STOP = object()
+
+    def __init__(self, sink, num_workers=2, max_pending=16, log_fn=None):
+        self.sink = sink
+        self.log_fn = log_fn
+        self.num_workers = num_workers
+        self._error = None
+        self._jobs = queue.Queue(maxsize=max(max_pending, 1))
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+        self._closed = False
+        atexit.register(self.close)
+
+    def save(self, tensor, path, nrow=8, padding=2, log_key=None):
+        """Write `tensor` ([N, C, H, W] as a grid, or [C, H, W]; values in [0, 1]) to `path`.
+
+        An [H, W, C] uint8 array (e.g. GridCanvas.array) is written as is; it must
+        not be modified afterwards.
+        """
+        self._raise_error()
+        if isinstance(tensor, np.ndarray):
+            job = (tensor, path, nrow, padding, log_key)
+        else:
+            job = (tensor.detach().to('cpu', copy=True), path, nrow, padding, log_key)
+        if self.num_workers == 0:
+            self._write(*job)
+        else:
+            self._jobs.put(job)
+
+    def _write(self, tensor, path, nrow, padding, log_key):
+        array = tensor if isinstance(tensor, np.ndarray) else to_uint8(tensor, nrow=nrow, padding=padding)
+        written = self.sink.write(path, array)
+        if log_key is not None and self.log_fn is not None:
+            self.log_fn(log_key, written if written is not None else array)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is self._STOP:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self):
+        """Wait until every queued image is written."""
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._jobs.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+        self.sink.close()
+        self._raise_error()
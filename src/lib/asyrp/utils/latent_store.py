@@ -0,0 +1,237 @@
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+
+MANIFEST = 'manifest.json'
+
+
+def _write_json(path, obj):
+    # write-then-rename, so readers never see a half written file
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+class LatentStore(object):
+    """Precomputed latents kept in fixed-shape, memory-mapped .npy shards.
+
+    Layout of `root`:
+        manifest.json            key (dataset, category, mode, t_0, n_inv_step), dtype, field shapes
+        {shard}.{field}.npy      [shard_size, *shape] array per field
+        {shard}.json             image index of every row written to the shard
+        claims/{start}-{stop}.lock   image ranges taken by a writer (see `claim`)
+
+    A shard's .json is (re)written atomically after its rows are flushed, so
+    a crashed run only loses the rows written since the last flush. Shards
+    are named after the writer, so several processes can fill one store.
+    """
+
+    def __init__(self, root, key, dtype='float32', shard_size=256, writer='w0'):
+        self.root = root
+        self.key = dict(key)
+        self.shard_size = shard_size
+        self.writer = writer
+        os.makedirs(os.path.join(root, 'claims'), exist_ok=True)
+
+        manifest_path = os.path.join(root, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['key'] != self.key:
+                raise ValueError(f"{root} holds latents for {manifest['key']}, not {self.key}")
+            self.dtype = np.dtype(manifest['dtype'])
+            self.shard_size = manifest['shard_size']
+            self.fields = {name: tuple(shape) for name, shape in manifest['fields'].items()}
+        else:
+            self.dtype = np.dtype(dtype)
+            self.fields = None  # set by the first append
+
+        self._arrays = {}   # (shard, field) -> np.memmap
+        self._index = {}    # image index -> (shard, row)
+        self._shard = None  # shard currently written by this process
+        self._rows = []
+        self.refresh()
+
+    # ----------- index -----------#
+    def refresh(self):
+        """Pick up shards flushed by other writers since the store was opened."""
+        for path in sorted(glob.glob(os.path.join(self.root, '*.json'))):
+            shard = os.path.basename(path)[:-len('.json')]
+            if shard == MANIFEST[:-len('.json')] or shard == self._shard:
+                continue
+            with open(path) as f:
+                rows = json.load(f)['indices']
+            for row, idx in enumerate(rows):
+                self._index.setdefault(idx, (shard, row))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, idx):
+        return idx in self._index
+
+    def indices(self):
+        return sorted(self._index)
+
+    # ----------- work claiming -----------#
+    def _claim_path(self, start, stop):
+        return os.path.join(self.root, 'claims', f'{start:07d}-{stop:07d}.lock')
+
+    def claim(self, start, stop, stale_after=None):
+        """Take image indices [start, stop) for this writer; False if someone else has them.
+
+        The lock file is created with O_EXCL, which is atomic on local and NFS
+        (v3+) filesystems. A lock its owner has not touched for `stale_after`
+        seconds is taken over; in the worst case two writers then compute the
+        same images, and readers keep the first copy.
+        """
+        path = self._claim_path(start, stop)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except FileNotFoundError:
+                age = 0
+            if stale_after is None or age < stale_after:
+                return False
+            print(f'Taking over stale claim {path}')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return self.claim(start, stop)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.writer)
+        return True
+
+    def touch_claim(self, start, stop):
+        """Heartbeat, so that a long running claim is not taken for stale."""
+        os.utime(self._claim_path(start, stop))
+
+    # ----------- write -----------#
+    def append(self, idx, **tensors):
+        """Store the fields of image `idx`; each tensor is [*shape] or [1, *shape]."""
+        arrays = {}
+        for name, value in tensors.items():
+            if torch.is_tensor(value):
+                value = value.detach().cpu().numpy()
+            if value.ndim > 1 and value.shape[0] == 1:
+                value = value[0]
+            arrays[name] = value
+
+        if self.fields is None:
+            self.fields = {name: tuple(value.shape) for name, value in arrays.items()}
+            _write_json(os.path.join(self.root, MANIFEST), {
+                'key': self.key,
+                'dtype': self.dtype.name,
+                'shard_size': self.shard_size,
+                'fields': {name: list(shape) for name, shape in self.fields.items()},
+            })
+        if set(arrays) != set(self.fields):
+            raise ValueError(f"expected fields {sorted(self.fields)}, got {sorted(arrays)}")
+
+        if self._shard is None or len(self._rows) == self.shard_size:
+            self._new_shard()
+        row = len(self._rows)
+        for name, value in arrays.items():
+            self._arrays[(self._shard, name)][row] = value
+        self._rows.append(idx)
+        self._index[idx] = (self._shard, row)
+
+    def flush(self):
+        if self._shard is None:
+            return
+        for name in self.fields:
+            self._arrays[(self._shard, name)].flush()
+        _write_json(os.path.join(self.root, f'{self._shard}.json'), {'indices': self._rows})
+
+    def _new_shard(self):
+        self.flush()
+        taken = glob.glob(os.path.join(self.root, f'{self.writer}-*.json'))
+        n = len(taken)
+        while os.path.exists(os.path.join(self.root, f'{self.writer}-{n:05d}.json')):
+            n += 1
+        self._shard = f'{self.writer}-{n:05d}'
+        self._rows = []
+        for name, shape in self.fields.items():
+            path = os.path.join(self.root, f'{self._shard}.{name}.npy')
+            self._arrays[(self._shard, name)] = np.lib.format.open_memmap(
+                path, mode='w+', dtype=self.dtype, shape=(self.shard_size,) + shape)
+        # claim the name right away; rows become visible on flush
+        _write_json(os.path.join(self.root, f'{self._shard}.json'), {'indices': []})
+
+    # ----------- read -----------#
+    def _array(self, shard, name):
+        if (shard, name) not in self._arrays:
+            # copy-on-write mapping: writable for torch.from_numpy, never written back
+            self._arrays[(shard, name)] = np.load(os.path.join(self.root, f'{shard}.{name}.npy'), mmap_mode='c')
+        return self._arrays[(shard, name)]
+
+    def get(self, idx, name):
+        """[1, *shape] tensor of image `idx`, sharing memory with the shard."""
+        shard, row = self._index[idx]
+        return torch.from_numpy(self._array(shard, name)[row:row + 1])
+
+    def get_batch(self, indices, name):
+        """[N, *shape] tensor; a view when the indices are consecutive rows of one shard."""
+        locs = [self._index[idx] for idx in indices]
+        shard, first = locs[0]
+        if all(loc == (shard, first + k) for k, loc in enumerate(locs)):
+            return torch.from_numpy(self._array(shard, name)[first:first + len(locs)])
+        return torch.cat([self.get(idx, name) for idx in indices], dim=0)
+
+    def pairs(self, indices):
+        return LatentPairs(self, indices)
+
+
+class LatentPairs(object):
+    """Read-only view with the layout of the old pickled pairs lists.
+
+    Item k is [x0, x_rec, x_lat] of image indices[k], each a [1, C, H, W]
+    float tensor (zero-copy for float32 stores).
+    """
+
+    names = ('x0', 'x_rec', 'x_lat')
+
+    def __init__(self, store, indices):
+        self.store = store
+        self.indices = list(indices)
+        missing = [idx for idx in self.indices if idx not in store]
+        if missing:
+            raise KeyError(f"{store.root} has no latents for images {missing[:8]}{'...' if len(missing) > 8 else ''}")
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        idx = self.indices[k]
+        return [self.store.get(idx, name).float() for name in self.names]
+
+
+class OriginTrajectories(object):
+    """Per-image {t: (x_t, x0_t)} of the unedited DDIM path, read from a LatentStore.
+
+    The store keeps them as `origin_xt` / `origin_x0t` fields of shape
+    [len(ts), C, H, W], with ts in generative order.
+    """
+
+    def __init__(self, store, indices, ts):
+        self.store = store
+        self.indices = list(indices)
+        self.ts = [int(t) for t in ts]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        idx = self.indices[k]
+        xt = self.store.get(idx, 'origin_xt')[0].float()
+        x0t = self.store.get(idx, 'origin_x0t')[0].float()
+        return {t: (xt[it:it + 1], x0t[it:it + 1]) for it, t in enumerate(self.ts)}
@@ -0,0 +1,185 @@
+import atexit
+import os
+import threading
+
+import torch
+
+from models.guided_diffusion.logger import make_output_format
+
+
+class WandbBackend(object):
+    def __init__(self, args):
+        import wandb
+        self.wandb = wandb
+        wandb.login()
+        self.run = wandb.init(
+            # Set the project where this run will be logged
+            project="asyrp",
+            name=args.exp.split("/")[-1],
+            # Track hyperparameters and run metadata
+            config=args)
+
+    def write(self, row):
+        self.wandb.log(row)
+
+    def image(self, key, image):
+        self.wandb.log({key: self.wandb.Image(image)})
+
+    def watch(self, module):
+        self.wandb.watch(module)
+
+    def save(self, path):
+        self.wandb.save(path)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class LocalBackend(object):
+    """Scalars go to {dir}/progress.json (one JSON object per line) and/or
+    {dir}/progress.csv, in the formats of guided_diffusion/logger.py. Images
+    are already on disk, so they are not logged."""
+
+    def __init__(self, dir, formats=('json', 'csv')):
+        self.outputs = [make_output_format(f, dir) for f in formats]
+
+    def write(self, row):
+        for output in self.outputs:
+            output.writekvs(dict(row))
+
+    def image(self, key, image):
+        pass
+
+    def watch(self, module):
+        pass
+
+    def save(self, path):
+        pass
+
+    def close(self):
+        for output in self.outputs:
+            output.close()
+
+
+class NullBackend(object):
+    def write(self, row):
+        pass
+
+    def image(self, key, image):
+        pass
+
+    def watch(self, module):
+        pass
+
+    def save(self, path):
+        pass
+
+    def close(self):
+        pass
+
+
+def host_values(tensors):
+    """{id(t): float} of scalar tensors, with one device to host copy per device."""
+    values = {}
+    for device in {t.device for t in tensors}:
+        on_device = [t for t in tensors if t.device == device]
+        for t, value in zip(on_device, torch.stack([t.float().reshape(()) for t in on_device]).tolist()):
+            values[id(t)] = value
+    return values
+
+
+class DeviceStats(object):
+    """Running sums of named scalars. Tensors are added on their device, so
+    `add` never syncs; `means` copies the window to the host and resets it."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, **values):
+        for k, v in values.items():
+            v = v.detach() if torch.is_tensor(v) else v
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    def means(self):
+        values = host_values([v for v in self.sums.values() if torch.is_tensor(v)])
+        means = {k: (values[id(v)] if torch.is_tensor(v) else float(v)) / self.counts[k] for k, v in self.sums.items()}
+        self.reset()
+        return means
+
+
+class MetricsLogger(object):
+    """Buffers scalar rows and writes them to a backend every `interval` rows.
+
+    Tensor values stay on their device until the flush, which copies all of
+    them to the host at once; so logging a step costs no device sync.
+    Images, watch and save go straight to the backend.
+    """
+
+    def __init__(self, backend, interval=1):
+        self.backend = backend
+        self.interval = max(interval, 1)
+        self._rows = []
+        self._lock = threading.Lock()  # the image writer logs from its own threads
+
+    def log(self, row):
+        row = {k: v.detach() if torch.is_tensor(v) else v for k, v in row.items()}
+        self._rows.append(row)
+        if len(self._rows) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        tensors = [v for row in rows for v in row.values() if torch.is_tensor(v)]
+        if tensors:
+            # one transfer per device for the whole buffer
+            values = host_values(tensors)
+            rows = [{k: values[id(v)] if torch.is_tensor(v) else v for k, v in row.items()} for row in rows]
+        with self._lock:
+            if self.backend is None:
+                return
+            for row in rows:
+                self.backend.write(row)
+
+    def log_image(self, key, image):
+        with self._lock:
+            if self.backend is not None:
+                self.backend.image(key, image)
+
+    def watch(self, module):
+        with self._lock:
+            if self.backend is not None:
+                self.backend.watch(module)
+
+    def save(self, path):
+        with self._lock:
+            if self.backend is not None:
+                self.backend.save(path)
+
+    def close(self):
+        if self.backend is None:
+            return
+        self.flush()
+        with self._lock:
+            self.backend.close()
+            self.backend = None
+
+
+def get_metrics_logger(args):
+    if args.logger == 'wandb':
+        backend = WandbBackend(args)
+    elif args.logger == 'local':
+        backend = LocalBackend(os.path.join(args.exp, 'logs'))
+    elif args.logger == 'none':
+        backend = NullBackend()
+    else:
+        raise ValueError(f"unknown logger {args.logger}")
+    logger = MetricsLogger(backend, interval=args.log_interval)
+    atexit.register(logger.close)
+    return logger
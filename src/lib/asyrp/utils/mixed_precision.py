@@ -0,0 +1,59 @@
+import torch
+
+from models.guided_diffusion.fp16_util import INITIAL_LOG_LOSS_SCALE, check_overflow
+
+
+DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def convert_frozen_unet(model, dtype):
+    """Store the frozen UNet torso in `dtype` where the model family supports it.
+
+    i_DDPM and guided_diffusion UNets have convert_to_fp16 (fp16_util); their
+    convolutions then hold 16-bit weights and the torso runs in `dtype` on its
+    own. DDPM has no such hook and keeps fp32 weights, which autocast casts
+    per call. The DeltaBlocks are attached after this and stay fp32 either way.
+    """
+    if hasattr(model, 'convert_to_fp16'):
+        model.convert_to_fp16(dtype)
+    return model
+
+
+class LossScaler(object):
+    """Dynamic loss scaling for fp32 parameters trained through an fp16 model.
+
+    The scheme of fp16_util.MixedPrecisionTrainer, for parameters that are
+    their own fp32 master weights (DeltaBlocks, delta_h): the loss is scaled
+    by 2 ** lg_loss_scale before backward, a step whose gradients overflow is
+    skipped and lowers lg_loss_scale by one, and every other step raises it
+    by fp16_scale_growth. Disabled (plain backward and step) for bf16 and fp32.
+    """
+
+    def __init__(self, params, enabled=True, fp16_scale_growth=1e-3, initial_lg_loss_scale=INITIAL_LOG_LOSS_SCALE):
+        self.params = list(params)
+        self.enabled = enabled
+        self.fp16_scale_growth = fp16_scale_growth
+        self.lg_loss_scale = initial_lg_loss_scale
+
+    def backward(self, loss):
+        if self.enabled:
+            loss = loss * 2 ** self.lg_loss_scale
+        loss.backward()
+
+    def step(self, opt):
+        """opt.step() on the unscaled gradients; returns False if the step was skipped."""
+        if not self.enabled:
+            opt.step()
+            return True
+        grads = [p.grad for p in self.params if p.grad is not None]
+        grad_norm = torch.norm(torch.stack([torch.norm(g.float()) for g in grads])).item() if grads else 0.0
+        if check_overflow(grad_norm):
+            self.lg_loss_scale -= 1
+            print(f"Found NaN, decreased lg_loss_scale to {self.lg_loss_scale}")
+            opt.zero_grad()
+            return False
+        for g in grads:
+            g.mul_(1.0 / 2 ** self.lg_loss_scale)
+        opt.step()
+        self.lg_loss_scale += self.fp16_scale_growth
+        return True
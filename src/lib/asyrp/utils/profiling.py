@@ -0,0 +1,141 @@
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+_NULL = contextlib.nullcontext()
+_profiler = None
+
+
+class StageProfiler(object):
+    """Latency, peak memory and throughput of named regions of the pipeline.
+
+    On the GPU a region is timed with a pair of CUDA events, read back in
+    `summary`, so profiling adds no syncs; on the CPU with perf_counter. The
+    peak memory of a region is the allocator peak since its outermost
+    enclosing region started. With `trace`, everything runs under
+    torch.profiler and the regions show up as record_function ranges of the
+    Chrome trace.
+    """
+
+    def __init__(self, out_dir, trace=False):
+        self.out_dir = out_dir
+        self.cuda = torch.cuda.is_available()
+        self._records = {}  # name -> [(start, end, n_images, peak_bytes)]
+        self._local = threading.local()  # region depth; DataParallel replicas run in threads
+        self._trace = None
+        if trace:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities, profile_memory=True)
+            self._trace.__enter__()
+
+    @contextlib.contextmanager
+    def region(self, name, n=None):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0 and self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self._local.depth = depth + 1
+        record = torch.profiler.record_function(name) if self._trace is not None else _NULL
+        try:
+            with record:
+                if self.cuda:
+                    start = torch.cuda.Event(enable_timing=True)
+                    start.record()
+                else:
+                    start = time.perf_counter()
+                yield
+        finally:
+            if self.cuda:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                peak = torch.cuda.max_memory_allocated()
+            else:
+                end = time.perf_counter()
+                peak = 0
+            self._local.depth = depth
+            self._records.setdefault(name, []).append((start, end, n, peak))
+
+    def summary(self):
+        """{region: calls, mean/p50/p95 latency (ms), total (s), peak memory (MB), images/s}"""
+        if self.cuda:
+            torch.cuda.synchronize()
+        summary = {}
+        for name, records in self._records.items():
+            if self.cuda:
+                ms = np.array([start.elapsed_time(end) for start, end, _, _ in records])
+            else:
+                ms = np.array([(end - start) * 1e3 for start, end, _, _ in records])
+            stats = {
+                'calls': len(records),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'total_s': float(ms.sum() / 1e3),
+                'peak_memory_mb': max(peak for _, _, _, peak in records) / 2 ** 20,
+            }
+            n_images = sum(n for _, _, n, _ in records if n is not None)
+            if n_images:
+                stats['images_per_s'] = n_images / stats['total_s']
+            summary[name] = stats
+        return summary
+
+    def close(self):
+        """Write {out_dir}/stages.json (and trace.json) and print the summary."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace.export_chrome_trace(os.path.join(self.out_dir, 'trace.json'))
+            self._trace = None
+        summary = self.summary()
+        with open(os.path.join(self.out_dir, 'stages.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        print(f"{'region':<28s}{'calls':>8s}{'mean ms':>10s}{'p50 ms':>10s}{'p95 ms':>10s}{'total s':>10s}{'peak MB':>10s}{'img/s':>10s}")
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]['total_s']):
+            print(f"{name:<28s}{s['calls']:>8d}{s['mean_ms']:>10.2f}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}"
+                  f"{s['total_s']:>10.2f}{s['peak_memory_mb']:>10.0f}{s.get('images_per_s', float('nan')):>10.1f}")
+        print(f"profile written to {self.out_dir}")
+        return summary
+
+
+def region(name, n=None):
+    """Context manager timing `name` (processing `n` images) while profiling is on; a no-op otherwise."""
+    if _profiler is None:
+        return _NULL
+    return _profiler.region(name, n)
+
+
+def profiled(name):
+    """Decorator form of `region`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with region(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_profiling(out_dir, trace=False):
+    global _profiler
+    if _profiler is None:
+        _profiler = StageProfiler(out_dir, trace=trace)
+        atexit.register(stop_profiling)
+    return _profiler
+
+
+def stop_profiling():
+    global _profiler
+    if _profiler is None:
+        return None
+    profiler, _profiler = _profiler, None
+    return profiler.close()
@@ -0,0 +1,92 @@
+import atexit
+import hashlib
+import os
+import threading
+
+import torch
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'asyrp', 'clip_text_features.pt')
+
+
+def templates_key(templates=None):
+    if templates is None:
+        return 'raw'
+    return hashlib.sha1('\n'.join(templates).encode()).hexdigest()[:16]
+
+
+class TextFeatureCache(object):
+    """Normalized CLIP text features, kept in memory and in one .pt file.
+
+    An entry is keyed by (clip model name, text, templates_key(templates),
+    encoder dtype) and holds the [len(templates), D] features of the text
+    formatted with every template (or [1, D] for the raw text), on the cpu in
+    that dtype. `clip.load` gives an fp16 encoder on the gpu and an fp32 one on
+    the cpu, so the two keep separate entries in the shared file.
+
+    `save` merges with what other processes wrote to the file meanwhile and
+    replaces it atomically; it runs at exit when there are new entries.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._features = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._features.update(self._read())
+        atexit.register(self.save)
+
+    def _read(self):
+        try:
+            return torch.load(self.path, map_location='cpu')
+        except Exception as e:  # a broken cache only costs the encoding
+            print(f"TextFeatureCache: ignoring {self.path} ({e})")
+            return {}
+
+    def features(self, model_name, texts, encode, templates=None, device='cpu', dtype=torch.float32):
+        """[len(texts) * len(templates), D] features, text-major (or [len(texts), D]
+        without templates), in `dtype`, the dtype of the encoder. `encode` maps a
+        list of strings to a [N, D] tensor; only the texts missing from the cache
+        are encoded, in one call."""
+        if isinstance(texts, str):
+            texts = [texts]
+        key = (templates_key(templates), str(dtype))
+        with self._lock:
+            missing = [text for text in dict.fromkeys(texts) if (model_name, text, *key) not in self._features]
+        if missing:
+            strings = list(missing) if templates is None \
+                else [template.format(text) for text in missing for template in templates]
+            with torch.no_grad():
+                encoded = encode(strings).detach()
+            encoded = (encoded / encoded.norm(dim=-1, keepdim=True)).cpu()
+            with self._lock:
+                for text, features in zip(missing, encoded.chunk(len(missing))):
+                    self._features[(model_name, text, *key)] = features.clone()
+                self._dirty = True
+        return torch.cat([self._features[(model_name, text, *key)] for text in texts]).to(device=device, dtype=dtype)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            features = self._read() if os.path.exists(self.path) else {}
+            features.update(self._features)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # write-then-rename, so readers never see a half written file
+            tmp_path = f'{self.path}.tmp{os.getpid()}'
+            torch.save(features, tmp_path)
+            os.replace(tmp_path, self.path)
+            self._features = features
+            self._dirty = False
+
+
+_cache = None
+
+
+def get_text_feature_cache():
+    """The process-wide cache, at $ASYRP_TEXT_CACHE or ~/.cache/asyrp/clip_text_features.pt."""
+    global _cache
+    if _cache is None:
+        _cache = TextFeatureCache(os.environ.get('ASYRP_TEXT_CACHE', DEFAULT_PATH))
+    return _cache
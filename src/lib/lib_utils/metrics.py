@@ -26,6 +26,7 @@ from transformers import (
 
 # dictionary of source and target texts for all attributes
 from utils.text_dic import SRC_TRG_TXT_DIC
+from utils.text_feature_cache import get_text_feature_cache
 
 # constants
 DEVICE = "cuda:0"
@@ -147,8 +148,10 @@ def reproduction_fid(dt_lambda=0.5, run_path=RUNSPATH):
 
 
 class DirectionalSimilarity(nn.Module):
-    def __init__(self, tokenizer, text_encoder, image_processor, image_encoder):
+    def __init__(self, tokenizer, text_encoder, image_processor, image_encoder, model_name=None):
         super().__init__()
+        # with a model name, text features come from the on-disk text feature cache
+        self.model_name = model_name
         self.tokenizer = tokenizer
         self.text_encoder = text_encoder
         self.image_processor = image_processor
@@ -175,6 +178,11 @@ class DirectionalSimilarity(nn.Module):
         return image_features
 
     def encode_text(self, text):
+        if self.model_name is not None:
+            return get_text_feature_cache().features(self.model_name, text, self._encode_text, device=DEVICE)
+        return self._encode_text(text)
+
+    def _encode_text(self, text):
         tokenized_text = self.tokenize_text(text)
         text_features = self.text_encoder(**tokenized_text).text_embeds
         text_features = text_features / text_features.norm(dim=1, keepdim=True)
@@ -210,7 +218,7 @@ def reproduction_sdir(dt_lambda=1.0, run_paths=RUNSPATH):
     image_processor = CLIPImageProcessor.from_pretrained(clip_id)
     image_encoder = CLIPVisionModelWithProjection.from_pretrained(clip_id).to(DEVICE)
 
-    dir_similarity = DirectionalSimilarity(tokenizer, text_encoder, image_processor, image_encoder)
+    dir_similarity = DirectionalSimilarity(tokenizer, text_encoder, image_processor, image_encoder, model_name=clip_id)
 
     results = {}
     for attr in attrs: